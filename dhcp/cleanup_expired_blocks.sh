@@ -8,6 +8,10 @@ BLOCK_REGISTRY="/var/lib/dhcp-blocks"
 LOG_FILE="/var/log/dhcp-blocks.log"
 NOW=$(date +%s)
 
+# The temporal policy engine unblocks devices exactly at expiry; this cron
+# job is only a fallback for when it is not running
+curl -sf -o /dev/null "http://127.0.0.1:1889/stats" 2>/dev/null && exit 0
+
 # Check if registry exists
 if [ ! -d "$BLOCK_REGISTRY" ]; then
     exit 0
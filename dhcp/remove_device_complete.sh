@@ -46,6 +46,18 @@ if [ -n "$SSH_CLIENT" ]; then
     fi
 fi
 
+# Prefer the temporal policy engine: it persists the block and lifts it at
+# expiry itself, so no sleep/at job is left behind for this device
+ENGINE_URL="http://127.0.0.1:1889"
+if RESPONSE=$(curl -sf -X POST "$ENGINE_URL/devices/block" \
+        -H "Content-Type: application/json" \
+        -d "{\"mac\": \"$MAC_LOWER\", \"duration\": $BLOCK_DURATION, \"force\": true}" 2>/dev/null); then
+    echo "✓ Device $MAC_LOWER blocked for $BLOCK_DURATION seconds by the temporal policy engine"
+    echo "$RESPONSE"
+    exit 0
+fi
+echo "! Temporal policy engine not reachable - blocking directly"
+
 echo "========================================"
 echo "Removing device: $MAC_LOWER"
 echo "========================================"
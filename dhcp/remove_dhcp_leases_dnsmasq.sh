@@ -17,22 +17,29 @@ BACKUP_FILE="${BACKUP_DIR}/dnsmasq.leases.backup.$(date +%Y%m%d_%H%M%S)"
 cp "$LEASE_FILE" "$BACKUP_FILE"
 echo "Backed up leases to: $BACKUP_FILE"
 
-# Remove leases for each MAC address
-for mac in "$@"; do
-    # Normalize to lowercase
-    mac_lower=$(echo "$mac" | tr '[:upper:]' '[:lower:]')
+LEASES_PY="/usr/local/bin/temporal/leases.py"
+
+if [ -f "$LEASES_PY" ]; then
+    # One atomic rewrite for all MACs instead of a sed -i pass per MAC
+    python3 "$LEASES_PY" --file "$LEASE_FILE" remove "$@"
+else
+    # Remove leases for each MAC address
+    for mac in "$@"; do
+        # Normalize to lowercase
+        mac_lower=$(echo "$mac" | tr '[:upper:]' '[:lower:]')
     
-    # Count matching leases before removal
-    count=$(grep -ci "$mac_lower" "$LEASE_FILE" || true)
+        # Count matching leases before removal
+        count=$(grep -ci "$mac_lower" "$LEASE_FILE" || true)
     
-    if [ "$count" -gt 0 ]; then
-        # Remove matching lines (case-insensitive)
-        sed -i "/${mac_lower}/Id" "$LEASE_FILE"
-        echo "Removed $count lease(s) for MAC: $mac_lower"
-    else
-        echo "No lease found for MAC: $mac_lower"
-    fi
-done
+        if [ "$count" -gt 0 ]; then
+            # Remove matching lines (case-insensitive)
+            sed -i "/${mac_lower}/Id" "$LEASE_FILE"
+            echo "Removed $count lease(s) for MAC: $mac_lower"
+        else
+            echo "No lease found for MAC: $mac_lower"
+        fi
+    done
+fi
 
 # Restart dnsmasq service
 echo "Restarting dnsmasq service..."
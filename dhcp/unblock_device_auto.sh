@@ -23,6 +23,16 @@ fi
 # Normalize MAC
 MAC_LOWER=$(echo "$MAC" | tr '[:upper:]' '[:lower:]' | tr '-' ':')
 
+# Blocks made through the temporal policy engine are tracked there
+ENGINE_URL="http://127.0.0.1:1889"
+if RESPONSE=$(curl -sf -X POST "$ENGINE_URL/devices/unblock" \
+        -H "Content-Type: application/json" \
+        -d "{\"mac\": \"$MAC_LOWER\"}" 2>/dev/null); then
+    echo "✓ Device $MAC_LOWER unblocked by the temporal policy engine"
+    echo "$RESPONSE"
+    exit 0
+fi
+
 echo "========================================"
 echo "Auto-unblocking device: $MAC_LOWER"
 [ -n "$IP" ] && echo "IP Address: $IP"
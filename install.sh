@@ -23,12 +23,24 @@ sudo mkdir -p /usr/local/bin/temporal
 sudo mv /tmp/auto_start_backend.sh \
         /tmp/backend_stub.py \
         /tmp/cleanup_policies.sh \
+        /tmp/device_blocks.py \
+        /tmp/dns_sinkhole.py \
+        /tmp/domain_trie.py \
+        /tmp/firewall.py \
+        /tmp/groups.py \
         /tmp/import_hosts.sh \
+        /tmp/leases.py \
+        /tmp/lifecycle.py \
+        /tmp/logs.py \
+        /tmp/metrics.py \
         /tmp/net_policies.json \
         /tmp/policies.json \
         /tmp/Policy.py \
+        /tmp/policy_files.py \
+        /tmp/query_log.py \
         /tmp/requirements.txt \
         /tmp/run_backend.bat \
+        /tmp/storage.py \
         /tmp/temporal \
         /tmp/temporal_policy.py \
         /tmp/temporal_policy.state \
@@ -38,6 +50,8 @@ sudo mv /tmp/auto_start_backend.sh \
 [ -f /tmp/temporal-policy.log ] && sudo mv /tmp/temporal-policy.log /usr/local/bin/temporal/ || true
 [ -f /tmp/temporal-policy.pid ] && sudo mv /tmp/temporal-policy.pid /usr/local/bin/temporal/ || true
 [ -f /tmp/temporal-policy.service ] && sudo mv /tmp/temporal-policy.service /usr/local/bin/temporal/ || true
+[ -f /tmp/temporal-policy.socket ] && sudo mv /tmp/temporal-policy.socket /usr/local/bin/temporal/ || true
+[ -f /tmp/seer-dns@.service ] && sudo mv /tmp/seer-dns@.service /usr/local/bin/temporal/ || true
 [ -d /tmp/__pycache__ ] && sudo mv /tmp/__pycache__ /usr/local/bin/temporal/ || true
 
 # Set permissions
@@ -1,5 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER policy model
+Compact Policy objects shared by the policy engine and the backend stub:
+slotted, with interned destinations and schedules pre-parsed into
+minute-of-week intervals that equal schedules share
+"""
 
+import bisect
+import json
+import sys
+import time
 
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+DAY_NAMES = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
 
+# Compiled schedules are immutable, and most policies share a few schedules
+COMPILED_SCHEDULE_CACHE_SIZE = 1024
 
+# The C string encoder json.dumps itself uses
+_quote = json.encoder.encode_basestring_ascii
 
+
+def _parse_hhmm(value):
+    """Parse 'HH:MM' into minutes since midnight"""
+    try:
+        hours, minutes = (int(part) for part in str(value).strip().split(":"))
+    except ValueError:
+        raise ValueError("Invalid time: %r" % (value,))
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError("Invalid time: %r" % (value,))
+    return hours * 60 + minutes
+
+
+def _parse_days(days):
+    """Parse a list of day names ('mon', 'Tuesday') or numbers (0 = Monday)"""
+    if not days:
+        return list(range(7))
+    if isinstance(days, (str, int)):
+        days = [days]
+    parsed = set()
+    for day in days:
+        if isinstance(day, int):
+            index = day
+        else:
+            name = str(day).strip().lower()[:3]
+            if name not in DAY_NAMES:
+                raise ValueError("Invalid day: %r" % (day,))
+            index = DAY_NAMES.index(name)
+        if not 0 <= index < 7:
+            raise ValueError("Invalid day: %r" % (day,))
+        parsed.add(index)
+    return sorted(parsed)
+
+
+def _format_hhmm(minutes):
+    return "%02d:%02d" % divmod(minutes, 60)
+
+
+def minute_of_week(timestamp):
+    """Local minute of the week (0 = Monday 00:00) for a UNIX timestamp"""
+    lt = time.localtime(timestamp)
+    return lt.tm_wday * MINUTES_PER_DAY + lt.tm_hour * 60 + lt.tm_min
+
+
+class Schedule:
+    """A daily window, pre-parsed into sorted minute-of-week intervals
+
+    start and end are minutes since midnight (end inclusive, so 00:00-23:59
+    is the whole day); a window whose end is before its start crosses
+    midnight. days is a tuple of weekday numbers (0 = Monday) on which the
+    window starts, or None for every day. Instances are immutable and
+    shared through compile_schedule().
+    """
+
+    __slots__ = ("start", "end", "days", "intervals", "transitions", "always", "json")
+
+    def __init__(self, start=0, end=MINUTES_PER_DAY - 1, days=None):
+        self.start = start
+        self.end = end
+        self.days = tuple(days) if days is not None and len(days) < 7 else None
+        length = (end + 1 - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+
+        intervals = []
+        for day in self.days if self.days is not None else range(7):
+            begin = day * MINUTES_PER_DAY + start
+            if begin + length <= MINUTES_PER_WEEK:
+                intervals.append((begin, begin + length))
+            else:
+                intervals.append((begin, MINUTES_PER_WEEK))
+                intervals.append((0, begin + length - MINUTES_PER_WEEK))
+        intervals.sort()
+
+        merged = []
+        for begin, finish in intervals:
+            if merged and begin <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], finish))
+            else:
+                merged.append((begin, finish))
+        self.intervals = tuple(merged)
+        self.always = merged == [(0, MINUTES_PER_WEEK)]
+        # Only boundaries where the state actually flips (intervals touching
+        # across the Sunday/Monday wrap do not produce a transition)
+        self.transitions = () if self.always else tuple(sorted(set(
+            point % MINUTES_PER_WEEK
+            for interval in merged for point in interval
+            if self.active(point % MINUTES_PER_WEEK) != self.active((point - 1) % MINUTES_PER_WEEK)
+        )))
+        self.json = json.dumps(self.to_dict())
+
+    def active(self, minute):
+        if self.always:
+            return True
+        i = bisect.bisect_right(self.intervals, (minute, MINUTES_PER_WEEK)) - 1
+        return i >= 0 and self.intervals[i][0] <= minute < self.intervals[i][1]
+
+    def minutes_until_next(self, minute):
+        """Minutes from minute-of-week until the next state change (not for always-active schedules)"""
+        i = bisect.bisect_right(self.transitions, minute)
+        if i < len(self.transitions):
+            return self.transitions[i] - minute
+        return self.transitions[0] + MINUTES_PER_WEEK - minute
+
+    def to_dict(self):
+        schedule = {"start": _format_hhmm(self.start), "end": _format_hhmm(self.end)}
+        if self.days is not None:
+            schedule["days"] = [DAY_NAMES[day] for day in self.days]
+        return schedule
+
+    def __repr__(self):
+        return "Schedule(%s)" % self.json
+
+
+ALL_DAY = Schedule()
+
+
+def parse_schedule(schedule):
+    """Compile a {"start", "end", "days"} schedule dict; raises ValueError if it is invalid"""
+    if not schedule:
+        return ALL_DAY
+    if not isinstance(schedule, dict):
+        raise ValueError("Schedule must be an object")
+    return Schedule(_parse_hhmm(schedule.get("start", "00:00")),
+                    _parse_hhmm(schedule.get("end", "23:59")),
+                    _parse_days(schedule.get("days")))
+
+
+_compiled_schedules = {}
+
+
+def compile_schedule(schedule):
+    """parse_schedule, memoized on the schedule's content; a Schedule is returned as is"""
+    if isinstance(schedule, Schedule):
+        return schedule
+    if not isinstance(schedule, dict):
+        return parse_schedule(schedule)
+    key = repr(sorted(schedule.items()))
+    try:
+        return _compiled_schedules[key]
+    except KeyError:
+        pass
+    compiled = parse_schedule(schedule)
+    if len(_compiled_schedules) >= COMPILED_SCHEDULE_CACHE_SIZE:
+        _compiled_schedules.clear()
+    _compiled_schedules[key] = compiled
+    return compiled
+
+
+class Policy:
+    """One blocking policy
+
+    The destination is interned and the schedule is a shared Schedule, so
+    a policy costs one small slotted object. Policies are replaced, never
+    mutated, once published: use replace() to change one.
+    """
+
+    __slots__ = ("destination", "schedule", "enabled", "source", "name", "restored_from_db")
+
+    def __init__(self, destination, schedule=None, enabled=True, source=None, name=None,
+                 restored_from_db=False):
+        self.destination = sys.intern(destination)
+        self.schedule = compile_schedule(schedule)
+        self.enabled = bool(enabled)
+        self.source = sys.intern(source) if source else None
+        self.name = name
+        self.restored_from_db = restored_from_db
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a policy from its JSON form ("policy" is the display name)"""
+        return cls(data["destination"], data.get("schedule"), data.get("enabled", True),
+                   data.get("source"), data.get("policy"), data.get("restored_from_db", False))
+
+    def replace(self, **changes):
+        fields = dict((name, getattr(self, name)) for name in self.__slots__)
+        fields.update(changes)
+        return Policy(**fields)
+
+    def to_dict(self):
+        data = {}
+        if self.name is not None:
+            data["policy"] = self.name
+        if self.source is not None:
+            data["source"] = self.source
+        data["destination"] = self.destination
+        data["enabled"] = self.enabled
+        data["schedule"] = self.schedule.to_dict()
+        if self.restored_from_db:
+            data["restored_from_db"] = True
+        return data
+
+    def to_json(self):
+        """Same text as json.dumps(self.to_dict()), without building the dicts"""
+        head = ""
+        if self.name is not None:
+            head = '"policy": %s, ' % _quote(self.name)
+        if self.source is not None:
+            head += '"source": %s, ' % _quote(self.source)
+        return '{%s"destination": %s, "enabled": %s, "schedule": %s%s}' % (
+            head, _quote(self.destination), "true" if self.enabled else "false", self.schedule.json,
+            ', "restored_from_db": true' if self.restored_from_db else "")
+
+    def __repr__(self):
+        return "Policy(%s)" % self.to_json()
+
+
+def encode_policies(policies):
+    """JSON array of policies, as json.dumps would write their dicts"""
+    return "[%s]" % ", ".join([policy.to_json() for policy in policies])
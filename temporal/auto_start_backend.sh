@@ -4,6 +4,11 @@ PORT=1889
 SCRIPT_PATH="/home/admin/Desktop/TemporalFiles/temporal_policy.py"
 PID_FILE="/home/admin/Desktop/TemporalFiles/temporal-policy.pid"
 LOG_FILE="/home/admin/Desktop/TemporalFiles/temporal-policy.log"
+# Only crash output lands here; the engine writes and rotates LOG_FILE itself
+ERR_FILE="/home/admin/Desktop/TemporalFiles/temporal-policy.err"
+# Seconds to wait for the engine to answer, and for a stop to drain
+READY_TIMEOUT=60
+STOP_TIMEOUT=30
 
 # Function to check if backend is running
 is_running() {
@@ -16,16 +21,30 @@ is_running() {
     return 1
 }
 
+# Start time of the running engine (changes when it restarts in place)
+started_at() {
+    curl -s --max-time 5 "http://127.0.0.1:${PORT}/stats" 2>/dev/null | grep -o '"started": [0-9.]*'
+}
+
+# Wait until the engine answers with a start time other than $1
+wait_ready() {
+    for _ in $(seq $((READY_TIMEOUT * 10))); do
+        STARTED=$(started_at)
+        if [ -n "$STARTED" ] && [ "$STARTED" != "$1" ]; then
+            return 0
+        fi
+        is_running || return 1
+        sleep 0.1
+    done
+    return 1
+}
+
 # Function to start backend
 start_backend() {
     echo "[$(date)] Starting backend..." | tee -a "$LOG_FILE"
     
-    # Kill any existing process on port
-    sudo fuser -k ${PORT}/tcp 2>/dev/null
-    sleep 1
-    
-    # Start backend in background
-    sudo nohup python3 "$SCRIPT_PATH" >> "$LOG_FILE" 2>&1 &
+    # Start backend in background; it stops an older engine still holding the port itself
+    sudo nohup python3 "$SCRIPT_PATH" --log-file "$LOG_FILE" > /dev/null 2>> "$ERR_FILE" &
     echo $! > "$PID_FILE"
     
     echo "[$(date)] Backend started with PID $(cat $PID_FILE)" | tee -a "$LOG_FILE"
@@ -36,25 +55,46 @@ stop_backend() {
     if [ -f "$PID_FILE" ]; then
         PID=$(cat "$PID_FILE")
         echo "[$(date)] Stopping backend PID $PID..." | tee -a "$LOG_FILE"
-        sudo kill -9 "$PID" 2>/dev/null
+        # SIGTERM: the engine finishes requests in progress and queued changes first
+        sudo kill -TERM "$PID" 2>/dev/null
+        for _ in $(seq $((STOP_TIMEOUT * 10))); do
+            ps -p "$PID" > /dev/null 2>&1 || break
+            sleep 0.1
+        done
+        if ps -p "$PID" > /dev/null 2>&1; then
+            echo "[$(date)] Backend did not stop within ${STOP_TIMEOUT}s, killing it" | tee -a "$LOG_FILE"
+            sudo kill -9 "$PID" 2>/dev/null
+        fi
         rm -f "$PID_FILE"
-        sudo fuser -k ${PORT}/tcp 2>/dev/null
         echo "[$(date)] Backend stopped" | tee -a "$LOG_FILE"
     else
-        echo "No PID file found. Trying to kill by port..."
-        sudo fuser -k ${PORT}/tcp 2>/dev/null
+        echo "No PID file found. Trying to stop by port..."
+        sudo fuser -k -TERM ${PORT}/tcp 2>/dev/null
         echo "Backend stopped"
     fi
 }
 
+# Restart in place: the engine drains, then re-executes itself on the same
+# listening socket, so requests made meanwhile wait instead of failing
+restart_backend() {
+    PID=$(cat "$PID_FILE")
+    BEFORE=$(started_at)
+    echo "[$(date)] Restarting backend PID $PID in place..." | tee -a "$LOG_FILE"
+    sudo kill -USR2 "$PID" 2>/dev/null
+    if wait_ready "$BEFORE"; then
+        echo "[$(date)] Backend restarted" | tee -a "$LOG_FILE"
+    else
+        echo "Backend did not come back. Check logs: $LOG_FILE"
+    fi
+}
+
 case "$1" in
     start)
         if is_running; then
             echo "Backend already running (PID: $(cat $PID_FILE))"
         else
             start_backend
-            sleep 2
-            if is_running; then
+            if wait_ready ""; then
                 echo "Backend started successfully!"
             else
                 echo "Failed to start backend. Check logs: $LOG_FILE"
@@ -65,9 +105,12 @@ case "$1" in
         stop_backend
         ;;
     restart)
-        stop_backend
-        sleep 2
-        start_backend
+        if is_running; then
+            restart_backend
+        else
+            start_backend
+            wait_ready "" || echo "Failed to start backend. Check logs: $LOG_FILE"
+        fi
         ;;
     status)
         if is_running; then
@@ -78,7 +121,7 @@ case "$1" in
         ;;
     logs)
         if [ -f "$LOG_FILE" ]; then
-            tail -f "$LOG_FILE"
+            tail -F "$LOG_FILE"
         else
             echo "No log file found at $LOG_FILE"
         fi
@@ -1,8 +1,14 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
+from functools import lru_cache
 import re
+import time
+
+from domain_trie import DomainTrie
+from leases import LEASE_FILE, LeaseIndex
+from Policy import Policy
 
 app = FastAPI(title="SEER Backend Stub")
 
@@ -15,16 +21,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory device and policy storage
-devices = [
+# Devices come from the dnsmasq lease file; the sample list is served where
+# there is none (e.g. running the stub on Windows)
+lease_index = LeaseIndex(LEASE_FILE)
+sample_devices = [
     {"ip": "192.168.50.101", "hostname": "phone-joe", "mac": "AA:BB:CC:00:11:01", "uptime": 3600, "static": False, "interface": "lan0", "status": "active"},
     {"ip": "192.168.50.102", "hostname": "laptop-sara", "mac": "AA:BB:CC:00:11:02", "uptime": 7200, "static": False, "interface": "lan0", "status": "active"},
     {"ip": "192.168.50.1", "hostname": "board", "mac": "AA:BB:CC:00:11:FF", "uptime": 99999, "static": True, "interface": "wan0", "status": "active"}
 ]
 
-policies: List[dict] = []
+# In-memory policy storage
+policies: List[Policy] = []
 blocked_domains = set()
 
+# Indexes maintained incrementally on every mutation
+policies_by_domain: Dict[str, List[Policy]] = {} # normalized destination -> policies
+enabled_count: Dict[str, int] = {}               # normalized destination -> enabled policies
+board_count: Dict[str, int] = {}                 # normalized destination -> enabled board-wide policies
+blocked_trie = DomainTrie()                      # enabled destinations, matched with subdomain semantics
+sample_by_ip = {d["ip"]: d for d in sample_devices}
+sample_by_mac = {d["mac"].lower(): d for d in sample_devices}
+
 # Models
 class PolicyIn(BaseModel):
     policy: Optional[str]
@@ -37,9 +54,13 @@ class TestIn(BaseModel):
     source: Optional[str]
     destination: str
 
+class TestBatchIn(BaseModel):
+    tests: List[TestIn]
+
 # Helpers
 _domain_re = re.compile(r"^(?:https?://)?(?:www\.)?([^/:]+)", re.IGNORECASE)
 
+@lru_cache(maxsize=65536)
 def normalize_domain(url: str) -> str:
     if not url:
         return ""
@@ -48,35 +69,113 @@ def normalize_domain(url: str) -> str:
         return m.group(1).lower()
     return url.strip().lower()
 
+def _bump(counter: Dict[str, int], dest: str, delta: int):
+    count = counter.get(dest, 0) + delta
+    if count:
+        counter[dest] = count
+    else:
+        counter.pop(dest, None)
+
+def index_policy(p: Policy, delta: int = 1):
+    """Add (delta=1) or remove (delta=-1) one policy from the indexes"""
+    dest = normalize_domain(p.destination)
+    if not dest:
+        return
+    bucket = policies_by_domain.setdefault(dest, [])
+    if delta > 0:
+        bucket.append(p)
+    else:
+        bucket[:] = [q for q in bucket if q is not p]
+        if not bucket:
+            del policies_by_domain[dest]
+    if p.enabled:
+        _bump(enabled_count, dest, delta)
+        if p.source == "board":
+            _bump(board_count, dest, delta)
+        if dest in enabled_count:
+            blocked_domains.add(dest)
+            blocked_trie.insert(dest, dest)
+        else:
+            blocked_domains.discard(dest)
+            blocked_trie.remove(dest)
+
 def rebuild_blocked():
-    global blocked_domains
-    blocked_domains = set()
+    """Rebuild every index from scratch (only needed if policies is replaced wholesale)"""
+    global blocked_trie
+    blocked_trie = DomainTrie()
+    policies_by_domain.clear()
+    enabled_count.clear()
+    board_count.clear()
+    blocked_domains.clear()
     for p in policies:
-        if p.get("enabled") and p.get("destination"):
-            blocked_domains.add(normalize_domain(p["destination"]))
+        index_policy(p)
+
+def lease_to_device(lease, now: float) -> dict:
+    return {
+        "ip": lease.ip,
+        "hostname": lease.hostname or "Unknown",
+        "mac": (lease.mac or "").upper(),
+        "expires": lease.expires,
+        "static": lease.static,
+        "status": "active" if lease.static or lease.expires > now else "expired",
+    }
+
+def mac_key(mac: str) -> str:
+    return mac.replace("-", ":").lower()
+
+def known_device(source: str) -> bool:
+    """True if source is the IP or MAC of a known device"""
+    if lease_index.exists():
+        return (lease_index.by_ip(source) or lease_index.by_mac(mac_key(source))) is not None
+    return source in sample_by_ip or mac_key(source) in sample_by_mac
+
+def evaluate(source: Optional[str], destination: str) -> dict:
+    """Policy check for one (source, destination) pair in O(labels)"""
+    # A policy for facebook.com also covers m.facebook.com, as in dnsmasq
+    found = blocked_trie.match(normalize_domain(destination))
+    # If blocked and applies to board or the specific source, consider the policy effective
+    if found is None:
+        return {"success": False, "reason": "not_blocked"}
+    dest = found[0]
+    # A board-wide policy applies to everyone; otherwise the source must be a known device
+    applies_to_source = dest in board_count or bool(source and known_device(source))
+    return {"success": applies_to_source, "matched": dest}
 
 # Endpoints
 @app.get("/devices")
 async def get_devices():
-    return devices
+    if not lease_index.exists():
+        return sample_devices
+    now = time.time()
+    return [lease_to_device(lease, now) for lease in lease_index.all()]
+
+@app.get("/devices/{mac}")
+async def get_device(mac: str):
+    if not lease_index.exists():
+        device = sample_by_mac.get(mac_key(mac))
+        if device is None:
+            raise HTTPException(status_code=404, detail="Device not found")
+        return device
+    lease = lease_index.by_mac(mac_key(mac))
+    if lease is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    return lease_to_device(lease, time.time())
 
 @app.get("/policies")
 async def get_policies():
-    return policies
+    return [p.to_dict() for p in policies]
 
 @app.post("/policies")
 async def add_policy(p: PolicyIn):
     # If source empty, treat as board-wide
     src = p.source if p.source else "board"
-    item = {
-        "policy": p.policy or f"Block {p.destination}",
-        "source": src,
-        "destination": p.destination,
-        "schedule": p.schedule or {"start": "00:00", "end": "23:59"},
-        "enabled": p.enabled if p.enabled is not None else True
-    }
+    try:
+        item = Policy(p.destination, p.schedule, p.enabled if p.enabled is not None else True,
+                      src, p.policy or f"Block {p.destination}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid schedule: {e}")
     policies.append(item)
-    rebuild_blocked()
+    index_policy(item)
     return {"status": "ok", "index": len(policies)-1}
 
 @app.put("/policies/{index}")
@@ -84,44 +183,37 @@ async def update_policy(index: int, p: PolicyIn):
     if index < 0 or index >= len(policies):
         raise HTTPException(status_code=404, detail="Policy not found")
     src = p.source if p.source else "board"
-    policies[index].update({
-        "policy": p.policy or policies[index].get("policy"),
-        "source": src,
-        "destination": p.destination or policies[index].get("destination"),
-        "schedule": p.schedule or policies[index].get("schedule"),
-        "enabled": p.enabled if p.enabled is not None else policies[index].get("enabled", True)
-    })
-    rebuild_blocked()
+    old = policies[index]
+    try:
+        item = old.replace(
+            name=p.policy or old.name,
+            source=src,
+            destination=p.destination or old.destination,
+            schedule=p.schedule or old.schedule,
+            enabled=p.enabled if p.enabled is not None else old.enabled,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid schedule: {e}")
+    index_policy(old, -1)
+    policies[index] = item
+    index_policy(item)
     return {"status": "ok"}
 
 @app.delete("/policies/{index}")
 async def delete_policy(index: int):
     if index < 0 or index >= len(policies):
         raise HTTPException(status_code=404, detail="Policy not found")
-    policies.pop(index)
-    rebuild_blocked()
+    index_policy(policies.pop(index), -1)
     return {"status": "ok"}
 
 @app.post("/test")
 async def test_policy(t: TestIn):
-    # Normalize domain
-    dest = normalize_domain(t.destination)
-    # If blocked and applies to board or the specific source, consider the policy effective
-    is_blocked = dest in blocked_domains
-    applies_to_source = False
-    if not is_blocked:
-        return {"success": False, "reason": "not_blocked"}
-    # If any enabled policy for this dest says source==board, or the provided source matches devices on board => applies
-    for p in policies:
-        if p.get("enabled") and normalize_domain(p.get("destination","")) == dest:
-            if p.get("source") == "board":
-                applies_to_source = True
-                break
-            # if the source IP is listed in devices and matches
-            if t.source and any(d["ip"] == t.source for d in devices):
-                applies_to_source = True
-                break
-    return {"success": applies_to_source}
+    return evaluate(t.source, t.destination)
+
+@app.post("/test/batch")
+async def test_policy_batch(batch: TestBatchIn):
+    # Evaluate many (source, destination) pairs in one request
+    return {"results": [evaluate(t.source, t.destination) for t in batch.tests]}
 
 @app.post("/reload")
 async def reload_services():
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GET latency of the policy API while a burst of POST blocks is running
+
+Runs temporal_policy.PolicyHandler in-process against a temporary hosts
+file, dnsmasq config and database, with dnsmasq reloads replaced by a
+sleep. Compares the old single-threaded HTTPServer with the
+ThreadingHTTPServer front end.
+
+Usage: python3 bench_api_latency.py [--posts 200] [--commit-delay 20]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import HTTPServer, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import temporal_policy as tp  # noqa: E402
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def sandbox(workdir, commit_delay, reload_delay):
+    """Point the engine at files under workdir and stub out slow system calls"""
+    tp.HOSTS_FILE = os.path.join(workdir, "hosts")
+    tp.DNSMASQ_CONF = os.path.join(workdir, "blocked-sites.conf")
+    tp.DB_PATH = os.path.join(workdir, "seer.db")
+    with open(tp.HOSTS_FILE, "w") as f:
+        f.write("127.0.0.1 localhost\n")
+    tp.ensure_db_initialized()
+
+    save = tp.save_blocked_website_to_db
+
+    def slow_save(*args):
+        # SD-card fsync cost of the commit
+        time.sleep(commit_delay / 1000.0)
+        return save(*args)
+
+    def fake_reload(restart=True):
+        time.sleep(reload_delay / 1000.0)
+        return "restart" if restart else "sighup"
+
+    tp.save_blocked_website_to_db = slow_save
+    tp.reload_dnsmasq = fake_reload
+    tp.BLOCKLIST.load([])
+    tp.WRITE_QUEUE.start()
+
+
+def run_case(server_class, posts, getters):
+    server = server_class(("127.0.0.1", 0), tp.PolicyHandler)
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    done = threading.Event()
+    latencies = []
+
+    def post_burst():
+        for i in range(posts):
+            body = json.dumps({"action": "block", "domain": "bench%d-%s.example" % (i, server_class.__name__)}).encode()
+            request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(request).read()
+        done.set()
+
+    def get_loop():
+        while not done.is_set():
+            start = time.perf_counter()
+            urllib.request.urlopen(url).read()
+            latencies.append((time.perf_counter() - start) * 1000.0)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=post_burst)] + [threading.Thread(target=get_loop) for _ in range(getters)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    server.shutdown()
+    server.server_close()
+    return {
+        "server": server_class.__name__,
+        "posts": posts,
+        "post_rate": posts / elapsed,
+        "gets": len(latencies),
+        "get_p50_ms": percentile(latencies, 50),
+        "get_p99_ms": percentile(latencies, 99),
+        "get_max_ms": max(latencies) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--posts", type=int, default=200, help="POST blocks in the burst")
+    parser.add_argument("--getters", type=int, default=2, help="concurrent GET pollers")
+    parser.add_argument("--commit-delay", type=float, default=20.0, help="simulated DB commit cost (ms)")
+    parser.add_argument("--reload-delay", type=float, default=500.0, help="simulated dnsmasq restart (ms)")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    tp.print = lambda *a, **k: None  # keep engine chatter out of the report
+    tp.PolicyHandler.log_message = lambda *a: None
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        sandbox(workdir, args.commit_delay, args.reload_delay)
+        for server_class in (HTTPServer, ThreadingHTTPServer):
+            results.append(run_case(server_class, args.posts, args.getters))
+        tp.WRITE_QUEUE.stop()
+        tp.RELOAD_SCHEDULER.flush()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("%-20s %8s %8s %10s %10s %10s" % ("server", "POST/s", "GETs", "p50 ms", "p99 ms", "max ms"))
+    for r in results:
+        print("%-20s %8.1f %8d %10.2f %10.2f %10.2f" % (
+            r["server"], r["post_rate"], r["gets"], r["get_p50_ms"], r["get_p99_ms"], r["get_max_ms"]))
+
+
+if __name__ == "__main__":
+    main()
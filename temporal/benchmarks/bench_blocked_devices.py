@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Latency of listing blocked devices: list_blocked_devices.sh vs GET /devices/blocked
+
+Blocks N devices in a sandboxed DeviceBlockManager (temporary database,
+lease file and registry, dry-run firewall), then times the in-memory
+listing, the HTTP endpoint, and the shell script run against the same
+registry files. Some hostnames contain quotes, which the script's
+hand-built JSON does not escape.
+
+Usage: python3 bench_blocked_devices.py [--devices 10 100 500] [--rounds 200]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import temporal_policy as tp  # noqa: E402
+from device_blocks import DeviceBlockManager  # noqa: E402
+from firewall import NftablesBackend  # noqa: E402
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "dhcp", "list_blocked_devices.sh")
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def setup(workdir, count):
+    """Sandbox the engine and block count devices"""
+    tp.DB_PATH = os.path.join(workdir, "seer.db")
+    tp.ensure_db_initialized()
+    lease_file = os.path.join(workdir, "dnsmasq.leases")
+    with open(lease_file, "w") as f:
+        for i in range(count):
+            f.write("%d 02:00:00:00:%02x:%02x 10.0.%d.%d host-%d *\n" % (
+                time.time() + 86400, i >> 8, i & 255, i >> 8, i & 255, i))
+    manager = DeviceBlockManager(tp.STORAGE, NftablesBackend(dry_run=True), lambda: None,
+                                 lease_file, os.path.join(workdir, "registry"))
+    devices = []
+    for i in range(count):
+        hostname = 'o"brien-%d' % i if i % 10 == 0 else None
+        devices.append(("02:00:00:00:%02x:%02x" % (i >> 8, i & 255), None, hostname))
+    # Keep the lease file for the script's hostname fallback
+    manager.leases.remove = lambda macs: 0
+    manager.block_many(devices, 3600)
+    tp.DEVICE_BLOCKS = manager
+    return manager
+
+
+def time_memory(manager, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        "[%s]" % ", ".join(block.json() for block in manager.blocked())
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_http(port, rounds):
+    samples = []
+    url = "http://127.0.0.1:%d/devices/blocked" % port
+    for _ in range(rounds):
+        start = time.perf_counter()
+        body = urllib.request.urlopen(url).read()
+        samples.append(time.perf_counter() - start)
+    return samples, json.loads(body)["count"]
+
+
+def time_script(workdir, rounds):
+    """Run a copy of the script pointed at the sandbox (engine URL disabled)"""
+    with open(SCRIPT, "r") as f:
+        text = f.read()
+    text = text.replace("/var/lib/dhcp-blocks", os.path.join(workdir, "registry"))
+    text = text.replace("/var/lib/misc/dnsmasq.leases", os.path.join(workdir, "dnsmasq.leases"))
+    text = text.replace("http://127.0.0.1:1889", "http://127.0.0.1:9")
+    script = os.path.join(workdir, "list_blocked_devices.sh")
+    with open(script, "w") as f:
+        f.write(text)
+
+    samples = []
+    output = ""
+    for _ in range(rounds):
+        start = time.perf_counter()
+        output = subprocess.run(["bash", script], stdout=subprocess.PIPE, text=True).stdout
+        samples.append(time.perf_counter() - start)
+    try:
+        json.loads(output)
+        valid = True
+    except ValueError:
+        valid = False
+    return samples, valid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--script-rounds", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    have_bash = shutil.which("bash") is not None
+    results = []
+    for count in args.devices:
+        workdir = tempfile.mkdtemp(prefix="seer-bench-")
+        server = None
+        try:
+            manager = setup(workdir, count)
+            server = tp.GracefulHTTPServer(("127.0.0.1", 0), tp.PolicyHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            tp.PolicyHandler.log_message = lambda *a: None
+
+            memory = time_memory(manager, args.rounds)
+            http, listed = time_http(server.server_address[1], args.rounds)
+            result = {
+                "devices": count,
+                "listed": listed,
+                "memory_p50_us": percentile(memory, 50) * 1e6,
+                "http_p50_us": percentile(http, 50) * 1e6,
+                "http_p99_us": percentile(http, 99) * 1e6,
+            }
+            if have_bash:
+                script, valid = time_script(workdir, args.script_rounds)
+                result["script_p50_ms"] = percentile(script, 50) * 1000
+                result["script_valid_json"] = valid
+            results.append(result)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            tp.STORAGE.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("%8s %14s %14s %14s %14s %12s" % (
+        "devices", "memory p50 us", "http p50 us", "http p99 us", "script p50 ms", "script json"))
+    for r in results:
+        print("%8d %14.1f %14.1f %14.1f %14s %12s" % (
+            r["devices"], r["memory_p50_us"], r["http_p50_us"], r["http_p99_us"],
+            "%.1f" % r["script_p50_ms"] if "script_p50_ms" in r else "-",
+            ("valid" if r["script_valid_json"] else "INVALID") if "script_valid_json" in r else "-"))
+
+
+if __name__ == "__main__":
+    main()
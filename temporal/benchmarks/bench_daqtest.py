@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline inline-enforcement throughput with dhcp/daqtest over a pcap
+
+Writes (or takes, with --pcap) a capture of devices resolving domains and
+opening TLS connections to them: a DNS query and answer, the TCP
+handshake, a ClientHello carrying the name as SNI and --data-packets
+server segments per visit, with --blocked-ratio of the visits going to
+blocked domains. Every packet is classified against the blocklist by
+its DNS question, or by the SNI for a ClientHello and the rest of its TCP
+flow, to report the share inline enforcement would drop (the handshake
+before the ClientHello names nothing and is not counted either way).
+
+Then runs daqtest -M read-file over the capture for every combination of
+--verdicts, --modes (decode, or perf for -p: auto-PASS, no decoding),
+--threads (-z) and --batch (-b), keeping the fastest of --repeat runs.
+Each run is timed from outside, less the start-up cost measured with -c 1,
+and daqtest's packet counters, message pool memory and packets per
+receive call are parsed from its output, next to the child's CPU time and
+peak RSS. daqtest renders the same default verdict (-V) on every packet,
+so the blocked share sizes the work, it is not checked against verdicts;
+with -z each thread reads the whole file. --save writes the results
+(tagged with --model) and --compare prints them next to another model's.
+
+daqtest is built for the router (aarch64): run this on the device, or
+--write-pcap here and copy the file over.
+
+Usage: python3 bench_daqtest.py [--threads 1 2 4] [--batch 1 16 64 256] [--model rk3328]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+from domain_trie import DomainTrie  # noqa: E402
+
+DAQTEST = os.path.join(HERE, "..", "..", "dhcp", "daqtest")
+RESOLVER = "192.168.1.1"
+
+# daqtest's stats lines, "  Packets Received:   1234", by our name
+STAT_NAMES = {
+    "Packets Received": "received",
+    "Packets Filtered": "filtered",
+    "Packets Passed": "passed",
+    "Packets Replaced": "replaced",
+    "Packets Blocked": "blocked",
+    "Packets Injected": "injected",
+    "Hardware Packets Received": "hw_received",
+    "Hardware Packets Dropped": "hw_dropped",
+    "Memory Usage": "pool_memory_bytes",
+    "Size": "pool_size",
+    "Maximum messages received in a burst": "max_burst",
+}
+# Printed once per packet thread; averaged rather than summed
+AVERAGED = {"Average number of packets received per receive call": "per_receive_call"}
+_STAT_RE = re.compile(r"^\s*([A-Za-z][A-Za-z ]*?):\s+([0-9]+(?:\.[0-9]+)?)\s*$")
+_TIMEOUTS_RE = re.compile(r"DAQ receive timed out (\d+) times")
+
+
+# ---- capture ----
+
+def checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def ipv4(src, dst, protocol, payload, ident):
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), ident & 0xFFFF, 0x4000, 64, protocol, 0,
+                         socket.inet_aton(src), socket.inet_aton(dst))
+    return header[:10] + struct.pack("!H", checksum(header)) + header[12:] + payload
+
+
+def udp(src, dst, sport, dport, payload, ident):
+    # A zero UDP checksum means "none" in IPv4
+    return ipv4(src, dst, 17, struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload, ident)
+
+
+def tcp(src, dst, sport, dport, seq, ack, flags, payload, ident):
+    header = struct.pack("!HHIIBBHHH", sport, dport, seq & 0xFFFFFFFF, ack & 0xFFFFFFFF, 5 << 4, flags, 64240, 0, 0)
+    pseudo = socket.inet_aton(src) + socket.inet_aton(dst) + struct.pack("!BBH", 0, 6, len(header) + len(payload))
+    header = header[:16] + struct.pack("!H", checksum(pseudo + header + payload)) + header[18:]
+    return ipv4(src, dst, 6, header + payload, ident)
+
+
+def ethernet(src_mac, dst_mac, packet):
+    return dst_mac + src_mac + b"\x08\x00" + packet
+
+
+def dns_question(name):
+    return b"".join(struct.pack("B", len(label)) + label.encode() for label in name.split(".")) + b"\0" + \
+        struct.pack("!HH", 1, 1)
+
+
+def dns_query(ident, name):
+    return struct.pack("!HHHHHH", ident, 0x0100, 1, 0, 0, 0) + dns_question(name)
+
+
+def dns_answer(ident, name, address):
+    return struct.pack("!HHHHHH", ident, 0x8180, 1, 1, 0, 0) + dns_question(name) + \
+        b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 300, 4) + socket.inet_aton(address)
+
+
+def client_hello(name, rng):
+    """TLS 1.2/1.3 ClientHello with SNI, padded to 512 bytes like common browsers"""
+    server_name = name.encode()
+    sni = struct.pack("!HBH", len(server_name) + 3, 0, len(server_name)) + server_name
+    extensions = struct.pack("!HH", 0, len(sni)) + sni + \
+        struct.pack("!HHB", 43, 5, 4) + b"\x03\x04\x03\x03" + \
+        struct.pack("!HHH", 10, 4, 2) + b"\x00\x1d"
+    ciphers = b"\x13\x01\x13\x02\x13\x03\xc0\x2b\xc0\x2f\xc0\x2c\xc0\x30"
+    body = b"\x03\x03" + bytes(rng.getrandbits(8) for _ in range(32)) + b"\x20" + \
+        bytes(rng.getrandbits(8) for _ in range(32)) + struct.pack("!H", len(ciphers)) + ciphers + b"\x01\x00"
+    padding = max(512 - 5 - 4 - len(body) - 2 - len(extensions) - 4, 0)
+    extensions += struct.pack("!HH", 21, padding) + b"\0" * padding
+    body += struct.pack("!H", len(extensions)) + extensions
+    handshake = b"\x01" + struct.pack("!I", len(body))[1:] + body
+    return b"\x16\x03\x01" + struct.pack("!H", len(handshake)) + handshake
+
+
+def write_pcap(path, blocked, allowed, visits, blocked_ratio, clients, data_packets, seed):
+    """Write the synthetic capture; returns the packet count"""
+    rng = random.Random(seed)
+    gateway_mac = b"\x02\x00\x00\x00\x00\x01"
+    packets = 0
+    stamp = 1700000000.0
+    with open(path, "wb") as f:
+        # Classic pcap, microsecond timestamps, Ethernet
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+
+        def emit(frame):
+            nonlocal packets, stamp
+            stamp += 0.0001
+            f.write(struct.pack("<IIII", int(stamp), int(stamp % 1 * 1e6), len(frame), len(frame)) + frame)
+            packets += 1
+
+        for visit in range(visits):
+            name = rng.choice(blocked if rng.random() < blocked_ratio else allowed)
+            device = visit % clients
+            client = "192.168.%d.%d" % (1 + device // 250, 2 + device % 250)
+            client_mac = struct.pack("!HI", 0x0200, 0x100000 + device)
+            server = "198.18.%d.%d" % (zlib.crc32(name.encode()) >> 8 & 255, zlib.crc32(name.encode()) & 255)
+            port = 32768 + visit % 28000
+            ident = visit & 0xFFFF
+            up = lambda packet: emit(ethernet(client_mac, gateway_mac, packet))  # noqa: E731
+            down = lambda packet: emit(ethernet(gateway_mac, client_mac, packet))  # noqa: E731
+
+            up(udp(client, RESOLVER, port, 53, dns_query(ident, name), ident))
+            down(udp(RESOLVER, client, 53, port, dns_answer(ident, name, server), ident))
+            seq, peer = rng.getrandbits(32), rng.getrandbits(32)
+            up(tcp(client, server, port, 443, seq, 0, 0x02, b"", ident))
+            down(tcp(server, client, 443, port, peer, seq + 1, 0x12, b"", ident))
+            up(tcp(client, server, port, 443, seq + 1, peer + 1, 0x10, b"", ident))
+            hello = client_hello(name, rng)
+            up(tcp(client, server, port, 443, seq + 1, peer + 1, 0x18, hello, ident))
+            for i in range(data_packets):
+                down(tcp(server, client, 443, port, peer + 1 + i * 1400, seq + 1 + len(hello), 0x10,
+                         b"\x17" * 1400, ident))
+    return packets
+
+
+def read_pcap(path):
+    """Yield the frames of a classic (not pcapng) Ethernet capture"""
+    with open(path, "rb") as f:
+        header = f.read(24)
+        magic = header[:4]
+        if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+            endian = "<"
+        elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+            endian = ">"
+        else:
+            raise ValueError("%s is not a pcap file (pcapng is not supported)" % path)
+        if struct.unpack(endian + "I", header[20:24])[0] != 1:
+            raise ValueError("%s is not an Ethernet capture" % path)
+        while True:
+            record = f.read(16)
+            if len(record) < 16:
+                return
+            length = struct.unpack(endian + "IIII", record)[2]
+            yield f.read(length)
+
+
+def dns_name(payload):
+    """Question name of a DNS message, or None"""
+    labels, offset = [], 12
+    while offset < len(payload):
+        length = payload[offset]
+        if length == 0:
+            return ".".join(labels).lower() if labels else None
+        if length & 0xC0:
+            return None
+        labels.append(payload[offset + 1:offset + 1 + length].decode("latin-1"))
+        offset += 1 + length
+    return None
+
+
+def sni_name(payload):
+    """Server name from a TLS ClientHello, or None"""
+    if len(payload) < 44 or payload[0] != 0x16 or payload[5] != 1:
+        return None
+    try:
+        offset = 43
+        offset += 1 + payload[offset]
+        offset += 2 + struct.unpack_from("!H", payload, offset)[0]
+        offset += 1 + payload[offset]
+        end = offset + 2 + struct.unpack_from("!H", payload, offset)[0]
+        offset += 2
+        while offset + 4 <= end:
+            kind, length = struct.unpack_from("!HH", payload, offset)
+            if kind == 0:
+                name_length = struct.unpack_from("!H", payload, offset + 7)[0]
+                return payload[offset + 9:offset + 9 + name_length].decode("latin-1").lower()
+            offset += 4 + length
+    except (IndexError, struct.error):
+        pass
+    return None
+
+
+def classify(path, trie):
+    """Packets and bytes to blocked and allowed names; other traffic is counted apart"""
+    result = {"packets": 0, "bytes": 0, "blocked_packets": 0, "blocked_bytes": 0,
+              "allowed_packets": 0, "allowed_bytes": 0, "dns_queries": 0, "tls_hellos": 0}
+    flows = {}
+    for frame in read_pcap(path):
+        result["packets"] += 1
+        result["bytes"] += len(frame)
+        if len(frame) < 34 or frame[12:14] != b"\x08\x00":
+            continue
+        header = (frame[14] & 0x0F) * 4
+        protocol, src, dst = frame[23], frame[26:30], frame[30:34]
+        segment = frame[14 + header:]
+        if protocol not in (6, 17) or len(segment) < 8:
+            continue
+        sport, dport = struct.unpack_from("!HH", segment)
+        flow = (protocol,) + tuple(sorted(((src, sport), (dst, dport))))
+        name = None
+        if protocol == 17 and 53 in (sport, dport):
+            name = dns_name(segment[8:])
+            if dport == 53:
+                result["dns_queries"] += 1
+        elif protocol == 6 and len(segment) >= 20:
+            payload = segment[(segment[12] >> 4) * 4:]
+            name = sni_name(payload)
+            if name is not None:
+                result["tls_hellos"] += 1
+        if name is not None:
+            flows[flow] = trie.match(name) is not None
+        if flow in flows:
+            kind = "blocked" if flows[flow] else "allowed"
+            result[kind + "_packets"] += 1
+            result[kind + "_bytes"] += len(frame)
+    return result
+
+
+# ---- daqtest ----
+
+def parse_output(lines):
+    """daqtest's end-of-run stats, summed over packet threads"""
+    stats, averaged = {}, {}
+    for line in lines:
+        found = _TIMEOUTS_RE.search(line)
+        if found:
+            stats["timeouts"] = stats.get("timeouts", 0) + int(found.group(1))
+            continue
+        found = _STAT_RE.match(line)
+        if not found:
+            continue
+        label, value = found.group(1), float(found.group(2))
+        if label in STAT_NAMES:
+            key = STAT_NAMES[label]
+            stats[key] = stats.get(key, 0) + int(value)
+        elif label in AVERAGED:
+            averaged.setdefault(AVERAGED[label], []).append(value)
+    for key, values in averaged.items():
+        stats[key] = sum(values) / len(values)
+    return stats
+
+
+def run_daqtest(args, pcap, verdict, perf, threads, batch, count=0):
+    """One daqtest run; returns parsed stats plus wall time, CPU time and peak RSS"""
+    command = [args.daqtest, "-d", args.module, "-i", pcap, "-M", "read-file",
+               "-V", verdict, "-z", str(threads), "-b", str(batch)]
+    for directory in args.module_dir:
+        command += ["-m", directory]
+    if perf:
+        command.append("-p")
+    if count:
+        command += ["-c", str(count)]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True, errors="replace")
+    # Without -p daqtest prints every packet: keep only what could be a stats line
+    lines, printed = [], 0
+    for line in process.stdout:
+        printed += 1
+        if ":" in line or "timed out" in line:
+            lines.append(line)
+            if len(lines) > 10000:
+                del lines[:5000]
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    stats = parse_output(lines)
+    if process.returncode != 0 or "received" not in stats:
+        raise RuntimeError("%s exited %d: %s" % (" ".join(command), process.returncode,
+                                                 "".join(lines[-5:]).strip() or "no stats printed"))
+    stats.update({
+        "elapsed_s": elapsed,
+        "cpu_s": usage.ru_utime + usage.ru_stime,
+        "max_rss_kb": usage.ru_maxrss,
+        "output_lines": printed,
+    })
+    return stats
+
+
+def sweep(args, pcap, capture):
+    results = []
+    frame_bytes = capture["bytes"] / float(capture["packets"] or 1)
+    for verdict in args.verdicts:
+        for mode in args.modes:
+            for threads in args.threads:
+                overhead = min(run_daqtest(args, pcap, verdict, mode == "perf", threads, 1, count=1)["elapsed_s"]
+                               for _ in range(args.repeat))
+                for batch in args.batch:
+                    runs = [run_daqtest(args, pcap, verdict, mode == "perf", threads, batch)
+                            for _ in range(args.repeat)]
+                    best = min(runs, key=lambda run: run["elapsed_s"])
+                    seconds = max(best["elapsed_s"] - overhead, 1e-6)
+                    best.update({
+                        "verdict": verdict,
+                        "mode": mode,
+                        "threads": threads,
+                        "batch": batch,
+                        "startup_s": overhead,
+                        "packets_per_s": best["received"] / seconds,
+                        "mbit_per_s": best["received"] * frame_bytes * 8 / seconds / 1e6,
+                        "cpu_us_per_packet": best["cpu_s"] / float(best["received"] or 1) * 1e6,
+                    })
+                    results.append(best)
+                    if not args.json:
+                        print("[DAQ] %s/%s -z %d -b %d: %.0f packets/s" % (
+                            verdict, mode, threads, batch, best["packets_per_s"]), file=sys.stderr)
+    return results
+
+
+def config_key(result):
+    return "%s/%s/z%d/b%d" % (result["verdict"], result["mode"], result["threads"], result["batch"])
+
+
+def report(results):
+    base = results[0]["packets_per_s"] if results else 0
+    print("%-8s %-6s %3s %5s %10s %8s %10s %8s %8s %8s %9s %8s" % (
+        "verdict", "mode", "-z", "-b", "packets", "seconds", "packets/s", "Mbit/s", "us/pkt", "per-call",
+        "pool KB", "RSS MB"))
+    for result in results:
+        print("%-8s %-6s %3d %5d %10d %8.3f %10.0f %8.1f %8.2f %8.2f %9.0f %8.1f  x%.2f" % (
+            result["verdict"], result["mode"], result["threads"], result["batch"], result["received"],
+            result["elapsed_s"] - result["startup_s"], result["packets_per_s"], result["mbit_per_s"],
+            result["cpu_us_per_packet"], result.get("per_receive_call", 0.0),
+            result.get("pool_memory_bytes", 0) / 1e3, result["max_rss_kb"] / 1e3,
+            result["packets_per_s"] / base if base else 0.0))
+
+
+def compare(current, other):
+    """Print packets/s per configuration next to another model's saved run"""
+    theirs = dict((config_key(result), result) for result in other["results"])
+    print("\n%-22s %14s %14s %8s" % ("configuration", other["meta"]["model"], current["meta"]["model"], "ratio"))
+    for result in current["results"]:
+        key = config_key(result)
+        if key in theirs:
+            old = theirs[key]["packets_per_s"]
+            print("%-22s %14.0f %14.0f %7.2fx" % (key, old, result["packets_per_s"],
+                                                 result["packets_per_s"] / old if old else 0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--daqtest", default=shutil.which("daqtest") or DAQTEST)
+    parser.add_argument("--module", default="pcap", help="DAQ module reading the file (-d)")
+    parser.add_argument("--module-dir", action="append", default=[], help="DAQ module directory (-m)")
+    parser.add_argument("--pcap", help="replay this capture instead of a synthetic one")
+    parser.add_argument("--write-pcap", metavar="FILE", help="only write the synthetic capture")
+    parser.add_argument("--blocked-file", help="blocked domains, one per line (default: synthetic)")
+    parser.add_argument("--allowed-file", help="allowed domains, one per line (default: synthetic)")
+    parser.add_argument("--domains", type=int, default=5000, help="synthetic blocked and allowed domains, each")
+    parser.add_argument("--visits", type=int, default=10000, help="DNS lookup + TLS connection pairs")
+    parser.add_argument("--blocked-ratio", type=float, default=0.3)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--data-packets", type=int, default=2, help="1400-byte server segments per visit")
+    parser.add_argument("--verdicts", nargs="+", default=["pass", "block"],
+                        choices=("pass", "block", "blacklist", "whitelist"))
+    parser.add_argument("--modes", nargs="+", default=["decode", "perf"], choices=("decode", "perf"))
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 16, 64, 256])
+    parser.add_argument("--repeat", type=int, default=3, help="runs per configuration, fastest kept")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--model", default=platform.node(), help="router model, recorded with --save")
+    parser.add_argument("--save", metavar="FILE", help="write results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare against another model's --save")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    def domains(path, fallback):
+        if not path:
+            return fallback
+        with open(path, "r") as f:
+            return [line.strip().lower() for line in f if line.strip() and not line.startswith("#")]
+
+    blocked = domains(args.blocked_file, ["blocked%d.example.com" % i for i in range(args.domains)])
+    allowed = domains(args.allowed_file, ["www.site%d.example.org" % i for i in range(args.domains)])
+    trie = DomainTrie((name, name) for name in blocked)
+
+    scratch = tempfile.mkdtemp(prefix="seer-daqtest-")
+    try:
+        pcap = args.pcap or args.write_pcap or os.path.join(scratch, "visits.pcap")
+        if not args.pcap:
+            start = time.perf_counter()
+            packets = write_pcap(pcap, blocked, allowed, args.visits, args.blocked_ratio, args.clients,
+                                 args.data_packets, args.seed)
+            if not args.json:
+                print("[DAQ] wrote %d packets to %s in %.1fs" % (packets, pcap, time.perf_counter() - start),
+                      file=sys.stderr)
+        capture = classify(pcap, trie)
+        capture["file"] = pcap
+        if args.write_pcap:
+            print(json.dumps(capture, indent=2) if args.json else
+                  "%d packets, %d to blocked names (%.1f%%), %d DNS queries, %d ClientHellos" % (
+                      capture["packets"], capture["blocked_packets"],
+                      100.0 * capture["blocked_packets"] / (capture["packets"] or 1),
+                      capture["dns_queries"], capture["tls_hellos"]))
+            return
+        if not os.access(args.daqtest, os.X_OK):
+            parser.error("daqtest not found or not executable: %s" % args.daqtest)
+        results = {
+            "meta": {
+                "model": args.model,
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "daqtest": args.daqtest,
+                "args": vars(args),
+            },
+            "capture": capture,
+            "results": sweep(args, pcap, capture),
+        }
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%s: %d packets (%.0f bytes avg), %.1f%% to blocked names" % (
+            args.model, capture["packets"], capture["bytes"] / float(capture["packets"] or 1),
+            100.0 * capture["blocked_packets"] / (capture["packets"] or 1)))
+        report(results["results"])
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
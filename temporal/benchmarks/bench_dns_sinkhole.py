@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load test for the DNS sinkhole against a local stand-in upstream
+
+Starts a stand-in upstream (answers every A query with 192.0.2.1, TTL
+300, after --upstream-delay ms) and dns_sinkhole.py pinned to one core
+with a blocklist of --blocked domains, then fires UDP queries from
+--clients processes keeping --window queries in flight each. The mix is
+--blocked-ratio names under blocked domains, --unique-ratio never-seen
+names (cache misses) and the rest drawn from --pool names (cache hits once
+warm). Reports queries per second and p50/p99 latency, overall and per kind.
+
+Usage: python3 bench_dns_sinkhole.py [--duration 10] [--clients 1] [--window 32]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+from dns_sinkhole import parse_question  # noqa: E402
+
+ANSWER = socket.inet_aton("192.0.2.1")
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def build_query(ident, name, qtype=1):
+    question = b"".join(struct.pack("B", len(label)) + label.encode() for label in name.split(".")) + b"\0"
+    return struct.pack("!HHHHHH", ident, 0x0100, 1, 0, 0, 0) + question + struct.pack("!HH", qtype, 1)
+
+
+def blocked_names(count):
+    return ["blocked%d.example.com" % i for i in range(count)]
+
+
+def pool_names(count):
+    return ["www.site%d.example.org" % i for i in range(count)]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# ---- stand-in upstream ----
+
+class Upstream(asyncio.DatagramProtocol):
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.delay:
+            asyncio.get_running_loop().call_later(self.delay, self.reply, data, addr)
+        else:
+            self.reply(data, addr)
+
+    def reply(self, data, addr):
+        _, qtype, _, end = parse_question(data)
+        answers = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 300, 4) + ANSWER if qtype == 1 else b""
+        header = struct.pack("!HHHHHH", struct.unpack_from("!H", data)[0], 0x8180, 1, 1 if answers else 0, 0, 0)
+        self.transport.sendto(header + data[12:end] + answers, addr)
+
+
+def serve_upstream(port, delay):
+    async def serve():
+        await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: Upstream(delay), local_addr=("127.0.0.1", port))
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+# ---- load generator ----
+
+def run_client(port, duration, window, mix, seed):
+    """Keep window queries in flight for duration seconds; returns {kind: [latency]}"""
+    rng = random.Random(seed)
+    blocked, pool = blocked_names(mix["blocked"]), pool_names(mix["pool"])
+    blocked_ratio, unique_ratio = mix["blocked_ratio"], mix["unique_ratio"]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(("127.0.0.1", port))
+    sock.settimeout(1.0)
+    latencies = {"blocked": [], "cached": [], "miss": []}
+    outstanding = {}
+    counter = [0]
+
+    def send():
+        counter[0] += 1
+        roll = rng.random()
+        if roll < blocked_ratio:
+            kind, name = "blocked", "host%d.%s" % (counter[0] % 7, rng.choice(blocked))
+        elif roll < blocked_ratio + unique_ratio:
+            kind, name = "miss", "u%d-%d.example.net" % (seed, counter[0])
+        else:
+            kind, name = "cached", rng.choice(pool)
+        ident = counter[0] & 0xFFFF
+        outstanding[ident] = (time.perf_counter(), kind)
+        sock.send(build_query(ident, name))
+
+    lost = 0
+    deadline = time.perf_counter() + duration
+    for _ in range(window):
+        send()
+    while time.perf_counter() < deadline:
+        try:
+            data = sock.recv(4096)
+        except socket.timeout:
+            lost += len(outstanding)
+            outstanding.clear()
+            for _ in range(window):
+                send()
+            continue
+        sent = outstanding.pop(struct.unpack_from("!H", data)[0], None)
+        if sent is None:
+            continue
+        latencies[sent[1]].append(time.perf_counter() - sent[0])
+        send()
+    latencies["lost"] = lost
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=1, help="load generator processes")
+    parser.add_argument("--window", type=int, default=32, help="queries in flight per client")
+    parser.add_argument("--blocked", type=int, default=50000, help="domains in the blocklist")
+    parser.add_argument("--pool", type=int, default=2000, help="distinct allowed names")
+    parser.add_argument("--blocked-ratio", type=float, default=0.2)
+    parser.add_argument("--unique-ratio", type=float, default=0.05)
+    parser.add_argument("--upstream-delay", type=float, default=1.0, help="ms the upstream takes to answer")
+    parser.add_argument("--cpu", type=int, default=0, help="core to pin the sinkhole to")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--serve-upstream", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--client", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_upstream:
+        serve_upstream(args.serve_upstream, args.upstream_delay / 1000.0)
+        return
+    if args.client:
+        spec = json.loads(args.client)
+        print(json.dumps(run_client(spec["port"], spec["duration"], spec["window"], spec["mix"], spec["seed"])))
+        return
+
+    blocked, pool = blocked_names(args.blocked), pool_names(args.pool)
+    upstream_port, port = free_port(), free_port()
+    processes = []
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as blocklist:
+        blocklist.write("\n".join(blocked) + "\n")
+        blocklist.flush()
+        try:
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--serve-upstream", str(upstream_port),
+                 "--upstream-delay", str(args.upstream_delay)]))
+            cpus = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set()
+            pin = (lambda: os.sched_setaffinity(0, {args.cpu})) if args.cpu in cpus else None
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(HERE, "..", "dns_sinkhole.py"), "--address", "127.0.0.1",
+                 "--port", str(port), "--upstream", "127.0.0.1:%d" % upstream_port,
+                 "--blocklist", blocklist.name], preexec_fn=pin, stdout=subprocess.DEVNULL))
+
+            # Ready once a query is answered
+            probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            probe.settimeout(0.1)
+            for _ in range(100):
+                try:
+                    probe.sendto(build_query(1, pool[0]), ("127.0.0.1", port))
+                    probe.recv(512)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            probe.close()
+
+            mix = {"blocked": args.blocked, "pool": args.pool,
+                   "blocked_ratio": args.blocked_ratio, "unique_ratio": args.unique_ratio}
+            clients = [subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--client", json.dumps({
+                    "port": port, "duration": args.duration, "window": args.window, "mix": mix,
+                    "seed": seed})], stdout=subprocess.PIPE) for seed in range(args.clients)]
+            outputs = [json.loads(client.communicate()[0]) for client in clients]
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    lost = sum(output.pop("lost") for output in outputs)
+    kinds = {}
+    for output in outputs:
+        for kind, values in output.items():
+            kinds.setdefault(kind, []).extend(values)
+    everything = [value for values in kinds.values() for value in values]
+    result = {
+        "duration_s": args.duration,
+        "clients": args.clients,
+        "window": args.window,
+        "blocked_domains": args.blocked,
+        "queries": len(everything),
+        "lost": lost,
+        "qps": len(everything) / args.duration,
+        "p50_ms": percentile(everything, 0.5) * 1e3,
+        "p99_ms": percentile(everything, 0.99) * 1e3,
+        "kinds": dict((kind, {
+            "queries": len(values),
+            "p50_ms": percentile(values, 0.5) * 1e3 if values else None,
+            "p99_ms": percentile(values, 0.99) * 1e3 if values else None,
+        }) for kind, values in sorted(kinds.items())),
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print("%d queries in %.0fs: %.0f q/s, p50 %.2f ms, p99 %.2f ms, %d lost" % (
+        result["queries"], args.duration, result["qps"], result["p50_ms"], result["p99_ms"], lost))
+    for kind, stats in result["kinds"].items():
+        if stats["queries"]:
+            print("  %-8s %8d  p50 %6.2f ms  p99 %6.2f ms" % (kind, stats["queries"], stats["p50_ms"],
+                                                             stats["p99_ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lookup throughput and memory of DomainTrie over a large synthetic blocklist
+
+Builds a trie of N domains (default 1M, shaped like community blocklists:
+registrable domains plus some subdomains), then times match() over a mix
+of exact hits, subdomain hits and misses. A plain set with a per-label
+suffix walk is measured alongside as the baseline. Memory counts only what
+each structure allocates; the domain strings themselves are shared with
+the caller and excluded from both.
+
+Usage: python3 bench_domain_trie.py [--domains 1000000] [--queries 300000]
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from domain_trie import DomainTrie  # noqa: E402
+
+TLDS = ["com", "net", "org", "io", "co", "info", "ph", "de", "ru", "xyz"]
+SUBDOMAINS = ["www", "m", "api", "cdn", "ads", "track", "static", "img"]
+
+
+def random_label(rng):
+    return "".join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(rng.randint(4, 14)))
+
+
+def generate(count, rng):
+    domains = set()
+    while len(domains) < count:
+        base = "%s.%s" % (random_label(rng), rng.choice(TLDS))
+        domains.add(base)
+        if rng.random() < 0.25 and len(domains) < count:
+            domains.add("%s.%s" % (rng.choice(SUBDOMAINS), base))
+    return list(domains)
+
+
+def set_match(blocked, name):
+    """Baseline: check every suffix of name against a set"""
+    labels = name.split(".")
+    for i in range(len(labels)):
+        suffix = ".".join(labels[i:])
+        if suffix in blocked:
+            return suffix
+    return None
+
+
+def measure_build(build):
+    """Time one build untraced, then size a second build under tracemalloc"""
+    gc.collect()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    traced = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del traced
+    return result, elapsed, size
+
+
+def measure_lookups(func, queries):
+    start = time.perf_counter()
+    hits = 0
+    for name in queries:
+        if func(name) is not None:
+            hits += 1
+    elapsed = time.perf_counter() - start
+    return len(queries) / elapsed, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--domains", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=300000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    domains = generate(args.domains, rng)
+    queries = []
+    for _ in range(args.queries):
+        kind = rng.random()
+        if kind < 1 / 3.0:
+            queries.append(rng.choice(domains))
+        elif kind < 2 / 3.0:
+            queries.append("%s.%s" % (rng.choice(SUBDOMAINS), rng.choice(domains)))
+        else:
+            queries.append("%s.%s" % (random_label(rng), rng.choice(TLDS)))
+
+    trie, trie_build, trie_bytes = measure_build(lambda: DomainTrie((d, d) for d in domains))
+    blocked, set_build, set_bytes = measure_build(lambda: set(domains))
+    trie_qps, trie_hits = measure_lookups(trie.match, queries)
+    set_qps, set_hits = measure_lookups(lambda name: set_match(blocked, name), queries)
+    minimal = sum(1 for _ in trie.minimal())
+
+    results = {
+        "domains": len(domains),
+        "queries": len(queries),
+        "collapsed_entries": minimal,
+        "trie": {"build_s": trie_build, "bytes": trie_bytes, "bytes_per_domain": trie_bytes / len(domains),
+                 "lookups_per_s": trie_qps, "hits": trie_hits},
+        "set_suffix_walk": {"build_s": set_build, "bytes": set_bytes, "bytes_per_domain": set_bytes / len(domains),
+                            "lookups_per_s": set_qps, "hits": set_hits},
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("%d domains, %d queries; %d entries after collapsing covered subdomains" % (
+        len(domains), len(queries), minimal))
+    print("%-16s %10s %12s %12s %14s" % ("structure", "build s", "MiB", "B/domain", "lookups/s"))
+    for name in ("trie", "set_suffix_walk"):
+        r = results[name]
+        print("%-16s %10.2f %12.1f %12.1f %14.0f" % (
+            name, r["build_s"], r["bytes"] / 1048576.0, r["bytes_per_domain"], r["lookups_per_s"]))
+    if trie_hits != set_hits:
+        print("WARNING: hit counts differ (%d vs %d)" % (trie_hits, set_hits))
+
+
+if __name__ == "__main__":
+    main()
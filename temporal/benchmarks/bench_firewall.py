@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cost of blocking N devices: per-device iptables calls vs one set batch
+
+Counts what dhcp/remove_device_complete.sh would run per device (iptables
+-C/-I for MAC and IP on INPUT and FORWARD) against the firewall backend,
+which renders a single nft -f / ipset restore batch. The backend runs in
+dry-run mode, so no root or kernel access is needed; the batch is only
+rendered and measured.
+
+Usage: python3 bench_firewall.py [--devices 10 100 1000] [--backend nft]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from firewall import BACKENDS, CHAINS  # noqa: E402
+
+# Per device: -C then -I for the MAC rule and the IP rule, on each chain
+LEGACY_CALLS_PER_DEVICE = 2 * 2 * len(CHAINS)
+LEGACY_RULES_PER_DEVICE = 2 * len(CHAINS)
+
+
+def make_devices(count):
+    return dict(("02:00:00:%02x:%02x:%02x" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                 "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255)) for i in range(count))
+
+
+def measure(backend_name, count):
+    devices = make_devices(count)
+    backend = BACKENDS[backend_name](dry_run=True)
+    backend.sync({})
+    base = backend.stats["transactions"]
+
+    start = time.perf_counter()
+    backend.apply(add=devices)
+    block_s = time.perf_counter() - start
+    block_bytes = len(backend.last_script)
+    block_tx = backend.stats["transactions"] - base
+
+    start = time.perf_counter()
+    backend.apply(remove=list(devices))
+    unblock_s = time.perf_counter() - start
+    unblock_tx = backend.stats["transactions"] - base - block_tx
+
+    return {
+        "devices": count,
+        "legacy_iptables_calls": count * LEGACY_CALLS_PER_DEVICE,
+        "legacy_chain_rules": count * LEGACY_RULES_PER_DEVICE,
+        "set_transactions_block": block_tx,
+        "set_transactions_unblock": unblock_tx,
+        "set_rules_per_chain": 3 if backend_name == "nft" else 2,
+        "batch_bytes": block_bytes,
+        "render_block_ms": block_s * 1000,
+        "render_unblock_ms": unblock_s * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="nft")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = [measure(args.backend, count) for count in args.devices]
+    if args.json:
+        print(json.dumps({"backend": args.backend, "results": results}, indent=2))
+        return
+
+    print("backend: %s (dry run)" % args.backend)
+    print("%8s %14s %13s %10s %12s %12s %12s" % (
+        "devices", "iptables calls", "legacy rules", "set tx", "set rules", "batch KiB", "render ms"))
+    for r in results:
+        print("%8d %14d %13d %10d %12d %12.1f %12.2f" % (
+            r["devices"], r["legacy_iptables_calls"], r["legacy_chain_rules"],
+            r["set_transactions_block"], r["set_rules_per_chain"], r["batch_bytes"] / 1024.0,
+            r["render_block_ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Size and update cost of per-group DNS policies
+
+Runs the engine in-process under a scratch --root (dnsmasq and the group
+resolvers replaced by `true`), defines G groups, spreads D devices over
+them and bulk-imports N domains per group, overlapping between groups.
+Reports the bytes of dnsmasq config written, next to what one copy of the
+group's blocklist per device would take, and the time and files touched
+when one device changes group and when one group gains a domain.
+
+Usage: python3 bench_groups.py [--groups 5] [--devices 300] [--domains 10000]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import temporal_policy as engine  # noqa: E402
+
+
+def mac(i):
+    return "02:00:00:%02x:%02x:%02x" % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def timed(func, *args):
+    """Run func on the writer path and return (seconds, result, files rewritten)"""
+    touched = []
+    reload_changed = engine.reload_changed
+
+    def record(changed):
+        touched.extend(changed)
+        return reload_changed(changed)
+
+    engine.reload_changed = record
+    try:
+        start = time.perf_counter()
+        result = func(*args)
+        engine.RELOAD_SCHEDULER.flush()
+        elapsed = time.perf_counter() - start
+    finally:
+        engine.reload_changed = reload_changed
+    return elapsed, result, sorted(set(touched))
+
+
+def run(groups, devices, domains):
+    root = tempfile.mkdtemp(prefix="seer-groups-")
+    try:
+        engine.apply_root(root)
+        engine.DNSMASQ_RESTART_COMMAND = ["true"]
+        engine.GROUP_RESOLVER_COMMAND = ["true"]
+        engine.ensure_db_initialized()
+        engine.load_and_apply_blocked_websites()
+
+        names = ["group%d" % g for g in range(groups)]
+        for g, name in enumerate(names):
+            engine.define_group(name, "10.53.0.%d" % (g + 1))
+        members = {}
+        for i in range(devices):
+            members.setdefault(names[i % groups], []).append((mac(i), "192.168.1.%d" % (i % 250 + 2)))
+
+        start = time.perf_counter()
+        for name, devs in members.items():
+            engine.assign_devices(name, devs)
+        assign_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for g, name in enumerate(names):
+            # Half of each group's list is shared with the next group
+            entries = [engine.parse_bulk_entry({"domain": "site%d.example.com" % (g * domains // 2 + i),
+                                                "source": name}) for i in range(domains)]
+            success, message = engine.apply_bulk_changes(entries)
+            assert success, message
+        import_s = time.perf_counter() - start
+
+        resolver_bytes = dict((name, file_size(engine.DEVICE_GROUPS.resolver_file(name))) for name in names)
+        grouped_bytes = sum(resolver_bytes.values()) + file_size(engine.DEVICE_GROUPS.hosts_file) + \
+            file_size(engine.DEVICE_GROUPS.opts_file) + file_size(engine.GROUPS_CONF)
+        per_device_bytes = sum(resolver_bytes[name] * len(devs) for name, devs in members.items())
+
+        device = members[names[0]][0]
+        move_s, _, move_files = timed(engine.assign_devices, names[-1], [device])
+        domain_s, _, domain_files = timed(engine.block_website, "new-site.example.org", None, names[0])
+
+        return {
+            "groups": groups,
+            "devices": devices,
+            "domains_per_group": domains,
+            "assign_s": assign_s,
+            "import_s": import_s,
+            "grouped_config_bytes": grouped_bytes,
+            "per_device_config_bytes": per_device_bytes,
+            "move_device_s": move_s,
+            "move_device_files": move_files,
+            "add_group_domain_s": domain_s,
+            "add_group_domain_files": domain_files,
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--groups", type=int, default=5)
+    parser.add_argument("--devices", type=int, default=300)
+    parser.add_argument("--domains", type=int, default=10000, help="domains per group")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    result = run(args.groups, args.devices, args.domains)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print("%d groups, %d devices, %d domains per group" % (args.groups, args.devices, args.domains))
+    print("  assign devices     %8.3f s" % result["assign_s"])
+    print("  bulk import        %8.3f s" % result["import_s"])
+    print("  config, grouped    %8.1f MB" % (result["grouped_config_bytes"] / 1e6))
+    print("  config, per device %8.1f MB" % (result["per_device_config_bytes"] / 1e6))
+    print("  move one device    %8.1f ms  rewrote %s" % (result["move_device_s"] * 1e3,
+                                                          ", ".join(result["move_device_files"])))
+    print("  add group domain   %8.1f ms  rewrote %s" % (result["add_group_domain_s"] * 1e3,
+                                                          ", ".join(result["add_group_domain_files"])))
+
+
+if __name__ == "__main__":
+    main()
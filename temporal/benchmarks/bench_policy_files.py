@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load cost of a bloated policy file, before and after compaction
+
+Writes a net_policies.json-style file ({"temporal_policies": [...]},
+indent 4) of --entries entries of which only --live are distinct valid
+policies; the rest repeat them or are the empty "Block " entries the UI
+used to append. Compares json.load with policy_files.py's streaming,
+deduplicating load (time and peak memory), compacts the file and loads it
+again, then times journaled single-policy changes, the compaction they
+trigger, and a reload picked up by the watcher after an outside rewrite.
+
+Usage: python3 bench_policy_files.py [--entries 200000] [--live 1000] [--changes 5000]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import policy_files  # noqa: E402
+from Policy import Policy  # noqa: E402
+
+EMPTY = {"name": "Block ", "destination": "", "domains": [], "enabled": True, "schedule": {}}
+
+
+def live_entry(i):
+    return {"name": "Block site%d.example.com" % i, "destination": "site%d.example.com" % i, "domains": [],
+            "enabled": True, "schedule": {"start": "%02d:00" % (i % 24), "end": "23:59"}}
+
+
+def write_bloated(path, entries, live, seed):
+    rng = random.Random(seed)
+    items = [live_entry(i) for i in range(live)]
+    items += [live_entry(rng.randrange(live)) if rng.random() < 0.5 else EMPTY for _ in range(entries - live)]
+    rng.shuffle(items)
+    with open(path, "w") as f:
+        json.dump({"temporal_policies": items}, f, indent=4)
+
+
+def measure(func):
+    """(seconds, peak traced bytes, result); timed without tracing, traced in a second call"""
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def run(entries, live, changes, seed):
+    directory = tempfile.mkdtemp(prefix="seer-policy-files-")
+    try:
+        path = os.path.join(directory, "net_policies.json")
+        write_bloated(path, entries, live, seed)
+        bloated_bytes = os.path.getsize(path)
+
+        def json_load():
+            with open(path, "r") as f:
+                return json.load(f)
+
+        json_s, json_peak, _ = measure(json_load)
+        store = policy_files.PolicyFile(path)
+        stream_s, stream_peak, policies = measure(lambda: store.load(compact=False))
+        assert len(policies) == live, len(policies)
+
+        start = time.perf_counter()
+        store.compact()
+        compact_s = time.perf_counter() - start
+        compact_bytes = os.path.getsize(path)
+        compacted_s, compacted_peak, _ = measure(lambda: policy_files.PolicyFile(path).load(compact=False))
+
+        # One journal record per change; deletes and re-adds keep the live count steady
+        start = time.perf_counter()
+        for i in range(changes // 2):
+            domain = "site%d.example.com" % (i % live)
+            store.append((), [(domain, None)])
+            store.append([Policy(domain, {"start": "%02d:00" % (i % 24), "end": "23:59"})], ())
+        append_s = time.perf_counter() - start
+        journal_compactions = store.stats["compactions"] - 1
+
+        watcher = policy_files.PolicyFileWatcher(store, lambda upserts, deleted: None)
+        time.sleep(0.01)
+        with open(path, "w") as f:
+            json.dump({"temporal_policies": [live_entry(i) for i in range(live + 1)]}, f)
+        start = time.perf_counter()
+        watcher.check()
+        reload_s = time.perf_counter() - start
+
+        return {
+            "entries": entries,
+            "live": live,
+            "bloated_bytes": bloated_bytes,
+            "json_load_s": json_s,
+            "json_load_peak_bytes": json_peak,
+            "stream_load_s": stream_s,
+            "stream_load_peak_bytes": stream_peak,
+            "compact_s": compact_s,
+            "compacted_bytes": compact_bytes,
+            "compacted_load_s": compacted_s,
+            "compacted_load_peak_bytes": compacted_peak,
+            "changes": changes,
+            "append_per_s": changes / append_s,
+            "journal_compactions": journal_compactions,
+            "reload_s": reload_s,
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=200000, help="entries in the bloated file")
+    parser.add_argument("--live", type=int, default=1000, help="distinct valid policies among them")
+    parser.add_argument("--changes", type=int, default=5000, help="journaled single-policy changes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    result = run(args.entries, args.live, args.changes, args.seed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print("%d entries, %d live policies" % (args.entries, args.live))
+    print("  bloated file       %8.1f MB" % (result["bloated_bytes"] / 1e6))
+    print("  json.load          %8.3f s  peak %7.1f MB" % (result["json_load_s"], result["json_load_peak_bytes"] / 1e6))
+    print("  streaming load     %8.3f s  peak %7.1f MB" % (result["stream_load_s"],
+                                                          result["stream_load_peak_bytes"] / 1e6))
+    print("  compaction         %8.3f s  -> %.1f KB" % (result["compact_s"], result["compacted_bytes"] / 1e3))
+    print("  compacted load     %8.3f s  peak %7.1f MB" % (result["compacted_load_s"],
+                                                          result["compacted_load_peak_bytes"] / 1e6))
+    print("  journaled changes  %8.0f /s  (%d compactions over %d changes)" % (
+        result["append_per_s"], result["journal_compactions"], args.changes))
+    print("  watcher reload     %8.1f ms" % (result["reload_s"] * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory and speed of N policies: plain dicts vs Policy objects
+
+Builds the engine's policy state from the same decoded NDJSON import
+(mostly all-day, some on weekday/evening windows) two ways: the dicts
+POLICIES used to hold, each with its own schedule dict, next to a
+Blocklist-style dict of normalized names; and Policy objects, whose
+interned destinations the blocklist shares and whose schedules are one
+shared Schedule per distinct window. Reports bytes per policy (tracemalloc),
+JSON encoding time for GET /, and the time to check every policy's window.
+
+Usage: python3 bench_policy_memory.py [--policies 10000 100000]
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Policy import Policy, compile_schedule, encode_policies, minute_of_week  # noqa: E402
+
+SCHEDULES = (
+    None,
+    {"start": "08:00", "end": "17:00", "days": ["mon", "tue", "wed", "thu", "fri"]},
+    {"start": "21:00", "end": "06:00"},
+)
+DEFAULT_SCHEDULE = {"start": "00:00", "end": "23:59"}
+
+
+def import_lines(count):
+    lines = []
+    for i in range(count):
+        entry = {"action": "block", "domain": "site%d.example%d.com" % (i, i % 97)}
+        schedule = SCHEDULES[max(0, i % 10 - 7)]
+        if schedule:
+            entry["schedule"] = schedule
+        lines.append(json.dumps(entry))
+    return lines
+
+
+def build_dicts(lines):
+    policies, blocklist = [], {}
+    for line in lines:
+        item = json.loads(line)
+        domain = item["domain"].strip().lower()
+        policies.append({"destination": domain, "enabled": True,
+                         "schedule": item.get("schedule") or dict(DEFAULT_SCHEDULE)})
+        blocklist[domain.strip().lower()] = None
+    return policies, blocklist
+
+
+def build_policies(lines):
+    policies, blocklist = [], {}
+    for line in lines:
+        item = json.loads(line)
+        policy = Policy(item["domain"].strip().lower(), item.get("schedule"))
+        policies.append(policy)
+        blocklist[sys.intern(policy.destination.strip().lower())] = None
+    return policies, blocklist
+
+
+def measure(build, lines):
+    """Build once timed, then again under tracemalloc (which slows it down) for the size"""
+    start = time.perf_counter()
+    build(lines)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    state = build(lines)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return state, size, elapsed
+
+
+def timed(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--policies", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    minute = minute_of_week(time.time())
+    results = []
+    for count in args.policies:
+        lines = import_lines(count)
+        (dicts, _), dict_bytes, dict_build = measure(build_dicts, lines)
+        (objects, _), object_bytes, object_build = measure(build_policies, lines)
+        assert json.loads(json.dumps(dicts)) == json.loads(encode_policies(objects))
+        results.append({
+            "policies": count,
+            "dict_bytes_per_policy": dict_bytes / float(count),
+            "policy_bytes_per_policy": object_bytes / float(count),
+            "dict_build_s": dict_build,
+            "policy_build_s": object_build,
+            "dict_encode_s": timed(lambda: json.dumps(dicts)),
+            "policy_encode_s": timed(lambda: encode_policies(objects)),
+            # The dict form has to go through the schedule cache (or re-parse) on every check
+            "dict_check_s": timed(lambda: [compile_schedule(p["schedule"]).active(minute) for p in dicts]),
+            "policy_check_s": timed(lambda: [p.schedule.active(minute) for p in objects]),
+        })
+        del dicts, objects
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("%9s %-7s %10s %9s %9s %9s" % ("policies", "form", "bytes/pol", "build", "encode", "check"))
+    for r in results:
+        for form in ("dict", "policy"):
+            print("%9d %-7s %10.0f %9.3f %9.3f %9.3f" % (
+                r["policies"], form, r["%s_bytes_per_policy" % form], r["%s_build_s" % form],
+                r["%s_encode_s" % form], r["%s_check_s" % form]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput and accuracy of the dnsmasq query log analytics
+
+Writes a synthetic log-queries file of --lines lines (a query, forwarded
+and reply line per lookup, like dnsmasq) where --clients devices look up
+--names distinct names with Zipf-distributed popularity, and --blocked of
+the names fall under a blocklist held in a DomainTrie. Then runs
+query_log.py's tailer over the file in one pass, and reports lines per
+second (next to a plain line-by-line count of names alone), peak memory
+of the tailer, and how well the fixed-size top-k summaries agree with
+exact counts.
+
+Usage: python3 bench_query_log.py [--lines 3000000] [--names 200000] [--clients 200]
+"""
+
+import argparse
+import bisect
+import collections
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import query_log  # noqa: E402
+from domain_trie import DomainTrie  # noqa: E402
+
+
+def domain(i):
+    return "site%d.example%d.com" % (i, i % 97)
+
+
+def write_log(path, lines, names, clients, blocked, seed):
+    """Write the synthetic log; returns the blocklist domains"""
+    rng = random.Random(seed)
+    # Zipf(1) popularity, most popular names first
+    cumulative = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(names)))
+    weights_total = cumulative[-1]
+    blocked_ids = set(rng.sample(range(names), blocked))
+    lookups = lines // 3
+    with open(path, "w") as f:
+        batch = []
+        for serial in range(lookups):
+            i = bisect.bisect_left(cumulative, rng.random() * weights_total)
+            name = "www." + domain(i) if i % 3 == 0 else domain(i)
+            client = "192.168.%d.%d" % (1 + rng.randrange(clients) // 250, 2 + rng.randrange(clients) % 250)
+            stamp = "Oct 17 10:%02d:%02d dnsmasq[812]: %d %s/%d " % (
+                serial // 60000 % 60, serial // 1000 % 60, serial, client, 40000 + serial % 20000)
+            batch.append(stamp + "query[A] %s from %s\n" % (name, client))
+            if i in blocked_ids:
+                batch.append(stamp + "config %s is 0.0.0.0\n" % name)
+            else:
+                batch.append(stamp + "forwarded %s to 1.1.1.1\n" % name)
+            batch.append(stamp + "reply %s is 203.0.113.%d\n" % (name, i % 250))
+            if len(batch) >= 30000:
+                f.write("".join(batch))
+                batch = []
+        f.write("".join(batch))
+    return [domain(i) for i in blocked_ids]
+
+
+def exact_counts(path, trie):
+    """Reference counts with a plain line-by-line pass"""
+    pattern = re.compile(r"query\[[^\]]*\] (\S+) from (\S+)")
+    names, blocked = collections.Counter(), collections.Counter()
+    with open(path, "r") as f:
+        for line in f:
+            found = pattern.search(line)
+            if found:
+                names[found.group(1)] += 1
+                if trie.match(found.group(1)) is not None:
+                    blocked[found.group(1)] += 1
+    return names, blocked
+
+
+def recall(summary, exact, k):
+    """Share of the exact top k that the summary's top k also holds"""
+    true_top = set(name for name, _ in exact.most_common(k))
+    return len(true_top & set(name for name, _, _ in summary.top(k))) / float(len(true_top) or 1)
+
+
+def max_error(summary, exact, k):
+    """Largest relative overestimate among the summary's top k"""
+    return max((count - exact[name]) / float(exact[name]) for name, count, _ in summary.top(k))
+
+
+def run(lines, names, clients, blocked, top, seed):
+    handle, path = tempfile.mkstemp(prefix="seer-dnsmasq-", suffix=".log")
+    os.close(handle)
+    state = path + ".state.json"
+    try:
+        start = time.perf_counter()
+        blocklist = write_log(path, lines, names, clients, blocked, seed)
+        generate_s = time.perf_counter() - start
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            line_count = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+        trie = DomainTrie((name, name) for name in blocklist)
+
+        def match(name, client):
+            return trie.match(name)
+
+        tailer = query_log.QueryLogTailer(match, path, state)
+        start = time.perf_counter()
+        tailer.poll()
+        parse_s = time.perf_counter() - start
+        tailer.close_file()
+        tailer.save_state()
+
+        # Memory in a second pass, as tracing slows the parse several times over
+        traced = query_log.QueryLogTailer(match, path, state + ".traced")
+        tracemalloc.start()
+        traced.poll()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        traced.close_file()
+
+        start = time.perf_counter()
+        exact_names, exact_blocked = exact_counts(path, trie)
+        naive_s = time.perf_counter() - start
+
+        return {
+            "lines": line_count,
+            "bytes": size,
+            "lookups": tailer.stats["queries"],
+            "blocked": tailer.stats["blocked"],
+            "distinct_names": len(exact_names),
+            "generate_s": generate_s,
+            "parse_s": parse_s,
+            "lines_per_s": line_count / parse_s,
+            "mb_per_s": size / parse_s / 1e6,
+            "naive_s": naive_s,
+            "peak_memory_bytes": peak,
+            "state_bytes": os.path.getsize(state),
+            "top": top,
+            "names_recall": recall(tailer.names, exact_names, top),
+            "names_max_error": max_error(tailer.names, exact_names, top),
+            "blocked_recall": recall(tailer.blocked_names, exact_blocked, top),
+            "blocked_max_error": max_error(tailer.blocked_names, exact_blocked, top),
+        }
+    finally:
+        for leftover in (path, state):
+            if os.path.exists(leftover):
+                os.unlink(leftover)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lines", type=int, default=3000000)
+    parser.add_argument("--names", type=int, default=200000, help="distinct names looked up")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--blocked", type=int, default=20000, help="names under a blocked domain")
+    parser.add_argument("--top", type=int, default=20, help="k for the top-k accuracy check")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    result = run(args.lines, args.names, args.clients, args.blocked, args.top, args.seed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print("%d lines (%.0f MB), %d lookups of %d names, %d blocked" % (
+        result["lines"], result["bytes"] / 1e6, result["lookups"], result["distinct_names"], result["blocked"]))
+    print("  tailer          %8.2f s  %10.0f lines/s  %6.1f MB/s" % (
+        result["parse_s"], result["lines_per_s"], result["mb_per_s"]))
+    print("  line by line    %8.2f s  (exact name counts only, unbounded memory)" % result["naive_s"])
+    print("  peak memory     %8.1f MB  state file %.0f KB" % (
+        result["peak_memory_bytes"] / 1e6, result["state_bytes"] / 1e3))
+    print("  top %d queried   recall %.2f  max overestimate %.1f%%" % (
+        args.top, result["names_recall"], result["names_max_error"] * 100))
+    print("  top %d blocked   recall %.2f  max overestimate %.1f%%" % (
+        args.top, result["blocked_recall"], result["blocked_max_error"] * 100))
+
+
+if __name__ == "__main__":
+    main()
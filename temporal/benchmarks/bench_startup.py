@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Engine time-to-ready with N stored policies: first boot vs restart
+
+Fills a temporary database with N policies (mostly all-day, some on
+weekday/evening windows), then starts the engine in a fresh process with
+start_server() and reports the per-phase breakdown from STARTUP_TIMINGS.
+The first boot renders the managed files; the restart finds them already
+on disk and must not rewrite them or reload dnsmasq.
+
+Usage: python3 bench_startup.py [--policies 1000 10000]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+
+ENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ENGINE_DIR)
+from storage import PolicyStorage  # noqa: E402
+
+SCHEDULES = (
+    None,
+    {"start": "08:00", "end": "17:00", "days": ["mon", "tue", "wed", "thu", "fri"]},
+    {"start": "21:00", "end": "06:00"},
+)
+
+# Runs in a fresh interpreter so imports and module state count like a real boot
+CHILD = r"""
+import io, json, os, sys, time, contextlib
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+workdir, port = sys.argv[2], int(sys.argv[3])
+with contextlib.redirect_stdout(io.StringIO()):
+    import temporal_policy as tp
+imported = time.perf_counter() - started
+tp.DB_PATH = os.path.join(workdir, "seer.db")
+tp.HOSTS_FILE = os.path.join(workdir, "hosts")
+tp.DNSMASQ_CONF = os.path.join(workdir, "blocked-sites.conf")
+tp.SERVER_PORT = port
+reloads = []
+tp.reload_dnsmasq = lambda restart=True: reloads.append(restart) or ("restart" if restart else "sighup")
+tp.DEVICE_BLOCKS.registry = os.path.join(workdir, "registry")
+tp.DEVICE_BLOCKS.leases.path = os.path.join(workdir, "dnsmasq.leases")
+with contextlib.redirect_stdout(io.StringIO()):
+    server = tp.start_server()
+ready = time.perf_counter() - started
+server.server_close()
+print(json.dumps({"import_s": imported, "process_ready_s": ready, "reloads": len(reloads),
+                  "blocked": len(tp.BLOCKLIST), "timings": dict(tp.STARTUP_TIMINGS)}))
+"""
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def populate(workdir, count):
+    storage = PolicyStorage(os.path.join(workdir, "seer.db"))
+    storage.open(os.path.join(workdir, "seer.db"))
+    storage.save_policies([("site%d.example%d.com" % (i, i % 97), SCHEDULES[max(0, i % 10 - 7)])
+                           for i in range(count)])
+    storage.close()
+    with open(os.path.join(workdir, "hosts"), "w") as f:
+        f.write("127.0.0.1 localhost\n::1 localhost\n")
+
+
+def boot(workdir):
+    output = subprocess.run([sys.executable, "-c", CHILD, ENGINE_DIR, workdir, str(free_port())],
+                            stdout=subprocess.PIPE, check=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--policies", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = []
+    for count in args.policies:
+        workdir = tempfile.mkdtemp(prefix="seer-bench-")
+        try:
+            populate(workdir, count)
+            for kind in ("first boot", "restart"):
+                result = boot(workdir)
+                result.update({"policies": count, "boot": kind})
+                results.append(result)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    phases = ["db", "port", "query", "schedule", "restore", "reload", "devices", "bind"]
+    print("%8s %-10s %8s %8s %s %8s %7s" % (
+        "policies", "boot", "import", "ready", " ".join("%8s" % p for p in phases), "total", "reloads"))
+    for r in results:
+        print("%8d %-10s %8.3f %8.3f %s %8.3f %7d" % (
+            r["policies"], r["boot"], r["import_s"], r["process_ready_s"],
+            " ".join("%8.3f" % r["timings"].get(p, 0) for p in phases), r["timings"]["total"], r["reloads"]))
+
+
+if __name__ == "__main__":
+    main()
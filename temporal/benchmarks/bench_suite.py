@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Policy engine benchmark suite with a machine-readable baseline
+
+Runs temporal_policy.py as a subprocess under a scratch root prefix
+(--root) with fake_dnsmasq.py as its dnsmasq, then replays:
+
+  bulk_import      one NDJSON upload of --domains domains
+  mixed_load       --clients threads of paged GETs and single block/unblock POSTs
+  scheduler        --scheduled policies whose window opens at the next minute
+                   boundary (waits for it, so this takes up to a minute)
+  startup_restore  stop and restart the engine with everything still stored
+  restart          restart the engine under GET/POST load three ways: SIGKILL and
+                   a fresh start binding the port (the old kill-by-port way),
+                   SIGTERM with the socket held by the suite the way
+                   temporal-policy.socket holds it, and an in-place SIGUSR2
+                   restart; counts failed requests and acknowledged blocks
+                   missing afterwards, and times signal to ready
+
+and reports throughput, p50/p99 latency, dnsmasq restarts and the engine's
+RSS. --save writes the results as a JSON baseline; --compare checks a run
+against one and exits 1 if a metric regressed by more than --tolerance.
+
+Usage: python3 bench_suite.py [--save baseline.json] [--compare baseline.json]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENGINE = os.path.join(HERE, "..", "temporal_policy.py")
+FAKE_DNSMASQ = os.path.join(HERE, "fake_dnsmasq.py")
+sys.path.insert(0, HERE)
+import fake_dnsmasq  # noqa: E402
+
+SCENARIOS = ("bulk_import", "mixed_load", "scheduler", "startup_restore", "restart")
+RESTART_METHODS = ("kill", "term", "reexec")
+
+# Metric name suffixes that tell which direction is better when comparing
+LOWER_IS_BETTER = ("_s", "_ms", "_kb", "_restarts", "_errors", "_lost_writes")
+HIGHER_IS_BETTER = ("_per_s",)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Engine:
+    """temporal_policy.py running under a root prefix with the fake dnsmasq"""
+
+    def __init__(self, root, startup_delay):
+        self.root = root
+        self.port = free_port()
+        self.restart_command = "%s %s --root %s --startup-delay %s restart" % (
+            sys.executable, FAKE_DNSMASQ, root, startup_delay)
+        self.process = None
+        # Listening socket passed to the engine like systemd's socket activation, see hold_socket()
+        self.listener = None
+
+    def hold_socket(self):
+        """Own the engine's listening socket from now on, as temporal-policy.socket does"""
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", self.port))
+        self.listener.listen(socket.SOMAXCONN)
+
+    def start(self, timeout=60.0):
+        """Start the engine; returns seconds until it answered its first request"""
+        started = time.perf_counter()
+        command = [sys.executable, ENGINE, "--root", self.root, "--port", str(self.port),
+                   "--restart-command", self.restart_command, "--log-level", "WARNING",
+                   "--log-file", os.path.join(self.root, "engine.log")]
+        pass_fds = ()
+        if self.listener is not None:
+            # The socket goes in as descriptor 3 with LISTEN_PID naming the engine's own PID
+            fd = self.listener.fileno()
+            move = " 3<&%d %d<&-" % (fd, fd) if fd != 3 else ""
+            command = ["sh", "-c", 'LISTEN_PID=$$ LISTEN_FDS=1 LISTEN_FDNAMES=http exec "$@"' + move, "sh"] + command
+            pass_fds = (fd,)
+        self.process = subprocess.Popen(command, pass_fds=pass_fds, stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("engine exited with status %d, see %s/engine.log"
+                                   % (self.process.returncode, self.root))
+            try:
+                self.request("GET", "/stats")
+                return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError("engine did not answer within %.0fs" % timeout)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            # What systemd sends: the engine drains and exits
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def request(self, method, path, body=None, content_type="application/json"):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            headers = {"Content-Type": content_type} if body is not None else {}
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def stats(self):
+        return json.loads(self.request("GET", "/stats")[1])
+
+    def memory(self):
+        """Current and peak RSS in KiB from /proc, or {} where there is no /proc"""
+        result = {}
+        try:
+            with open("/proc/%d/status" % self.process.pid, "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        result["rss_kb"] = int(line.split()[1])
+                    elif line.startswith("VmHWM:"):
+                        result["peak_rss_kb"] = int(line.split()[1])
+        except (OSError, AttributeError):
+            pass
+        return result
+
+    def dnsmasq_restarts(self):
+        return fake_dnsmasq.stats(self.root)["start"]
+
+
+def bulk_import(engine, args):
+    body = "".join(json.dumps({"action": "block", "domain": "bulk%d.example%d.com" % (i, i % 97)}) + "\n"
+                   for i in range(args.domains))
+    restarts = engine.dnsmasq_restarts()
+    start = time.perf_counter()
+    status, _ = engine.request("POST", "/", body.encode("utf-8"), "application/x-ndjson")
+    elapsed = time.perf_counter() - start
+    if status != 200:
+        raise RuntimeError("bulk import failed with HTTP %d" % status)
+    result = {
+        "domains": args.domains,
+        "import_s": elapsed,
+        "domains_per_s": args.domains / elapsed,
+        "dnsmasq_restarts": engine.dnsmasq_restarts() - restarts,
+    }
+    result.update(engine.memory())
+    return result
+
+
+def mixed_load(engine, args):
+    samples = {"GET": [], "POST": []}
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    restarts = engine.dnsmasq_restarts()
+
+    def client(seed):
+        rng = random.Random(seed)
+        local = {"GET": [], "POST": []}
+        blocked = set()
+        failed = 0
+        while time.monotonic() < deadline:
+            if rng.random() < args.post_ratio:
+                # Each client toggles its own domains so every unblock has a block to undo
+                domain = "load%d-%d.example.net" % (seed, rng.randrange(25))
+                action = "unblock" if domain in blocked else "block"
+                blocked.symmetric_difference_update((domain,))
+                method, path = "POST", "/"
+                body = json.dumps({"action": action, "domain": domain}).encode("utf-8")
+            else:
+                method, body = "GET", None
+                path = "/?offset=%d&limit=50" % rng.randrange(max(1, args.domains - 50))
+            start = time.perf_counter()
+            try:
+                status, _ = engine.request(method, path, body)
+                if status >= 400:
+                    failed += 1
+            except OSError:
+                failed += 1
+            local[method].append(time.perf_counter() - start)
+        with lock:
+            for method in local:
+                samples[method].extend(local[method])
+            errors[0] += failed
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = len(samples["GET"]) + len(samples["POST"])
+    result = {
+        "clients": args.clients,
+        "requests": total,
+        "errors": errors[0],
+        "requests_per_s": total / elapsed,
+        "get_p50_ms": percentile(samples["GET"], 50) * 1000 if samples["GET"] else None,
+        "get_p99_ms": percentile(samples["GET"], 99) * 1000 if samples["GET"] else None,
+        "post_p50_ms": percentile(samples["POST"], 50) * 1000 if samples["POST"] else None,
+        "post_p99_ms": percentile(samples["POST"], 99) * 1000 if samples["POST"] else None,
+        "dnsmasq_restarts": engine.dnsmasq_restarts() - restarts,
+    }
+    result.update(engine.memory())
+    return result
+
+
+def scheduler(engine, args):
+    # Leave a few seconds to upload the policies before the window opens
+    boundary = (int(time.time()) // 60 + 1) * 60
+    if boundary - time.time() < 5:
+        boundary += 60
+    opens = time.localtime(boundary)
+    closes = time.localtime(boundary + 30 * 60)
+    schedule = {"start": "%02d:%02d" % (opens.tm_hour, opens.tm_min),
+                "end": "%02d:%02d" % (closes.tm_hour, closes.tm_min)}
+    body = json.dumps({"action": "block", "schedule": schedule,
+                       "domains": ["sched%d.example.org" % i for i in range(args.scheduled)]}).encode("utf-8")
+    status, _ = engine.request("POST", "/", body)
+    if status != 200:
+        raise RuntimeError("scheduled upload failed with HTTP %d" % status)
+
+    before = engine.stats()["scheduler"]["transitions"]
+    restarts = engine.dnsmasq_restarts()
+    time.sleep(max(0.0, boundary - time.time()))
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        transitions = engine.stats()["scheduler"]["transitions"] - before
+        if transitions >= args.scheduled:
+            break
+        time.sleep(0.01)
+    lag = time.time() - boundary
+    # The batch restart runs after the counter moves; let it land
+    time.sleep(args.startup_delay + 0.5)
+    result = {
+        "policies": args.scheduled,
+        "transitions": transitions,
+        "activation_lag_s": lag,
+        "dnsmasq_restarts": engine.dnsmasq_restarts() - restarts,
+    }
+    result.update(engine.memory())
+    return result
+
+
+def startup_restore(engine, args):
+    engine.stop()
+    restarts = engine.dnsmasq_restarts()
+    ready = engine.start()
+    stats = engine.stats()
+    result = {
+        "policies": stats.get("scheduler", {}).get("policies"),
+        "time_to_ready_s": ready,
+        "engine_ready_s": stats.get("startup", {}).get("total"),
+        "dnsmasq_restarts": engine.dnsmasq_restarts() - restarts,
+    }
+    result.update(engine.memory())
+    return result
+
+
+def restart_under_load(engine, args, method):
+    """Restart the engine one way while clients keep sending requests"""
+    stop = threading.Event()
+    lock = threading.Lock()
+    acked = set()
+    latencies = []
+    errors = [0]
+
+    def client(seed):
+        rng = random.Random(seed)
+        serial = 0
+        while not stop.is_set():
+            if rng.random() < args.post_ratio:
+                serial += 1
+                domain = "restart-%s%d-%d.example.net" % (method, seed, serial)
+                method_, path, body = "POST", "/", json.dumps({"action": "block", "domain": domain}).encode("utf-8")
+            else:
+                domain, method_, path, body = None, "GET", "/stats", None
+            start = time.perf_counter()
+            try:
+                status, _ = engine.request(method_, path, body)
+                ok = status < 400
+            except OSError:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+                elif domain is not None:
+                    acked.add(domain)
+            if not ok:
+                # Refused connections come back at once; do not spin on them
+                time.sleep(0.01)
+
+    before = engine.stats()["process"]["started"]
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.restart_load)
+    with lock:
+        latencies[:] = []
+    restarts = engine.dnsmasq_restarts()
+
+    signalled = time.perf_counter()
+    if method == "reexec":
+        engine.process.send_signal(signal.SIGUSR2)
+        while engine.stats()["process"]["started"] == before:
+            time.sleep(0.005)
+        ready = time.perf_counter() - signalled
+    else:
+        if method == "kill":
+            engine.process.kill()
+            engine.process.wait()
+        else:
+            engine.stop()
+        engine.start()
+        ready = time.perf_counter() - signalled
+
+    time.sleep(args.restart_load)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    status, body = engine.request("GET", "/")
+    present = set(policy["destination"] for policy in json.loads(body)["policies"])
+    return {
+        method + "_ready_s": ready,
+        method + "_requests": len(latencies),
+        method + "_errors": errors[0],
+        method + "_lost_writes": len(acked - present),
+        method + "_max_wait_ms": max(latencies) * 1000 if latencies else None,
+        method + "_dnsmasq_restarts": engine.dnsmasq_restarts() - restarts,
+    }
+
+
+def restart(engine, args):
+    result = {}
+    for method in RESTART_METHODS:
+        if method != "kill" and engine.listener is None:
+            # From here on the suite holds the socket across engine processes
+            engine.stop()
+            engine.hold_socket()
+            engine.start()
+        result.update(restart_under_load(engine, args, method))
+    result.update(engine.memory())
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Print per-metric changes against a baseline; returns the regressed metrics"""
+    regressions = []
+    print("\n%-16s %-20s %14s %14s %9s" % ("scenario", "metric", "baseline", "current", "change"))
+    for scenario, metrics in results["results"].items():
+        for metric, value in metrics.items():
+            old = baseline.get("results", {}).get(scenario, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            # Any rise from zero (a clean restart starting to fail requests) is unbounded
+            change = (value - old) / float(old) if old else (float("inf") if value > old else 0.0)
+            # "_per_s" also ends in "_s", so rates are checked first
+            if metric.endswith(HIGHER_IS_BETTER):
+                worse = change < -tolerance
+            else:
+                worse = metric.endswith(LOWER_IS_BETTER) and change > tolerance
+            # Restart counts and lost writes are exact: any increase is a regression
+            if metric.endswith(("_restarts", "_lost_writes")):
+                worse = value > old
+            if worse:
+                regressions.append("%s.%s" % (scenario, metric))
+            print("%-16s %-20s %14.4g %14.4g %+8.1f%%%s" % (
+                scenario, metric, old, value, change * 100, "  REGRESSED" if worse else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--domains", type=int, default=10000, help="bulk import size")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="mixed load seconds")
+    parser.add_argument("--post-ratio", type=float, default=0.1)
+    parser.add_argument("--scheduled", type=int, default=1000, help="policies opening at once")
+    parser.add_argument("--restart-load", type=float, default=2.0,
+                        help="seconds of load before and after each restart")
+    parser.add_argument("--startup-delay", type=float, default=0.1,
+                        help="seconds the fake dnsmasq takes to start, on top of parsing its config")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch root")
+    parser.add_argument("--save", metavar="FILE", help="write results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="seer-suite-")
+    engine = Engine(root, args.startup_delay)
+    results = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": {},
+    }
+    scenarios = {"bulk_import": bulk_import, "mixed_load": mixed_load,
+                 "scheduler": scheduler, "startup_restore": startup_restore, "restart": restart}
+    try:
+        fake_dnsmasq.restart(root, args.startup_delay)
+        results["results"]["startup"] = {"time_to_ready_s": engine.start()}
+        results["results"]["startup"].update(engine.memory())
+        for name in SCENARIOS:
+            if name in args.scenarios:
+                if not args.json:
+                    print("[SUITE] %s..." % name, file=sys.stderr)
+                results["results"][name] = scenarios[name](engine, args)
+    finally:
+        engine.stop()
+        if engine.listener is not None:
+            engine.listener.close()
+        fake_dnsmasq.stop(root)
+        if args.keep:
+            print("[SUITE] scratch root kept at %s" % root, file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for scenario, metrics in results["results"].items():
+            print("%s:" % scenario)
+            for metric, value in metrics.items():
+                print("  %-22s %s" % (metric, "%.4g" % value if isinstance(value, float) else value))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressed: %s" % ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
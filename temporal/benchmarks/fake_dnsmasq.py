@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in for dnsmasq under a root prefix, for benchmarks
+
+Behaves like dnsmasq as far as the policy engine can tell: on start it
+parses <root>/etc/dnsmasq.d/*.conf and <root>/etc/hosts and writes
+<root>/run/dnsmasq/dnsmasq.pid; SIGHUP re-reads the hosts file only; a
+restart (the engine's DNSMASQ_RESTART_COMMAND) stops it and waits for a
+new instance to finish loading. Every start and SIGHUP is appended as a
+JSON line to <root>/fake-dnsmasq.log.
+
+Usage: python3 fake_dnsmasq.py --root DIR restart   (also: serve, stop, stats)
+"""
+
+import argparse
+import glob
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+PID_FILE = "run/dnsmasq/dnsmasq.pid"
+CONF_GLOB = "etc/dnsmasq.d/*.conf"
+HOSTS_FILE = "etc/hosts"
+EVENT_LOG = "fake-dnsmasq.log"
+
+
+def _path(root, relative):
+    return os.path.join(root, relative)
+
+
+def load_conf(root):
+    """address=/domain/ip entries from every conf file, parsed like dnsmasq would"""
+    addresses = {}
+    for conf in sorted(glob.glob(_path(root, CONF_GLOB))):
+        with open(conf, "r") as f:
+            for line in f:
+                if line.startswith("address=/"):
+                    _, domain, ip = line.strip().split("/", 2)
+                    addresses[domain] = ip
+    return addresses
+
+
+def load_hosts(root):
+    hosts = {}
+    try:
+        with open(_path(root, HOSTS_FILE), "r") as f:
+            for line in f:
+                fields = line.split("#", 1)[0].split()
+                for name in fields[1:]:
+                    hosts[name] = fields[0]
+    except FileNotFoundError:
+        pass
+    return hosts
+
+
+def record(root, event, **fields):
+    fields.update(event=event, time=time.time(), pid=os.getpid())
+    with open(_path(root, EVENT_LOG), "a") as f:
+        f.write(json.dumps(fields) + "\n")
+
+
+def read_pid(root):
+    try:
+        with open(_path(root, PID_FILE), "r") as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+        return pid
+    except (OSError, ValueError):
+        return None
+
+
+def serve(root, startup_delay):
+    start = time.perf_counter()
+    addresses = load_conf(root)
+    hosts = load_hosts(root)
+    # Real dnsmasq also binds sockets and reads leases; model that as a fixed cost
+    time.sleep(startup_delay)
+    record(root, "start", addresses=len(addresses), hosts=len(hosts), load_s=time.perf_counter() - start)
+
+    def on_hup(signum, frame):
+        record(root, "sighup", hosts=len(load_hosts(root)))
+
+    def on_term(signum, frame):
+        try:
+            os.unlink(_path(root, PID_FILE))
+        except FileNotFoundError:
+            pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGHUP, on_hup)
+    signal.signal(signal.SIGTERM, on_term)
+    os.makedirs(os.path.dirname(_path(root, PID_FILE)), exist_ok=True)
+    tmp = _path(root, PID_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        f.write("%d\n" % os.getpid())
+    # The PID file appearing is the "ready" signal restart() waits for
+    os.replace(tmp, _path(root, PID_FILE))
+    while True:
+        signal.pause()
+
+
+def stop(root, timeout=5.0):
+    pid = read_pid(root)
+    if pid is None:
+        return False
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    # serve() removes the PID file on SIGTERM; the process itself can linger
+    # as a zombie until whoever adopted it reaps it, so don't wait on that
+    while time.monotonic() < deadline:
+        if read_pid(root) != pid:
+            return True
+        time.sleep(0.005)
+    os.kill(pid, signal.SIGKILL)
+    return True
+
+
+def restart(root, startup_delay, timeout=10.0):
+    """Like systemctl restart: returns once the new instance has loaded its config"""
+    stop(root)
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "--root", root,
+                      "--startup-delay", str(startup_delay), "serve"],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while read_pid(root) is None:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def stats(root):
+    counts = {"start": 0, "sighup": 0}
+    last = None
+    try:
+        with open(_path(root, EVENT_LOG), "r") as f:
+            for line in f:
+                event = json.loads(line)
+                counts[event["event"]] = counts.get(event["event"], 0) + 1
+                if event["event"] == "start":
+                    last = event
+    except FileNotFoundError:
+        pass
+    counts["restarts"] = max(0, counts["start"] - 1)
+    counts["last_start"] = last
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--root", required=True)
+    parser.add_argument("--startup-delay", type=float, default=0.0,
+                        help="extra seconds a start takes after parsing the files")
+    parser.add_argument("command", choices=("serve", "restart", "stop", "stats"))
+    args = parser.parse_args()
+    root = os.path.abspath(args.root)
+
+    if args.command == "serve":
+        serve(root, args.startup_delay)
+    elif args.command == "restart":
+        sys.exit(0 if restart(root, args.startup_delay) else 1)
+    elif args.command == "stop":
+        stop(root)
+    else:
+        print(json.dumps(stats(root), indent=2))
+
+
+if __name__ == "__main__":
+    main()
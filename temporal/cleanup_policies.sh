@@ -1,20 +1,19 @@
 
 echo "[$(date)] Cleaning up temporal policies..."
-# Get all policies
-POLICIES=$(curl -s http://127.0.0.1:1889 | python3 -c "import sys, json; data = json.load(sys.stdin); print(' '.join([p['destination'] for p in data.get('policies', [])]))" 2>/dev/null)
+# Get all policies as NDJSON unblock records, keeping each group policy's source
+POLICIES=$(curl -s http://127.0.0.1:1889 | python3 -c "import sys, json; data = json.load(sys.stdin); print('\\n'.join(json.dumps(dict({'action': 'unblock', 'domain': p['destination']}, **({'source': p['source']} if p.get('source') else {}))) for p in data.get('policies', [])))" 2>/dev/null)
 
-# Unblock each one
-for domain in $POLICIES; do
-    echo "Unblocking $domain..."
-    curl -X POST http://127.0.0.1:1889 \
-      -H "Content-Type: application/json" \
-      -d "{\"action\":\"unblock\",\"domain\":\"$domain\"}" \
+# Unblock all of them in one bulk request
+if [ -n "$POLICIES" ]; then
+    echo "Unblocking $(echo "$POLICIES" | wc -l) policies..."
+    echo "$POLICIES" | curl -X POST "http://127.0.0.1:1889/?action=unblock" \
+      -H "Content-Type: application/x-ndjson" \
+      --data-binary @- \
       -s > /dev/null
-done
+fi
 
-# Also clean /etc/hosts directly
-sed -i '/SEER Policy/d' /etc/hosts
-sed -i '/# SEER Policy/d' /etc/hosts
+# Also clean /etc/hosts directly: the engine keeps its entries between these markers
+sed -i '/^# BEGIN SEER Policy/,/^# END SEER Policy/d' /etc/hosts
 
 # Remove any blocked domains
 sed -i '/facebook.com/d' /etc/hosts
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER device blocks
+Timed device blocks with an in-process expiry heap, replacing the per-device
+sleep/at jobs and the per-minute cleanup_expired_blocks.sh cron job
+"""
+
+import bisect
+import heapq
+import itertools
+import json
+import math
+import os
+import re
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+from firewall import remove_legacy_rules
+from leases import LEASE_FILE, LeaseIndex
+from logs import get_logger
+
+log = get_logger("devices")
+
+# Defaults match dhcp/remove_device_complete.sh
+BLOCK_DURATION = 120
+# Longest block accepted, in seconds (one year)
+MAX_BLOCK_DURATION = 365 * 24 * 3600
+BLOCK_REGISTRY = "/var/lib/dhcp-blocks"
+
+# Upper bound on one wait, so a clock jump is noticed eventually
+EXPIRY_MAX_SLEEP = 300
+
+_MAC_RE = re.compile(r"^[0-9a-f]{2}(:[0-9a-f]{2}){5}$")
+
+
+def normalize_mac(mac):
+    """Lowercase, colon-separated MAC address; raises ValueError if malformed"""
+    value = str(mac or "").strip().lower().replace("-", ":")
+    if not _MAC_RE.match(value):
+        raise ValueError("Invalid MAC address: %r" % (mac,))
+    return value
+
+
+class DeviceBlock:
+    """One blocked device and when its block expires"""
+
+    __slots__ = ("mac", "ip", "hostname", "blocked_at", "expires_at", "_json")
+
+    def __init__(self, mac, ip=None, hostname=None, blocked_at=None, expires_at=None):
+        self._json = None
+        self.mac = mac
+        self.ip = ip or None
+        self.hostname = hostname or "Unknown"
+        self.blocked_at = blocked_at if blocked_at is not None else time.time()
+        self.expires_at = expires_at if expires_at is not None else self.blocked_at + BLOCK_DURATION
+
+    def row(self):
+        return (self.mac, self.ip, self.hostname, self.blocked_at, self.expires_at)
+
+    def to_dict(self):
+        return {
+            "mac": self.mac,
+            "ip": self.ip,
+            "hostname": self.hostname,
+            "blocked_at": self.blocked_at,
+            "expires": int(self.expires_at),
+            "expires_at": datetime.fromtimestamp(self.expires_at).isoformat(),
+        }
+
+    def json(self):
+        """to_dict() encoded once; blocks are never modified after creation"""
+        if self._json is None:
+            self._json = json.dumps(self.to_dict())
+        return self._json
+
+
+# ==================== SYSTEM HELPERS ====================
+
+_missing_commands = set()
+
+
+def _run(args):
+    """Run a command quietly; returns True on exit status 0"""
+    try:
+        return subprocess.run(args, check=False, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL).returncode == 0
+    except FileNotFoundError:
+        if args[0] not in _missing_commands:
+            _missing_commands.add(args[0])
+            log.warning("%s not found - skipping", args[0])
+        return False
+
+
+def kill_connections(ip):
+    if ip:
+        _run(["conntrack", "-D", "-s", ip])
+        _run(["conntrack", "-D", "-d", ip])
+
+
+def _summary(macs, limit=10):
+    return ", ".join(macs[:limit]) + (" ..." if len(macs) > limit else "")
+
+
+# ==================== MANAGER ====================
+
+class DeviceBlockManager:
+    """Block devices for a fixed time and unblock them exactly at expiry
+
+    Active blocks sit in a min-heap of (expires_at, generation, mac) that is
+    mirrored to the device_blocks table, so they survive restarts. One
+    thread sleeps until the earliest expiry; every block that has expired
+    by then is lifted in one batch, with one lease-file rewrite and one
+    dnsmasq restart. Re-blocking or unblocking early bumps the device's
+    generation, which lazily invalidates its old heap entry. Firewall
+    changes for a batch go to the kernel as one transaction.
+    """
+
+    def __init__(self, storage, firewall, restart_dnsmasq, lease_file=LEASE_FILE, registry=BLOCK_REGISTRY):
+        self._storage = storage
+        self.firewall = firewall
+        self._restart_dnsmasq = restart_dnsmasq
+        self.leases = LeaseIndex(lease_file)
+        self.registry = registry
+        # False in a sandbox: no iptables/conntrack calls against the host
+        self.system_commands = True
+        self._cond = threading.Condition()
+        self._apply_lock = threading.Lock()
+        self._heap = []
+        self._entries = {}
+        self._generation = itertools.count()
+        # Active blocks sorted by expiry, rebuilt only after a change
+        self._view = None
+        self._view_keys = None
+        self._thread = None
+        self._stopped = False
+        self.stats = {
+            "blocked": 0,
+            "unblocked": 0,
+            "expired": 0,
+            "unblock_batches": 0,
+            "restarts": 0,
+        }
+
+    # ---- registry files, kept for list_blocked_devices.sh ----
+
+    def _write_registry(self, block):
+        try:
+            os.makedirs(self.registry, exist_ok=True)
+            with open(os.path.join(self.registry, block.mac), "w") as f:
+                f.write("%d|%s|%s|%s\n" % (block.expires_at, block.mac, block.ip or "", block.hostname))
+        except OSError as e:
+            log.warning("Could not write registry entry for %s: %s", block.mac, str(e))
+
+    def _remove_registry(self, mac):
+        try:
+            os.unlink(os.path.join(self.registry, mac))
+        except OSError:
+            pass
+
+    def _read_registry(self):
+        """Blocks recorded by the old shell scripts as timestamp|mac|ip[|hostname]"""
+        blocks = []
+        try:
+            names = os.listdir(self.registry)
+        except OSError:
+            return blocks
+        for name in names:
+            try:
+                with open(os.path.join(self.registry, name), "r") as f:
+                    fields = f.read().strip().split("|")
+                expires_at = float(fields[0])
+                mac = normalize_mac(fields[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            ip = fields[2] if len(fields) > 2 else None
+            hostname = fields[3] if len(fields) > 3 else None
+            blocks.append(DeviceBlock(mac, ip, hostname, blocked_at=min(expires_at, time.time()),
+                                      expires_at=expires_at))
+        return blocks
+
+    # ---- heap ----
+
+    def _schedule(self, block):
+        with self._cond:
+            generation = next(self._generation)
+            self._entries[block.mac] = (block, generation)
+            self._view = None
+            entry = (block.expires_at, generation, block.mac)
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._cond.notify()
+
+    def _forget(self, macs):
+        """Drop macs from the active set; returns the blocks that were active"""
+        with self._cond:
+            self._view = None
+            return [entry[0] for entry in (self._entries.pop(mac, None) for mac in macs) if entry]
+
+    # ---- operations ----
+
+    def load(self):
+        """Restore blocks from the database (and legacy registry files) after a restart"""
+        blocks = {row["mac"]: DeviceBlock(**row) for row in self._storage.load_device_blocks()}
+        legacy = [block for block in self._read_registry() if block.mac not in blocks]
+        if legacy:
+            self._storage.save_device_blocks(block.row() for block in legacy)
+            log.info("Imported %d block(s) from %s", len(legacy), self.registry)
+            blocks.update((block.mac, block) for block in legacy)
+
+        now = time.time()
+        expired = [block for block in blocks.values() if block.expires_at <= now]
+        active = [block for block in blocks.values() if block.expires_at > now]
+        with self._apply_lock:
+            # The old scripts blocked with one iptables rule pair per device; the sets replace them
+            for block in legacy:
+                self._remove_legacy_rules(block.mac, block.ip)
+            # Sets do not survive a reboot, so the full set is rebuilt in one transaction
+            self.firewall.sync(dict((block.mac, block.ip) for block in active))
+        for block in active:
+            self._schedule(block)
+        if expired:
+            self._unblock_batch(expired)
+        log.info("%d active device block(s), %d expired while stopped (firewall: %s)",
+                 len(active), len(expired), self.firewall.name)
+
+    def enforced(self):
+        """False when a block would only be recorded: no firewall tool on a real system"""
+        return not self.firewall.dry_run or not self.system_commands
+
+    def lease_ip(self, mac):
+        """Current lease IP of a device, or None"""
+        lease = self.leases.by_mac(normalize_mac(mac))
+        return lease.ip if lease else None
+
+    def block(self, mac, duration=BLOCK_DURATION, ip=None, hostname=None):
+        """Block a device for duration seconds; re-blocking replaces the expiry"""
+        return self.block_many([(mac, ip, hostname)], duration)[0]
+
+    def block_many(self, devices, duration=BLOCK_DURATION):
+        """Block (mac, ip, hostname) devices with one firewall transaction and one dnsmasq restart"""
+        if not (math.isfinite(duration) and 0 < duration <= MAX_BLOCK_DURATION):
+            raise ValueError("Duration must be a positive number of seconds up to %d" % MAX_BLOCK_DURATION)
+        if not devices:
+            raise ValueError("No devices to block")
+        devices = [(normalize_mac(mac), ip, hostname) for mac, ip, hostname in devices]
+        now = time.time()
+        blocks = []
+        for mac, ip, hostname in devices:
+            lease = self.leases.by_mac(mac)
+            if lease:
+                ip, hostname = ip or lease.ip, hostname or lease.hostname
+            # Whole seconds, as in the registry files, so blocks made together also expire together
+            blocks.append(DeviceBlock(mac, ip, hostname,
+                                      blocked_at=now, expires_at=math.ceil(now + duration)))
+
+        with self._apply_lock:
+            self.firewall.apply(add=dict((block.mac, block.ip) for block in blocks))
+            for block in blocks:
+                self._kill_connections(block.ip)
+                self._write_registry(block)
+            self._storage.save_device_blocks(block.row() for block in blocks)
+            # Drop the leases so the devices cannot simply renew them
+            if self.leases.remove([block.mac for block in blocks]):
+                self._restart()
+            # Scheduled under the lock, so a batch of expiries waiting on it sees the new blocks
+            for block in blocks:
+                self._schedule(block)
+        with self._cond:
+            self.stats["blocked"] += len(blocks)
+        log.info("Blocked %d device(s) until %s: %s",
+                 len(blocks), datetime.fromtimestamp(blocks[0].expires_at).strftime('%Y-%m-%d %H:%M:%S'),
+                 _summary([block.mac for block in blocks]))
+        return blocks
+
+    def unblock(self, macs):
+        """Lift blocks now; returns the blocks that were active"""
+        macs = [normalize_mac(mac) for mac in macs]
+        blocks = self._forget(macs)
+        known = set(block.mac for block in blocks)
+        # Devices blocked outside the engine still get their MAC rules removed
+        self._unblock_batch(blocks + [DeviceBlock(mac) for mac in macs if mac not in known])
+        return blocks
+
+    def _unblock_batch(self, blocks):
+        """Remove firewall rules, leases and records for many devices with one dnsmasq restart"""
+        with self._apply_lock:
+            # The batch was taken off the active set before the lock; a device
+            # blocked again since then is active anew and keeps its block
+            with self._cond:
+                blocks = [block for block in blocks if block.mac not in self._entries]
+            if not blocks:
+                return
+            macs = [block.mac for block in blocks]
+            unknown = [mac for mac in macs if mac not in self.firewall]
+            self.firewall.apply(remove=macs)
+            # Not in the sets: probably blocked by the old scripts while the engine was down
+            for mac in unknown:
+                self._remove_legacy_rules(mac)
+            for block in blocks:
+                self._kill_connections(block.ip)
+                self._remove_registry(block.mac)
+            self._storage.delete_device_blocks(macs)
+            # Removing the lease makes the device request a fresh one
+            self.leases.remove(macs)
+            self._restart()
+        with self._cond:
+            self.stats["unblocked"] += len(blocks)
+            self.stats["unblock_batches"] += 1
+        log.info("Unblocked %d device(s): %s", len(blocks), _summary(macs))
+
+    def _remove_legacy_rules(self, mac, ip=None):
+        if self.system_commands:
+            remove_legacy_rules(mac, ip)
+
+    def _kill_connections(self, ip):
+        if self.system_commands:
+            kill_connections(ip)
+
+    def _restart(self):
+        self._restart_dnsmasq()
+        with self._cond:
+            self.stats["restarts"] += 1
+
+    def active(self, expires_after=None, expires_before=None):
+        """Unexpired blocks, soonest expiry first, optionally within an expiry range"""
+        now = time.time()
+        with self._cond:
+            if self._view is None:
+                self._view = sorted((block for block, _ in self._entries.values()),
+                                    key=lambda block: block.expires_at)
+                self._view_keys = [block.expires_at for block in self._view]
+            view, keys = self._view, self._view_keys
+            # Blocks whose expiry has passed but that the thread has not
+            # lifted yet sit at the front; drop them here instead of waiting
+            expired = bisect.bisect_right(keys, now)
+            if expired:
+                del view[:expired]
+                del keys[:expired]
+            start = bisect.bisect_right(keys, expires_after) if expires_after is not None else 0
+            end = bisect.bisect_left(keys, expires_before) if expires_before is not None else len(keys)
+            return view[start:end]
+
+    def blocked(self, mac=None, ip=None, hostname=None, expires_after=None, expires_before=None,
+                descending=False):
+        """Filtered view of active() for listings"""
+        blocks = self.active(expires_after, expires_before)
+        if mac:
+            mac = normalize_mac(mac)
+            blocks = [block for block in blocks if block.mac == mac]
+        if ip:
+            blocks = [block for block in blocks if block.ip == ip]
+        if hostname:
+            hostname = hostname.lower()
+            blocks = [block for block in blocks if hostname in block.hostname.lower()]
+        if descending:
+            blocks.reverse()
+        return blocks
+
+    # ---- expiry thread ----
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="device-blocks", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _pop_expired(self):
+        """Wait for the next expiry; returns the expired blocks or None when stopped"""
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    break
+                timeout = self._heap[0][0] - now if self._heap else EXPIRY_MAX_SLEEP
+                self._cond.wait(min(timeout, EXPIRY_MAX_SLEEP))
+            if self._stopped:
+                return None
+
+            now = time.time()
+            expired = []
+            while self._heap and self._heap[0][0] <= now:
+                _, generation, mac = heapq.heappop(self._heap)
+                entry = self._entries.get(mac)
+                if entry is None or entry[1] != generation:
+                    continue
+                del self._entries[mac]
+                expired.append(entry[0])
+            if expired:
+                self._view = None
+            self.stats["expired"] += len(expired)
+            return expired
+
+    def _run(self):
+        while True:
+            expired = self._pop_expired()
+            if expired is None:
+                return
+            if expired:
+                try:
+                    self._unblock_batch(expired)
+                except Exception as e:
+                    log.error("Failed to unblock %d device(s): %s", len(expired), str(e))
+
+    def __len__(self):
+        with self._cond:
+            return len(self._entries)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats["active"] = len(self._entries)
+            stats["firewall"] = self.firewall.get_stats()
+            stats["leases"] = self.leases.get_stats()
+            next_expiry = min((block.expires_at for block, _ in self._entries.values()), default=None)
+        stats["next_expiry"] = datetime.fromtimestamp(next_expiry).isoformat() if next_expiry else None
+        return stats
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER DNS sinkhole
+Asyncio UDP/TCP DNS front end: names the policy index blocks are answered
+with the sinkhole address straight from memory, everything else goes to an
+upstream resolver through a TTL-respecting response cache. A policy change
+applies to the next query, with no config rewrite or resolver restart
+"""
+
+import argparse
+import asyncio
+import collections
+import ipaddress
+import random
+import socket
+import struct
+import threading
+
+from logs import get_logger
+
+log = get_logger("dns")
+
+# What blocked names resolve to, as in blocked-sites.conf
+SINKHOLE_ADDRESS = "127.0.0.1"
+SINKHOLE_ADDRESS6 = "::1"
+# Like dnsmasq's local-ttl: clients must not cache a block past an unblock
+BLOCKED_TTL = 0
+
+CACHE_SIZE = 10000
+# Cap on how long an upstream answer is cached, whatever its TTL says
+MAX_CACHE_TTL = 3600
+UPSTREAM_TIMEOUT = 2.0
+
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_AAAA = 28
+TYPE_OPT = 41
+CLASS_IN = 1
+
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+_HEADER = struct.Struct("!HHHHHH")
+_RR = struct.Struct("!HHIH")
+_TTL = struct.Struct("!I")
+
+
+def parse_upstream(value, default_port=53):
+    """Parse "host" or "host:port" ("[v6]:port" for IPv6) into (host, port)"""
+    value = value.strip()
+    if value.startswith("["):
+        host, _, port = value[1:].partition("]")
+        port = port.lstrip(":")
+    elif value.count(":") == 1:
+        host, port = value.split(":")
+    else:
+        host, port = value, ""
+    return str(ipaddress.ip_address(host)), int(port) if port else default_port
+
+
+# ==================== WIRE FORMAT ====================
+
+def parse_question(data):
+    """Return (name, qtype, qclass, end) of a message's single question; raises ValueError
+
+    name is lowercase without the trailing dot, and end is the offset just
+    past the question.
+    """
+    if len(data) < 12:
+        raise ValueError("Short message")
+    if data[4] != 0 or data[5] != 1:
+        raise ValueError("Expected one question")
+    labels = []
+    pos = 12
+    try:
+        while True:
+            length = data[pos]
+            if length == 0:
+                pos += 1
+                break
+            if length & 0xC0:
+                raise ValueError("Compressed question name")
+            labels.append(data[pos + 1:pos + 1 + length])
+            pos += 1 + length
+        qtype, qclass = struct.unpack_from("!HH", data, pos)
+    except (IndexError, struct.error):
+        raise ValueError("Truncated question")
+    if pos > 12 + 255:
+        raise ValueError("Name too long")
+    return b".".join(labels).decode("latin-1").lower(), qtype, qclass, pos + 4
+
+
+def _skip_name(data, pos):
+    """Offset just past a (possibly compressed) name"""
+    while True:
+        length = data[pos]
+        if length == 0:
+            return pos + 1
+        if length & 0xC0 == 0xC0:
+            return pos + 2
+        pos += 1 + length
+
+
+def response_ttl(data):
+    """Cache lifetime of a response and the offsets of its TTL fields
+
+    Returns (ttl, offsets), or (None, ()) if the response must not be cached:
+    truncated, an error other than NXDOMAIN, or nothing to take a TTL from.
+    Positive answers live for their smallest answer TTL, negative ones for
+    the SOA record's TTL in the authority section.
+    """
+    ident, flags, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(data)
+    if flags & 0x0200 or flags & 0x000F not in (0, RCODE_NXDOMAIN):
+        return None, ()
+    pos = 12
+    for _ in range(qdcount):
+        pos = _skip_name(data, pos) + 4
+    ttl = None
+    offsets = []
+    for index in range(ancount + nscount + arcount):
+        pos = _skip_name(data, pos)
+        rtype, rclass, record_ttl, rdlength = _RR.unpack_from(data, pos)
+        # OPT's "TTL" holds EDNS flags
+        if rtype != TYPE_OPT:
+            offsets.append(pos + 4)
+            if index < ancount or (index < ancount + nscount and rtype == TYPE_SOA and not ancount):
+                ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+        pos += _RR.size + rdlength
+    if not ttl:
+        return None, ()
+    return min(ttl, MAX_CACHE_TTL), tuple(offsets)
+
+
+def blocked_response(query, end, qtype, address4=SINKHOLE_ADDRESS, address6=SINKHOLE_ADDRESS6, ttl=BLOCKED_TTL):
+    """Answer a blocked name: the sinkhole address for A/AAAA, an empty answer otherwise"""
+    flags = _HEADER.unpack_from(query)[1]
+    if qtype == TYPE_A:
+        rdata = socket.inet_pton(socket.AF_INET, address4)
+    elif qtype == TYPE_AAAA:
+        rdata = socket.inet_pton(socket.AF_INET6, address6)
+    else:
+        rdata = None
+    # QR, authoritative, recursion available; opcode and RD echoed
+    header = _HEADER.pack(_HEADER.unpack_from(query)[0], 0x8480 | (flags & 0x7900), 1,
+                          1 if rdata else 0, 0, 0)
+    if rdata is None:
+        return header + query[12:end]
+    # The answer's name is a pointer to the question at offset 12
+    return header + query[12:end] + b"\xc0\x0c" + _RR.pack(qtype, CLASS_IN, ttl, len(rdata)) + rdata
+
+
+def error_response(query, end, rcode):
+    """Answer with just an rcode, echoing the question if it could be parsed"""
+    ident, flags = struct.unpack_from("!HH", query)
+    return _HEADER.pack(ident, 0x8080 | (flags & 0x7900) | rcode, 1 if end else 0, 0, 0, 0) + query[12:end]
+
+
+# ==================== CACHE ====================
+
+class ResponseCache:
+    """LRU of upstream responses keyed by question
+
+    A hit is the stored response with the client's ID and question bytes
+    (0x20 case randomization survives) and every TTL counted down by the
+    time it spent in the cache.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, key, query, end, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, stored, response, offsets = entry
+        if now >= expires:
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        out = bytearray(response)
+        out[0:2] = query[0:2]
+        out[12:end] = query[12:end]
+        elapsed = int(now - stored)
+        if elapsed:
+            for offset in offsets:
+                _TTL.pack_into(out, offset, max(_TTL.unpack_from(out, offset)[0] - elapsed, 0))
+        return bytes(out)
+
+    def put(self, key, response, now):
+        try:
+            ttl, offsets = response_ttl(response)
+        except (IndexError, struct.error):
+            return
+        if ttl is None:
+            return
+        self._entries[key] = (now + ttl, now, response, offsets)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+# ==================== SERVER ====================
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, sinkhole):
+        self._sinkhole = sinkhole
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        response = self._sinkhole.answer_local(data, addr[0])
+        if response is not None:
+            self.transport.sendto(response, addr)
+        elif len(data) >= 12 and not data[2] & 0x80:
+            self._sinkhole._spawn(self._sinkhole.forward_udp(data, addr, self.transport))
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, sinkhole):
+        self._sinkhole = sinkhole
+
+    def datagram_received(self, data, addr):
+        self._sinkhole._upstream_reply(data)
+
+    def error_received(self, exc):
+        log.warning("Upstream socket error: %s", exc)
+
+
+class DNSSinkhole:
+    """DNS front end answering blocked names from memory and forwarding the rest
+
+    match(name, client_ip) is called for every query and returns a truthy
+    value (the blocking policy) if name is blocked for that client. Forwarded
+    UDP queries for the same question share one upstream query while it is
+    in flight. Runs its own event loop, in a thread when start()ed.
+    """
+
+    def __init__(self, match, upstream, address="0.0.0.0", port=53, cache_size=CACHE_SIZE,
+                 timeout=UPSTREAM_TIMEOUT, sinkhole=SINKHOLE_ADDRESS, sinkhole6=SINKHOLE_ADDRESS6):
+        self.match = match
+        self.upstream = upstream
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.sinkhole = sinkhole
+        self.sinkhole6 = sinkhole6
+        self.cache = ResponseCache(cache_size)
+        self._loop = None
+        self._thread = None
+        self._udp = None
+        self._tcp = None
+        self._upstream = None
+        self._pending = {}
+        self._inflight = {}
+        self._tasks = set()
+        self.stats = {
+            "queries": 0,
+            "blocked": 0,
+            "forwarded": 0,
+            "coalesced": 0,
+            "tcp_queries": 0,
+            "upstream_timeouts": 0,
+            "servfail": 0,
+            "formerr": 0,
+        }
+
+    # ---- query path ----
+
+    def answer_local(self, data, client):
+        """Answer from the policy index or the cache; None means forward upstream
+
+        Messages that are not queries get no answer at all, which the
+        caller recognizes because they are responses or shorter than a header.
+        """
+        if len(data) < 12 or data[2] & 0x80:
+            return None
+        self.stats["queries"] += 1
+        try:
+            name, qtype, qclass, end = parse_question(data)
+        except ValueError:
+            self.stats["formerr"] += 1
+            return error_response(data, 0, RCODE_FORMERR)
+        if self.match(name, client):
+            self.stats["blocked"] += 1
+            return blocked_response(data, end, qtype, self.sinkhole, self.sinkhole6)
+        return self.cache.get((name, qtype, qclass, len(data) > end), data, end, self._loop.time())
+
+    def _spawn(self, coroutine):
+        task = self._loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _upstream_reply(self, data):
+        if len(data) < 12:
+            return
+        ident = struct.unpack_from("!H", data)[0]
+        pending = self._pending.get(ident)
+        # Only a reply to the exact question sent counts, not just a matching ID
+        if pending is None or data[12:12 + len(pending[1])] != pending[1]:
+            return
+        del self._pending[ident]
+        if not pending[0].done():
+            pending[0].set_result(data)
+
+    async def _query_upstream(self, data, end):
+        """Send one UDP query upstream under a fresh random ID; returns the raw reply"""
+        while True:
+            ident = random.getrandbits(16)
+            if ident not in self._pending:
+                break
+        future = self._loop.create_future()
+        self._pending[ident] = (future, data[12:end])
+        self._upstream.sendto(struct.pack("!H", ident) + data[2:])
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(ident, None)
+
+    def _upstream_done(self, key, task):
+        del self._inflight[key]
+        if not task.cancelled() and task.exception() is None:
+            self.cache.put(key, task.result(), self._loop.time())
+
+    async def forward_udp(self, data, addr, transport):
+        name, qtype, qclass, end = parse_question(data)
+        key = (name, qtype, qclass, len(data) > end)
+        upstream = self._inflight.get(key)
+        if upstream is None:
+            self.stats["forwarded"] += 1
+            upstream = self._inflight[key] = self._loop.create_task(self._query_upstream(data, end))
+            upstream.add_done_callback(lambda task: self._upstream_done(key, task))
+        else:
+            self.stats["coalesced"] += 1
+        try:
+            reply = await asyncio.shield(upstream)
+        except (asyncio.TimeoutError, OSError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["upstream_timeouts"] += 1
+            self.stats["servfail"] += 1
+            transport.sendto(error_response(data, end, RCODE_SERVFAIL), addr)
+            return
+        response = bytearray(reply)
+        response[0:2] = data[0:2]
+        response[12:end] = data[12:end]
+        transport.sendto(bytes(response), addr)
+
+    async def forward_tcp(self, data):
+        """Forward one query over a new TCP connection; returns the reply with the client's ID"""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.upstream), self.timeout)
+        try:
+            writer.write(struct.pack("!H", len(data)) + data)
+            length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), self.timeout))[0]
+            return await asyncio.wait_for(reader.readexactly(length), self.timeout)
+        finally:
+            writer.close()
+
+    async def _serve_tcp(self, reader, writer):
+        client = writer.get_extra_info("peername")[0]
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            while True:
+                try:
+                    length = struct.unpack("!H", await reader.readexactly(2))[0]
+                    data = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                self.stats["tcp_queries"] += 1
+                response = self.answer_local(data, client)
+                if response is None:
+                    if len(data) < 12 or data[2] & 0x80:
+                        continue
+                    self.stats["forwarded"] += 1
+                    try:
+                        response = await self.forward_tcp(data)
+                    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                        self.stats["servfail"] += 1
+                        response = error_response(data, parse_question(data)[3], RCODE_SERVFAIL)
+                writer.write(struct.pack("!H", len(response)) + response)
+                await writer.drain()
+        except asyncio.CancelledError:
+            # Shutting down; ending normally keeps asyncio's stream callback from
+            # reporting the cancellation as an error
+            pass
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    # ---- lifecycle ----
+
+    async def open(self):
+        """Bind the UDP and TCP listeners and the upstream socket on the running loop"""
+        self._loop = asyncio.get_running_loop()
+        self._udp, _ = await self._loop.create_datagram_endpoint(
+            lambda: _ClientProtocol(self), local_addr=(self.address, self.port))
+        if self.port == 0:
+            # Let TCP share the port the kernel picked for UDP
+            self.port = self._udp.get_extra_info("sockname")[1]
+        self._tcp = await asyncio.start_server(self._serve_tcp, self.address, self.port, reuse_address=True)
+        self._upstream, _ = await self._loop.create_datagram_endpoint(
+            lambda: _UpstreamProtocol(self), remote_addr=self.upstream)
+        log.info("DNS sinkhole on %s:%d, forwarding to %s:%d", self.address, self.port, *self.upstream)
+
+    async def close(self):
+        tasks = list(self._tasks) + list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tcp.close()
+        await self._tcp.wait_closed()
+        self._udp.close()
+        self._upstream.close()
+
+    def start(self):
+        """Run in a background thread; returns once the sockets are bound (or raises why not)"""
+        ready = threading.Event()
+        failure = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.open())
+            except BaseException as e:
+                failure.append(e)
+                ready.set()
+                loop.close()
+                return
+            ready.set()
+            loop.run_forever()
+            loop.run_until_complete(self.close())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, name="dns-sinkhole", daemon=True)
+        self._thread.start()
+        ready.wait()
+        if failure:
+            self._thread = None
+            raise failure[0]
+
+    def stop(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["cache_hits"] = self.cache.hits
+        stats["cache_misses"] = self.cache.misses
+        stats["cached"] = len(self.cache)
+        stats["in_flight"] = len(self._pending)
+        return stats
+
+
+def main():
+    """Run the sinkhole on its own with a blocklist file (one domain per line)"""
+    from domain_trie import DomainTrie
+    from logs import setup_logging
+
+    parser = argparse.ArgumentParser(description="SEER DNS sinkhole")
+    parser.add_argument("--address", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=53)
+    parser.add_argument("--upstream", default="127.0.0.1:5353", help="resolver for names that are not blocked")
+    parser.add_argument("--blocklist", help="file with one blocked domain per line")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE)
+    args = parser.parse_args()
+    setup_logging()
+
+    trie = DomainTrie()
+    if args.blocklist:
+        with open(args.blocklist, "r") as f:
+            for line in f:
+                domain = line.split("#", 1)[0].strip().lower()
+                if domain:
+                    trie.insert(domain)
+    sinkhole = DNSSinkhole(lambda name, client: trie.match(name), parse_upstream(args.upstream),
+                           args.address, args.port, args.cache_size)
+
+    async def serve():
+        await sinkhole.open()
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER domain suffix trie
+Reversed-label trie for wildcard/subdomain policy matching
+"""
+
+import sys
+
+# Key under which an interior node stores its own value ("" is never a label)
+_END = ""
+_MISSING = object()
+
+
+class _Leaf:
+    """Wrapper for leaf values that would be mistaken for an interior node"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _wrap(value):
+    return _Leaf(value) if value.__class__ is dict or value.__class__ is _Leaf else value
+
+
+def _unwrap(child):
+    return child.value if child.__class__ is _Leaf else child
+
+
+class DomainTrie:
+    """Map domains to values and match names against them with subdomain semantics
+
+    Labels are stored right to left (com -> facebook -> m), so a lookup walks
+    at most one node per label of the queried name: an entry for facebook.com
+    covers m.facebook.com and www.m.facebook.com, just like dnsmasq's
+    address=/.facebook.com/ wildcard. Only nodes with children are dicts;
+    a childless entry is stored as its bare value in the parent dict, and
+    labels are interned, to keep 1M-entry tries affordable.
+    """
+
+    __slots__ = ("_root", "_size")
+
+    def __init__(self, items=()):
+        self._root = {}
+        self._size = 0
+        for domain, value in items:
+            self.insert(domain, value)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, domain):
+        return self.get(domain, _MISSING) is not _MISSING
+
+    @staticmethod
+    def _labels(domain):
+        labels = domain.lower().rstrip(".").split(".")
+        labels.reverse()
+        return labels
+
+    def insert(self, domain, value=True):
+        """Add or replace an exact domain; returns True if it was new"""
+        labels = self._labels(domain)
+        node = self._root
+        for label in labels[:-1]:
+            child = node.get(label, _MISSING)
+            if child is _MISSING:
+                child = node[sys.intern(label)] = {}
+            elif child.__class__ is not dict:
+                child = node[label] = {_END: child}
+            node = child
+
+        last = labels[-1]
+        child = node.get(last, _MISSING)
+        if child is _MISSING:
+            node[sys.intern(last)] = _wrap(value)
+        elif child.__class__ is not dict:
+            node[last] = _wrap(value)
+            return False
+        else:
+            new = _END not in child
+            child[_END] = _wrap(value)
+            if not new:
+                return False
+        self._size += 1
+        return True
+
+    def remove(self, domain):
+        """Remove an exact domain; returns True if it was present"""
+        path = []
+        node = self._root
+        labels = self._labels(domain)
+        for label in labels[:-1]:
+            child = node.get(label, _MISSING)
+            if child is _MISSING or child.__class__ is not dict:
+                return False
+            path.append((node, label))
+            node = child
+
+        last = labels[-1]
+        child = node.get(last, _MISSING)
+        if child is _MISSING:
+            return False
+        if child.__class__ is not dict:
+            del node[last]
+        elif _END in child:
+            del child[_END]
+            if not child:
+                del node[last]
+        else:
+            return False
+        self._size -= 1
+
+        # Prune interior nodes left empty, and collapse {_END: value} back into a leaf
+        while path:
+            parent, label = path.pop()
+            if not node:
+                del parent[label]
+            elif len(node) == 1 and _END in node:
+                parent[label] = node[_END]
+            else:
+                break
+            node = parent
+        return True
+
+    def get(self, domain, default=None):
+        """Value stored for exactly this domain"""
+        node = self._root
+        for label in self._labels(domain):
+            if node.__class__ is not dict:
+                return default
+            node = node.get(label, _MISSING)
+            if node is _MISSING:
+                return default
+        if node.__class__ is not dict:
+            return _unwrap(node)
+        if _END in node:
+            return _unwrap(node[_END])
+        return default
+
+    def match(self, name):
+        """Most specific entry covering name (itself or a parent); returns (domain, value) or None"""
+        node = self._root
+        labels = self._labels(name)
+        found = _MISSING
+        found_depth = 0
+        for depth, label in enumerate(labels, 1):
+            node = node.get(label, _MISSING)
+            if node is _MISSING:
+                break
+            if node.__class__ is not dict:
+                found, found_depth = node, depth
+                break
+            if _END in node:
+                found, found_depth = node[_END], depth
+        if found is _MISSING:
+            return None
+        return ".".join(reversed(labels[:found_depth])), _unwrap(found)
+
+    def covering(self, name):
+        """Least specific strict parent of name that is present, or None"""
+        node = self._root
+        labels = self._labels(name)
+        for depth, label in enumerate(labels[:-1], 1):
+            node = node.get(label, _MISSING)
+            if node is _MISSING:
+                return None
+            if node.__class__ is not dict or _END in node:
+                return ".".join(reversed(labels[:depth]))
+        return None
+
+    def items(self):
+        """All (domain, value) pairs"""
+        stack = [(self._root, ())]
+        while stack:
+            node, suffix = stack.pop()
+            for label, child in node.items():
+                if label == _END:
+                    yield ".".join(reversed(suffix)), _unwrap(child)
+                elif child.__class__ is not dict:
+                    yield ".".join(reversed(suffix + (label,))), _unwrap(child)
+                else:
+                    stack.append((child, suffix + (label,)))
+
+    def minimal(self):
+        """(domain, value) pairs not already covered by a parent entry"""
+        stack = [(self._root, ())]
+        while stack:
+            node, suffix = stack.pop()
+            for label, child in node.items():
+                path = suffix + (label,)
+                if child.__class__ is not dict:
+                    yield ".".join(reversed(path)), _unwrap(child)
+                elif _END in child:
+                    # Everything below is covered by this entry
+                    yield ".".join(reversed(path)), _unwrap(child[_END])
+                else:
+                    stack.append((child, path))
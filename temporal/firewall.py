@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER firewall backend
+Blocked device MACs/IPs kept in kernel sets behind one DROP rule per chain,
+changed with one atomic nft -f (or ipset restore) batch; plain iptables
+rules in a chain of their own where neither is installed
+
+Dry run: python3 firewall.py [--backend nft|ipset|iptables] [--full] mac[=ip] ...
+"""
+
+import argparse
+import shutil
+import subprocess
+
+from logs import get_logger
+
+log = get_logger("firewall")
+
+NFT_TABLE = "seer"
+NFT_PRIORITY = -5
+NFT_SETS = (("blocked_macs", "ether_addr"), ("blocked_ipv4", "ipv4_addr"), ("blocked_ipv6", "ipv6_addr"))
+IPSET_PREFIX = "seer_blocked"
+IPTABLES_CHAIN = "SEER_BLOCKED"
+CHAINS = ("INPUT", "FORWARD")
+
+
+def _family(ip):
+    return "ipv6" if ":" in ip else "ipv4"
+
+
+def _run(args, script=None):
+    """Run a command, feeding script on stdin; returns (ok, stderr)"""
+    try:
+        result = subprocess.run(args, input=script, check=False, text=True,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        return False, "%s not found" % args[0]
+    return result.returncode == 0, result.stderr.strip()
+
+
+def remove_legacy_rules(mac, ip=None):
+    """Delete per-device iptables rules left by the old dhcp scripts"""
+    rules = [["-m", "mac", "--mac-source", mac, "-j", "DROP"]]
+    if ip:
+        rules.append(["-s", ip, "-j", "DROP"])
+    for rule in rules:
+        for chain in CHAINS:
+            _run(["iptables", "-D", chain] + rule)
+
+
+class FirewallBackend:
+    """Blocked devices as {mac: ip}, mirrored into kernel sets in batches
+
+    Subclasses render a full ruleset (sync) or an incremental add/remove
+    batch; each batch is handed to the kernel in one transaction. With
+    dry_run the rendered batch is only recorded, so nothing needs root.
+    """
+
+    name = None
+    command = None
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self._devices = {}
+        self._synced = False
+        self.last_script = None
+        self.stats = {"transactions": 0, "failures": 0, "resyncs": 0}
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, mac):
+        return mac in self._devices
+
+    def render_full(self, devices):
+        raise NotImplementedError
+
+    def render_changes(self, added, removed):
+        raise NotImplementedError
+
+    def _execute(self, script):
+        self.last_script = script
+        self.stats["transactions"] += 1
+        if self.dry_run:
+            return True
+        ok, error = _run(self.command, script)
+        if not ok:
+            self.stats["failures"] += 1
+            log.error("%s batch failed: %s", self.name, error)
+        return ok
+
+    def sync(self, devices):
+        """Replace the whole ruleset with exactly these {mac: ip} devices"""
+        self._devices = dict(devices)
+        self._synced = self._execute(self.render_full(self._devices))
+        return self._synced
+
+    def apply(self, add=None, remove=()):
+        """Block {mac: ip} devices and unblock macs in one transaction"""
+        added = {mac: ip for mac, ip in (add or {}).items() if self._devices.get(mac, False) != ip}
+        # Only elements known to be in the set can be deleted without failing the batch
+        removed = {mac: self._devices[mac] for mac in remove if mac in self._devices and mac not in added}
+        # A re-block with a new IP replaces the old element
+        replaced = {mac: self._devices[mac] for mac in added if mac in self._devices}
+        if not added and not removed:
+            return True
+
+        for mac in removed:
+            del self._devices[mac]
+        self._devices.update(added)
+        if not self._synced:
+            return self.sync(self._devices)
+        removed.update(replaced)
+        if self._execute(self.render_changes(added, removed)):
+            return True
+        # The kernel state drifted (rules flushed by hand, reboot...): rebuild it
+        self.stats["resyncs"] += 1
+        return self.sync(self._devices)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["backend"] = self.name
+        stats["devices"] = len(self._devices)
+        stats["dry_run"] = self.dry_run
+        return stats
+
+
+class NftablesBackend(FirewallBackend):
+    """inet table with ether_addr/ipv4_addr/ipv6_addr sets, applied with nft -f -"""
+
+    name = "nftables"
+    command = ["nft", "-f", "-"]
+
+    @staticmethod
+    def _sets(devices):
+        sets = {"blocked_macs": [], "blocked_ipv4": [], "blocked_ipv6": []}
+        for mac, ip in devices.items():
+            sets["blocked_macs"].append(mac)
+            if ip:
+                sets["blocked_" + _family(ip)].append(ip)
+        return sets
+
+    def render_full(self, devices):
+        out = [
+            # "add" then "delete" succeeds whether or not the table exists,
+            # and the whole file is applied as one transaction
+            "add table inet %s" % NFT_TABLE,
+            "delete table inet %s" % NFT_TABLE,
+            "table inet %s {" % NFT_TABLE,
+        ]
+        sets = self._sets(devices)
+        for name, kind in NFT_SETS:
+            elements = sets[name]
+            out.append("    set %s {" % name)
+            out.append("        type %s" % kind)
+            if elements:
+                out.append("        elements = { %s }" % ", ".join(elements))
+            out.append("    }")
+        for chain in CHAINS:
+            out.extend([
+                "    chain %s {" % chain.lower(),
+                "        type filter hook %s priority %d; policy accept;" % (chain.lower(), NFT_PRIORITY),
+                "        ether saddr @blocked_macs drop",
+                "        ip saddr @blocked_ipv4 drop",
+                "        ip6 saddr @blocked_ipv6 drop",
+                "    }",
+            ])
+        out.append("}")
+        return "\n".join(out) + "\n"
+
+    def render_changes(self, added, removed):
+        out = []
+        for verb, devices in (("delete", removed), ("add", added)):
+            for name, elements in self._sets(devices).items():
+                if elements:
+                    out.append("%s element inet %s %s { %s }" % (verb, NFT_TABLE, name, ", ".join(elements)))
+        return "\n".join(out) + "\n"
+
+
+class IpsetBackend(FirewallBackend):
+    """hash:mac/hash:ip sets applied with ipset restore, matched by one iptables rule per chain"""
+
+    name = "ipset"
+    command = ["ipset", "restore", "-exist"]
+
+    def __init__(self, dry_run=False):
+        super().__init__(dry_run)
+        self._rules_installed = False
+
+    @staticmethod
+    def _sets(devices):
+        sets = {IPSET_PREFIX + "_macs": [], IPSET_PREFIX + "_ipv4": [], IPSET_PREFIX + "_ipv6": []}
+        for mac, ip in devices.items():
+            sets[IPSET_PREFIX + "_macs"].append(mac)
+            if ip:
+                sets["%s_%s" % (IPSET_PREFIX, _family(ip))].append(ip)
+        return sets
+
+    def render_full(self, devices):
+        types = {"macs": "hash:mac", "ipv4": "hash:ip family inet", "ipv6": "hash:ip family inet6"}
+        out = []
+        for name, elements in self._sets(devices).items():
+            kind = types[name.rsplit("_", 1)[1]]
+            # Fill a scratch set and swap it in, so the live set is never empty mid-sync
+            out.append("create %s %s" % (name, kind))
+            out.append("create %s_new %s" % (name, kind))
+            out.append("flush %s_new" % name)
+            out.extend("add %s_new %s" % (name, element) for element in elements)
+            out.append("swap %s_new %s" % (name, name))
+            out.append("destroy %s_new" % name)
+        return "\n".join(out) + "\n"
+
+    def render_changes(self, added, removed):
+        out = []
+        for verb, devices in (("del", removed), ("add", added)):
+            for name, elements in self._sets(devices).items():
+                out.extend("%s %s %s" % (verb, name, element) for element in elements)
+        return "\n".join(out) + "\n"
+
+    def render_rules(self):
+        """iptables-restore input with the single set-matching DROP rule per chain and family"""
+        tables = {"iptables": ["*filter"], "ip6tables": ["*filter"]}
+        for chain in CHAINS:
+            tables["iptables"].append("-I %s -m set --match-set %s_macs src -j DROP" % (chain, IPSET_PREFIX))
+            tables["iptables"].append("-I %s -m set --match-set %s_ipv4 src -j DROP" % (chain, IPSET_PREFIX))
+            tables["ip6tables"].append("-I %s -m set --match-set %s_macs src -j DROP" % (chain, IPSET_PREFIX))
+            tables["ip6tables"].append("-I %s -m set --match-set %s_ipv6 src -j DROP" % (chain, IPSET_PREFIX))
+        return {tool: "\n".join(lines + ["COMMIT"]) + "\n" for tool, lines in tables.items()}
+
+    def sync(self, devices):
+        ok = super().sync(devices)
+        if ok and not self._rules_installed and not self.dry_run:
+            # The rules never change, so they are installed once; -C avoids duplicates after a restart
+            probe = ["-C", CHAINS[0], "-m", "set", "--match-set", IPSET_PREFIX + "_macs", "src", "-j", "DROP"]
+            for tool, script in self.render_rules().items():
+                if not _run([tool] + probe)[0]:
+                    _run([tool + "-restore", "--noflush"], script)
+            self._rules_installed = True
+        return ok
+
+
+class IptablesBackend(FirewallBackend):
+    """Per-device DROP rules in one chain jumped to from INPUT and FORWARD, applied with iptables-restore
+
+    For routers with iptables but neither nft nor ipset. Rules are matched
+    one by one, so this scales worse than the sets, but a batch is still
+    one iptables-restore transaction. IPv4 only, like the rules of the
+    dhcp scripts it replaces.
+    """
+
+    name = "iptables"
+    command = ["iptables-restore", "--noflush"]
+
+    def __init__(self, dry_run=False):
+        super().__init__(dry_run)
+        self._jumps_installed = False
+
+    @staticmethod
+    def _rules(devices):
+        rules = []
+        for mac, ip in devices.items():
+            rules.append("%s -m mac --mac-source %s -j DROP" % (IPTABLES_CHAIN, mac))
+            if ip and _family(ip) == "ipv4":
+                rules.append("%s -s %s -j DROP" % (IPTABLES_CHAIN, ip))
+        return rules
+
+    def render_full(self, devices):
+        # Declaring the chain creates it, or empties it under --noflush
+        out = ["*filter", ":%s - [0:0]" % IPTABLES_CHAIN]
+        out.extend("-A " + rule for rule in self._rules(devices))
+        out.append("COMMIT")
+        return "\n".join(out) + "\n"
+
+    def render_changes(self, added, removed):
+        out = ["*filter"]
+        out.extend("-D " + rule for rule in self._rules(removed))
+        out.extend("-A " + rule for rule in self._rules(added))
+        out.append("COMMIT")
+        return "\n".join(out) + "\n"
+
+    def sync(self, devices):
+        ok = super().sync(devices)
+        if ok and not self._jumps_installed and not self.dry_run:
+            # -C avoids a second jump after a restart
+            for chain in CHAINS:
+                if not _run(["iptables", "-C", chain, "-j", IPTABLES_CHAIN])[0]:
+                    _run(["iptables", "-I", chain, "-j", IPTABLES_CHAIN])
+            self._jumps_installed = True
+        return ok
+
+
+BACKENDS = {"nft": NftablesBackend, "ipset": IpsetBackend, "iptables": IptablesBackend}
+
+
+def create_backend(name="auto", dry_run=False):
+    """Pick nftables when available, then ipset, then plain iptables
+
+    With none of them installed, the backend is a dry run: blocks are
+    recorded but not enforced, and callers must check dry_run.
+    """
+    if name == "auto":
+        name = next((name for name, tool in (("nft", "nft"), ("ipset", "ipset"), ("iptables", "iptables-restore"))
+                     if shutil.which(tool)), None)
+        if name is None:
+            log.error("None of nft, ipset or iptables found - device blocks cannot be enforced")
+            return NftablesBackend(dry_run=True)
+    return BACKENDS[name](dry_run=dry_run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the firewall batch for a set of blocked devices")
+    parser.add_argument("devices", nargs="*", help="mac or mac=ip")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="nft")
+    parser.add_argument("--full", action="store_true", help="render a full sync instead of an add batch")
+    args = parser.parse_args()
+
+    devices = dict((item.split("=", 1) + [None])[:2] for item in args.devices)
+    backend = BACKENDS[args.backend](dry_run=True)
+    if args.full:
+        backend.sync(devices)
+    else:
+        backend.sync({})
+        backend.apply(add=devices)
+    print(backend.last_script, end="")
+    if isinstance(backend, IpsetBackend) and args.full:
+        for tool, script in backend.render_rules().items():
+            print("# %s-restore --noflush\n%s" % (tool, script), end="")
+
+
+if __name__ == "__main__":
+    main()
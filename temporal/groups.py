@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER device groups
+Source-scoped DNS policies: devices are tagged by group in dnsmasq's DHCP
+host file, each tag is handed its group's resolver as DNS server, and each
+group's resolver holds only that group's blocklist
+"""
+
+import ipaddress
+import os
+import re
+import threading
+
+from device_blocks import normalize_mac
+from logs import get_logger
+
+log = get_logger("groups")
+
+# Files for the main dnsmasq (both re-read on SIGHUP) and one resolver
+# config per group, outside dnsmasq.d so the main instance does not load them
+GROUP_DIR = "/etc/seer/dnsmasq"
+HOSTS_FILE_NAME = "group-hosts"
+OPTS_FILE_NAME = "group-opts"
+
+TAG_PREFIX = "seer_"
+# Group resolvers forward everything they do not block to the main dnsmasq,
+# so board-wide blocks apply to grouped devices too
+UPSTREAM = "127.0.0.1"
+
+_NAME_RE = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+
+
+def normalize_group(name):
+    """Lowercase group name usable in a dnsmasq tag and a unit name; raises ValueError"""
+    value = str(name or "").strip().lower()
+    if not _NAME_RE.match(value):
+        raise ValueError("Invalid group name: %r" % (name,))
+    return value
+
+
+class DeviceGroup:
+    """A named set of devices sharing one resolver address"""
+
+    __slots__ = ("name", "address", "members")
+
+    def __init__(self, name, address, members=None):
+        self.name = name
+        self.address = address
+        # mac -> ip seen when the device was assigned (informational)
+        self.members = members if members is not None else {}
+
+    @property
+    def tag(self):
+        return TAG_PREFIX + self.name
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "address": self.address,
+            "tag": self.tag,
+            "members": [{"mac": mac, "ip": ip} for mac, ip in sorted(self.members.items())],
+        }
+
+
+class DeviceGroupManager:
+    """Group definitions and memberships, persisted in the database
+
+    The dnsmasq side is three kinds of text rendered from this state:
+    the main instance's dhcp-hostsfile (one "mac,set:tag" line per grouped
+    device), its dhcp-optsfile (one dns-server option per group) and a
+    resolver config per group. A device is in at most one group, so moving
+    it changes one line of the host file and nothing else.
+    """
+
+    def __init__(self, storage, directory=GROUP_DIR, upstream=UPSTREAM):
+        self._storage = storage
+        self.directory = directory
+        self.upstream = upstream
+        self._lock = threading.Lock()
+        self._groups = {}
+        self._group_of = {}
+
+    @property
+    def hosts_file(self):
+        return os.path.join(self.directory, HOSTS_FILE_NAME)
+
+    @property
+    def opts_file(self):
+        return os.path.join(self.directory, OPTS_FILE_NAME)
+
+    def resolver_file(self, name):
+        return os.path.join(self.directory, "%s.conf" % name)
+
+    def load(self):
+        """Restore groups and memberships from the database"""
+        groups = {}
+        for row in self._storage.load_groups():
+            groups[row["name"]] = DeviceGroup(row["name"], row["address"], dict(row["members"]))
+        with self._lock:
+            self._groups = groups
+            self._group_of = dict((mac, group.name) for group in groups.values() for mac in group.members)
+        log.info("%d device group(s), %d grouped device(s)", len(groups), len(self._group_of))
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._groups
+
+    def __len__(self):
+        with self._lock:
+            return len(self._groups)
+
+    def names(self):
+        with self._lock:
+            return sorted(self._groups)
+
+    def group_of(self, mac):
+        with self._lock:
+            return self._group_of.get(normalize_mac(mac))
+
+    def define(self, name, address):
+        """Create a group or change its resolver address; returns the group"""
+        name = normalize_group(name)
+        try:
+            address = str(ipaddress.ip_address(str(address or "").strip()))
+        except ValueError:
+            raise ValueError("Invalid resolver address: %r" % (address,))
+        with self._lock:
+            for other in self._groups.values():
+                if other.address == address and other.name != name:
+                    raise ValueError("%s is already the resolver of group %s" % (address, other.name))
+            self._storage.save_group(name, address)
+            group = self._groups.get(name)
+            if group is None:
+                group = self._groups[name] = DeviceGroup(name, address)
+            else:
+                group.address = address
+        log.info("Group %s resolves via %s", name, address)
+        return group
+
+    def remove(self, name):
+        """Delete a group and its memberships; returns the MACs that were in it"""
+        name = normalize_group(name)
+        with self._lock:
+            group = self._groups.get(name)
+            if group is None:
+                raise ValueError("Unknown group: %s" % name)
+            self._storage.delete_group(name)
+            del self._groups[name]
+            for mac in group.members:
+                self._group_of.pop(mac, None)
+        log.info("Removed group %s (%d device(s))", name, len(group.members))
+        return sorted(group.members)
+
+    def assign(self, name, devices):
+        """Put (mac, ip) devices in a group, moving them out of any other; returns the MACs that moved"""
+        name = normalize_group(name)
+        devices = [(normalize_mac(mac), ip or None) for mac, ip in devices]
+        with self._lock:
+            group = self._groups.get(name)
+            if group is None:
+                raise ValueError("Unknown group: %s" % name)
+            moved = [mac for mac, ip in devices if self._group_of.get(mac) != name]
+            self._storage.save_group_members((mac, name, ip) for mac, ip in devices)
+            for mac, ip in devices:
+                previous = self._group_of.get(mac)
+                if previous is not None and previous != name:
+                    self._groups[previous].members.pop(mac, None)
+                group.members[mac] = ip
+                self._group_of[mac] = name
+        if moved:
+            log.info("Assigned %d device(s) to %s", len(moved), name)
+        return moved
+
+    def unassign(self, macs):
+        """Take devices out of their groups; returns the MACs that were grouped"""
+        macs = [normalize_mac(mac) for mac in macs]
+        with self._lock:
+            grouped = [mac for mac in macs if mac in self._group_of]
+            self._storage.delete_group_members(grouped)
+            for mac in grouped:
+                self._groups[self._group_of.pop(mac)].members.pop(mac, None)
+        return grouped
+
+    # ---- rendering ----
+
+    def render_hosts(self):
+        """dhcp-hostsfile: the tag for each grouped device, sorted so unrelated moves leave lines alone"""
+        with self._lock:
+            return "".join("%s,set:%s%s\n" % (mac, TAG_PREFIX, name) for mac, name in sorted(self._group_of.items()))
+
+    def render_opts(self):
+        """dhcp-optsfile: each group's resolver as the DNS server of its tag"""
+        with self._lock:
+            return "".join("tag:%s,option:dns-server,%s\n" % (group.tag, group.address)
+                           for _, group in sorted(self._groups.items()))
+
+    def render_main_conf(self):
+        """Include for the main dnsmasq; only changes if GROUP_DIR moves"""
+        return (
+            "# SEER device groups - managed by temporal_policy.py\n"
+            "# Both files are re-read on SIGHUP, so membership changes need no restart\n"
+            "dhcp-hostsfile=%s\n"
+            "dhcp-optsfile=%s\n" % (self.hosts_file, self.opts_file)
+        )
+
+    def render_resolver_header(self, name):
+        """Head of a group resolver's config; the group's address= lines follow it"""
+        with self._lock:
+            group = self._groups[name]
+            address = group.address
+        return (
+            "# SEER resolver for group %s - managed by temporal_policy.py\n"
+            "# Devices tagged %s get %s as DNS server; run as seer-dns@%s\n"
+            "listen-address=%s\n"
+            "bind-interfaces\n"
+            "no-resolv\n"
+            "no-hosts\n"
+            "server=%s\n\n" % (name, TAG_PREFIX + name, address, name, address, self.upstream)
+        )
+
+    def to_list(self):
+        with self._lock:
+            return [group.to_dict() for _, group in sorted(self._groups.items())]
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "groups": len(self._groups),
+                "grouped_devices": len(self._group_of),
+            }
@@ -6,6 +6,7 @@ set -euo pipefail
 
 TEMPDIR=/usr/local/bin/temporal
 UNIT_PATH=/etc/systemd/system/temporal-policy.service
+SOCKET_PATH=/etc/systemd/system/temporal-policy.socket
 
 echo "1) Ensuring folder exists: $TEMPDIR"
 if [ ! -d "$TEMPDIR" ]; then
@@ -18,16 +19,33 @@ chown -R root:root "$TEMPDIR"
 find "$TEMPDIR" -type f -name "*.py" -exec chmod 755 {} \;
 find "$TEMPDIR" -type f -name "*.sh" -exec chmod 755 {} \;
 
-echo "3) Writing systemd unit to $UNIT_PATH"
+echo "3) Writing systemd units to $SOCKET_PATH and $UNIT_PATH"
+# systemd holds the API socket, so requests made during a restart wait instead of failing
+cat > "$SOCKET_PATH" <<'UNIT'
+[Unit]
+Description=SEER Temporal Policy Backend API socket
+
+[Socket]
+ListenStream=127.0.0.1:1889
+FileDescriptorName=http
+
+[Install]
+WantedBy=sockets.target
+UNIT
+
 cat > "$UNIT_PATH" <<'UNIT'
 [Unit]
 Description=SEER Temporal Policy Backend
-After=network.target
+After=network.target temporal-policy.socket
+Requires=temporal-policy.socket
 
 [Service]
-Type=simple
+Type=notify
+NotifyAccess=main
 WorkingDirectory=/usr/local/bin/temporal
 ExecStart=/usr/bin/python3 /usr/local/bin/temporal/temporal_policy.py
+ExecReload=/bin/kill -USR2 $MAINPID
+TimeoutStopSec=30
 Restart=on-failure
 RestartSec=5
 User=root
@@ -37,10 +55,20 @@ Environment=PYTHONUNBUFFERED=1
 WantedBy=multi-user.target
 UNIT
 
+# Template unit for the per-group resolvers; the engine starts the instances
+if [ -f "$TEMPDIR/seer-dns@.service" ]; then
+  echo "3b) Installing seer-dns@.service for device group resolvers"
+  cp "$TEMPDIR/seer-dns@.service" /etc/systemd/system/seer-dns@.service
+  mkdir -p /etc/seer/dnsmasq
+fi
+
 echo "4) Reloading systemd daemon"
 systemctl daemon-reload
 
-echo "5) Enabling and starting the service"
+echo "5) Enabling and starting the socket and the service"
+# An engine started before socket activation still holds the port
+systemctl stop temporal-policy.service 2>/dev/null || true
+systemctl enable --now temporal-policy.socket
 systemctl enable --now temporal-policy.service
 
 echo "6) Status (last few lines)"
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER dnsmasq leases
+Parsed, indexed and cached view of the dnsmasq lease file
+
+Usage: python3 leases.py [--file PATH] show
+       python3 leases.py [--file PATH] remove <mac> [mac ...]
+"""
+
+import argparse
+import json
+import os
+import re
+import tempfile
+import threading
+
+LEASE_FILE = "/var/lib/misc/dnsmasq.leases"
+
+_MAC_RE = re.compile(r"^[0-9a-f]{2}(:[0-9a-f]{2}){5}$")
+
+
+class Lease:
+    """One line of the lease file: <expires> <mac> <ip> <hostname> <client-id>"""
+
+    __slots__ = ("expires", "mac", "ip", "hostname", "client_id")
+
+    def __init__(self, expires, mac, ip, hostname=None, client_id=None):
+        self.expires = expires
+        self.mac = mac
+        self.ip = ip
+        self.hostname = hostname
+        self.client_id = client_id
+
+    @property
+    def static(self):
+        # dnsmasq writes 0 for infinite leases
+        return self.expires == 0
+
+    def to_dict(self):
+        return {
+            "mac": self.mac,
+            "ip": self.ip,
+            "hostname": self.hostname,
+            "expires": self.expires,
+            "static": self.static,
+        }
+
+
+def parse_line(line):
+    """Parse one lease line; returns None for DHCPv6 duid lines and junk"""
+    fields = line.split()
+    if len(fields) < 3 or fields[0] == "duid":
+        return None
+    try:
+        expires = int(fields[0])
+    except ValueError:
+        return None
+    # DHCPv6 lines carry an IAID instead of a MAC in the second field
+    mac = fields[1].lower()
+    if not _MAC_RE.match(mac):
+        mac = None
+    hostname = fields[3] if len(fields) > 3 and fields[3] != "*" else None
+    client_id = fields[4] if len(fields) > 4 and fields[4] != "*" else None
+    return Lease(expires, mac, fields[2], hostname, client_id)
+
+
+class LeaseIndex:
+    """MAC and IP indexes over the lease file, re-parsed only when the file changes
+
+    Every lookup costs one stat(); the file is re-read only when its mtime,
+    size or inode differ from the last parse, so repeated lookups during a
+    request or a batch share one parse instead of grepping the file each time.
+    """
+
+    def __init__(self, path=LEASE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._leases = ()
+        self._by_mac = {}
+        self._by_ip = {}
+        self.stats = {"parses": 0, "lookups": 0, "rewrites": 0, "removed": 0}
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _index(self, leases, stamp):
+        self._leases = tuple(leases)
+        self._by_mac = {}
+        self._by_ip = {}
+        for lease in self._leases:
+            if lease.mac:
+                self._by_mac[lease.mac] = lease
+            self._by_ip[lease.ip] = lease
+        self._stamp = stamp
+
+    def _refresh(self):
+        """Re-parse if the file changed; caller holds the lock"""
+        stamp = self._stat()
+        if stamp == self._stamp:
+            return
+        leases = []
+        if stamp is not None:
+            try:
+                with open(self.path, "r") as f:
+                    leases = [lease for lease in map(parse_line, f) if lease]
+            except FileNotFoundError:
+                stamp = None
+        self._index(leases, stamp)
+        self.stats["parses"] += 1
+
+    def exists(self):
+        return self._stat() is not None
+
+    def all(self):
+        with self._lock:
+            self._refresh()
+            self.stats["lookups"] += 1
+            return list(self._leases)
+
+    def by_mac(self, mac):
+        with self._lock:
+            self._refresh()
+            self.stats["lookups"] += 1
+            return self._by_mac.get(mac.lower())
+
+    def by_ip(self, ip):
+        with self._lock:
+            self._refresh()
+            self.stats["lookups"] += 1
+            return self._by_ip.get(ip)
+
+    def remove(self, macs):
+        """Drop every lease for the given MACs in one atomic rewrite; returns the number removed"""
+        macs = set(mac.lower() for mac in macs)
+        with self._lock:
+            try:
+                with open(self.path, "r") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                return 0
+            kept = []
+            for line in lines:
+                fields = line.split(None, 2)
+                if len(fields) > 1 and fields[1].lower() in macs:
+                    continue
+                kept.append(line)
+            removed = len(lines) - len(kept)
+            if not removed:
+                return 0
+
+            directory = os.path.dirname(self.path) or "."
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".%s." % os.path.basename(self.path))
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.writelines(kept)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            # The kept lines are already parsed into a fresh index; no re-read needed
+            self._index([lease for lease in map(parse_line, kept) if lease], self._stat())
+            self.stats["rewrites"] += 1
+            self.stats["removed"] += removed
+            return removed
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["leases"] = len(self._leases)
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or remove dnsmasq leases")
+    parser.add_argument("--file", default=LEASE_FILE)
+    parser.add_argument("command", choices=("show", "remove"))
+    parser.add_argument("macs", nargs="*")
+    args = parser.parse_args()
+
+    index = LeaseIndex(args.file)
+    if args.command == "show":
+        print(json.dumps([lease.to_dict() for lease in index.all()], indent=2))
+        return
+    if not args.macs:
+        parser.error("remove needs at least one MAC address")
+    macs = [mac.lower().replace("-", ":") for mac in args.macs]
+    removed = index.remove(macs)
+    print("Removed %d lease(s) for %d MAC(s)" % (removed, len(macs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER process lifecycle
+systemd socket activation and readiness notification, an HTTP server that
+drains in-flight requests, and an in-place restart that keeps the socket
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+from logs import get_logger
+
+log = get_logger("lifecycle")
+
+# First descriptor passed by systemd (SD_LISTEN_FDS_START in sd-daemon.h)
+LISTEN_FDS_START = 3
+
+
+def listen_fds():
+    """Listening sockets passed by systemd socket activation or by reexec(), by name
+
+    Follows sd_listen_fds(3): LISTEN_PID must be this process, LISTEN_FDS
+    counts descriptors from 3 on and LISTEN_FDNAMES names them ("unknown"
+    when unnamed). The variables are removed so child processes do not
+    take the sockets for theirs.
+    """
+    try:
+        if int(os.environ.get("LISTEN_PID", "")) != os.getpid():
+            return {}
+        count = int(os.environ.get("LISTEN_FDS", ""))
+    except ValueError:
+        return {}
+    names = os.environ.get("LISTEN_FDNAMES", "").split(":")
+    for variable in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(variable, None)
+
+    sockets = {}
+    for i in range(count):
+        fd = LISTEN_FDS_START + i
+        os.set_inheritable(fd, False)
+        name = names[i] if i < len(names) and names[i] else "unknown"
+        sockets[name] = socket.socket(fileno=fd)
+    return sockets
+
+
+def notify(state):
+    """Send an sd_notify(3) state such as "READY=1"; False when not run as a Type=notify service"""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        # Abstract namespace socket
+        address = "\0" + address[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(address)
+        sock.sendall(state.encode("utf-8"))
+        return True
+    except OSError as e:
+        log.warning("sd_notify %s failed: %s", state.split("\n")[0], str(e))
+        return False
+    finally:
+        sock.close()
+
+
+def reexec(sockets):
+    """Replace this process with a fresh start of the same command, keeping the listening sockets
+
+    sockets is {name: socket}. They are moved to descriptors 3 and up and
+    announced the way systemd does, with LISTEN_PID set to this PID (which
+    exec keeps), so the new image picks them up in listen_fds().
+    Connections made in between wait in the listen backlog. Only returns
+    by raising OSError if the exec fails.
+    """
+    import fcntl
+
+    # Copy every socket above the target range first, so moving one onto
+    # 3.. cannot close another one still waiting to be moved
+    floor = LISTEN_FDS_START + len(sockets)
+    copies = [fcntl.fcntl(sock.fileno(), fcntl.F_DUPFD, floor) for sock in sockets.values()]
+    for i, fd in enumerate(copies):
+        os.dup2(fd, LISTEN_FDS_START + i)
+        os.close(fd)
+    os.environ.update(LISTEN_PID=str(os.getpid()), LISTEN_FDS=str(len(sockets)),
+                      LISTEN_FDNAMES=":".join(sockets))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # orig_argv keeps interpreter options such as -u (Python 3.10+)
+    argv = list(getattr(sys, "orig_argv", None) or [sys.executable] + sys.argv)
+    os.execv(sys.executable, argv)
+
+
+class GracefulHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer that can adopt an inherited listening socket and wait for requests in progress"""
+
+    # systemd's default backlog rather than socketserver's 5: connections made
+    # while the engine restarts wait in the kernel instead of being refused
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, server_address, handler, sock=None):
+        super().__init__(server_address, handler, bind_and_activate=sock is None)
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+            self.server_name = self.server_address[0]
+            self.server_port = self.server_address[1]
+        self.inherited = sock is not None
+        self._active = 0
+        self._idle = threading.Condition()
+
+    def process_request(self, request, client_address):
+        # Counted before the thread starts, so drain() cannot miss it
+        with self._idle:
+            self._active += 1
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._finished()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._finished()
+
+    def _finished(self):
+        with self._idle:
+            self._active -= 1
+            if not self._active:
+                self._idle.notify_all()
+
+    def active(self):
+        with self._idle:
+            return self._active
+
+    def drain(self, timeout):
+        """Wait up to timeout seconds for the requests in progress; returns how many are still running"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            return self._active
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER logging
+Non-blocking, rate-limited logging for the policy engine: records are queued
+by the calling thread and written by one listener thread, as text or JSON,
+to stdout (the journal) or a size-rotated file
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+ROOT_LOGGER = "seer"
+
+# Records waiting for the writer thread; when full, new records are dropped
+# instead of blocking the request that logged them
+QUEUE_SIZE = 10000
+
+# Per-category token bucket: sustained records per second and burst size.
+# WARNING and above are never rate limited.
+RATE_LIMIT = 20.0
+RATE_BURST = 100
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(category)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def get_logger(category):
+    """Logger for one category ("db", "http"...), shown as [DB], [HTTP]"""
+    return logging.getLogger("%s.%s" % (ROOT_LOGGER, category))
+
+
+def _category(record):
+    name = record.name
+    if name.startswith(ROOT_LOGGER + "."):
+        name = name[len(ROOT_LOGGER) + 1:]
+    return name.upper()
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(TEXT_FORMAT, DATE_FORMAT)
+
+    def format(self, record):
+        record.category = _category(record)
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += " (%d similar message(s) suppressed)" % suppressed
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, category, msg, plus suppressed/exc when present"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "category": _category(record).lower(),
+            "msg": record.getMessage(),
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per logger name; the next record let through reports how many were dropped"""
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.name)
+            if bucket is None:
+                bucket = self._buckets[record.name] = [float(self.burst), now, 0]
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1.0
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of raising"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # This is the records' only handler, so it is updated in place: merge
+        # args and render the traceback here, as the record crosses threads
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # The queue may be full at shutdown; wait for the writer to make room
+        self.queue.put(self._sentinel)
+
+
+_listener = None
+_queue_handler = None
+_rate_filter = None
+
+
+def setup_logging(level="INFO", fmt="text", log_file=None, max_bytes=5 * 1024 * 1024, backups=3,
+                  rate=RATE_LIMIT, burst=RATE_BURST):
+    """Route the "seer" loggers through a background queue; safe to call again to reconfigure
+
+    With log_file, records go to that file, rotated at max_bytes with
+    backups old copies kept; otherwise they go to stdout.
+    """
+    global _listener, _queue_handler, _rate_filter
+    shutdown_logging()
+
+    # The formats never show the caller's file/line, thread or process, so
+    # skip collecting them for every record (the stack walk is the costly part)
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    if log_file:
+        target = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups,
+                                                      encoding="utf-8")
+    else:
+        target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    log_queue = queue.Queue(QUEUE_SIZE)
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _rate_filter = RateLimitFilter(rate, burst)
+    _queue_handler.addFilter(_rate_filter)
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers = [_queue_handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
+
+    _listener = _Listener(log_queue, target, respect_handler_level=False)
+    _listener.start()
+    return root
+
+
+def shutdown_logging():
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        root = logging.getLogger(ROOT_LOGGER)
+        root.handlers = [handler for handler in root.handlers if handler is not _queue_handler]
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
+
+
+def get_stats():
+    return {
+        "queued": _queue_handler.queue.qsize() if _queue_handler else 0,
+        "dropped": _queue_handler.dropped if _queue_handler else 0,
+        "rate_limited": _rate_filter.suppressed if _rate_filter else 0,
+    }
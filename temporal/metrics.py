@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER metrics
+Counters, gauges and histograms rendered in the Prometheus text format,
+plus an opt-in cProfile hook for slow requests
+"""
+
+import contextlib
+import cProfile
+import os
+import random
+import threading
+import time
+
+from logs import get_logger
+
+log = get_logger("profile")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; spans a cached GET (sub-millisecond) up to a dnsmasq restart
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROFILE_DIR = "/tmp/seer-profiles"
+PROFILE_HEADER = "X-SEER-Profile"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return "%d" % value if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Metric:
+    """A named metric family with a fixed set of label names
+
+    Label values are passed as keyword arguments and must name every label.
+    A metric built with function= is read when rendered instead of being
+    updated in place; the function returns a number, or {label values: number}.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError("%s expects labels %s" % (self.name, ", ".join(self.labelnames)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        """(suffix, label values, extra label, value) tuples"""
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [("", key if isinstance(key, tuple) else (key,), None, value)
+                    for key, value in sorted(values.items())]
+        with self._lock:
+            return [("", key, None, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        for suffix, key, extra, value in self._samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, _label_text(self.labelnames, key, extra),
+                                        _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram; each labelset keeps bucket counts, a sum and a count"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block, even if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            states = sorted((key, list(state[0]), state[1], state[2]) for key, state in self._values.items())
+        samples = []
+        for key, counts, total, count in states:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                samples.append(("_bucket", key, ("le", _format_value(float(bound))), cumulative))
+            samples.append(("_bucket", key, ("le", "+Inf"), count))
+            samples.append(("_sum", key, None, total))
+            samples.append(("_count", key, None, count))
+        return samples
+
+
+class Registry:
+    """The metrics served at /metrics, rendered in registration order"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Metric %s is already registered" % metric.name)
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), function=None):
+        return self.register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        out = []
+        for metric in metrics:
+            try:
+                out.append(metric.render())
+            except Exception as e:
+                # One broken callback must not take the whole scrape down
+                out.append("# %s unavailable: %s" % (metric.name, _escape(e)))
+        return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class RequestProfiler:
+    """Run selected requests under cProfile and keep the stats of slow ones
+
+    A request is profiled when it carries the profile header (its stats are
+    always dumped) or when it is picked by sample_rate (dumped only if it
+    took at least slow_seconds). One request is profiled at a time: the
+    profiler hooks are process-wide on newer Pythons, and a second
+    concurrent request simply runs unprofiled.
+    """
+
+    def __init__(self, sample_rate=0.0, slow_seconds=0.25, directory=PROFILE_DIR, header=PROFILE_HEADER):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.directory = directory
+        self.header = header
+        self._busy = threading.Lock()
+        self.stats = {"profiled": 0, "dumped": 0, "skipped_busy": 0}
+
+    def wanted(self, headers):
+        """Returns "forced", "sampled" or None for a request's headers"""
+        value = headers.get(self.header) if headers is not None else None
+        if value is not None and value.strip().lower() not in ("", "0", "false", "no"):
+            return "forced"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    @contextlib.contextmanager
+    def profile(self, headers, describe):
+        """Profile the with block if the request asks for it; describe() names the dump"""
+        reason = self.wanted(headers)
+        if reason is None:
+            yield
+            return
+        if not self._busy.acquire(blocking=False):
+            self.stats["skipped_busy"] += 1
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiling tool already holds the hooks
+                self.stats["skipped_busy"] += 1
+                profiler = None
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            try:
+                if profiler is not None:
+                    profiler.disable()
+                    self.stats["profiled"] += 1
+                    if reason == "forced" or elapsed >= self.slow_seconds:
+                        self._dump(profiler, describe(), elapsed)
+            finally:
+                self._busy.release()
+
+    def _dump(self, profiler, name, elapsed):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, "%s-%d-%s.prof" % (
+                time.strftime("%Y%m%d-%H%M%S"), int(elapsed * 1000), name.replace("/", "_")))
+            profiler.dump_stats(path)
+        except OSError as e:
+            log.error("Could not write profile: %s", str(e))
+            return
+        self.stats["dumped"] += 1
+        log.info("%s took %.3fs, stats in %s (python3 -m pstats %s)", name, elapsed, path, path)
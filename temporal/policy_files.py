@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER policy files
+Streaming, deduplicating reader for policies.json / net_policies.json, an
+append-only journal of changes compacted into the file, and a watcher
+that reloads both when they change on disk
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from Policy import Policy
+from logs import get_logger
+
+log = get_logger("policy_files")
+
+# Bytes read per step; memory while loading is this plus the largest entry
+CHUNK_SIZE = 64 * 1024
+# A single entry larger than this is treated as a corrupt file
+MAX_ENTRY_SIZE = 1024 * 1024
+# Rewrite the file once dead records (duplicates, invalid entries, journal
+# lines) outnumber the live policies and this floor
+COMPACT_MIN_RECORDS = 256
+# Seconds between stat() checks of the file and its journal
+POLL_INTERVAL = 2.0
+
+_decoder = json.JSONDecoder()
+_SPACE = re.compile(r"[ \t\n\r]*")
+# What may follow an array entry
+_SEPARATOR = re.compile(r"[ \t\n\r]*([,\]])[ \t\n\r]*")
+
+
+class _Reader:
+    """Character buffer over a text file, refilled in CHUNK_SIZE steps"""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read one more chunk, dropping what was consumed; False at end of file"""
+        if self.eof:
+            return False
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-space character, or "" at end of file"""
+        while True:
+            self.pos = _SPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected %r at offset %d" % (char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """Decode the next JSON value, reading more until it is complete"""
+        self.peek()
+        while True:
+            try:
+                value, self.pos = _decoder.raw_decode(self.buf, self.pos)
+                return value
+            except ValueError:
+                if len(self.buf) - self.pos > MAX_ENTRY_SIZE or not self.fill():
+                    raise
+
+
+def iter_entries(f, found_key=None):
+    """Yield (text, entry) for each entry of a policy array without reading the whole document
+
+    The array is either the document itself (policies.json) or the first
+    array-valued member of a top-level object ({"temporal_policies": [...]});
+    found_key, if given, is a list that receives that member's name. text
+    is the entry's source, so byte-identical repeats can be spotted without
+    validating them again.
+    """
+    reader = _Reader(f)
+    first = reader.peek()
+    if first == "":
+        return
+    if first == "{":
+        reader.expect("{")
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if reader.peek() == "[":
+                if found_key is not None:
+                    found_key.append(key)
+                break
+            reader.value()
+            if reader.peek() != ",":
+                reader.expect("}")
+                return
+            reader.expect(",")
+    reader.expect("[")
+    if reader.peek() == "]":
+        return
+    scan = _decoder.scan_once
+    count = 0
+    while True:
+        buf, pos = reader.buf, reader.pos
+        try:
+            value, end = scan(buf, pos)
+            separator = _SEPARATOR.match(buf, end)
+        except (StopIteration, ValueError):
+            # Invalid, or cut off at the end of the buffer
+            separator = None
+        # Trust an entry only once the buffer also holds what follows it
+        if separator is not None and (separator.end() < len(buf) or reader.eof):
+            count += 1
+            yield buf[pos:end], value
+            reader.pos = separator.end()
+            if separator.group(1) == "]":
+                return
+            continue
+        if len(buf) - pos > MAX_ENTRY_SIZE:
+            raise ValueError("Entry %d is larger than %d bytes" % (count + 1, MAX_ENTRY_SIZE))
+        if not reader.fill() and separator is None:
+            raise ValueError("Invalid or truncated entry %d" % (count + 1))
+
+
+def entry_domains(item):
+    """Domains named by one file entry: its destination plus any "domains" list
+
+    Raises ValueError if there are none, as in the empty "Block " entries
+    a UI bug used to append.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Entry must be an object")
+    domains = [item.get("destination") or item.get("domain")] + list(item.get("domains") or ())
+    domains = [d.strip() for d in domains if isinstance(d, str) and d.strip()]
+    if not domains:
+        raise ValueError("Entry has no domain")
+    return domains
+
+
+def entry_name(item):
+    """Display name of a file entry: "policy" as the engine writes it, or "name" as the UI does"""
+    return item.get("policy") or item.get("name")
+
+
+def parse_entry(item):
+    """Policies in one file entry, one per domain; raises ValueError if it has none"""
+    source = item.get("source") if isinstance(item, dict) else None
+    return [Policy(domain.lower().rstrip("."), item.get("schedule") or None, item.get("enabled", True),
+                   source if source not in (None, "", "*") else None, entry_name(item))
+            for domain in entry_domains(item)]
+
+
+def policy_key(policy):
+    return (policy.destination, policy.source)
+
+
+def _rewrite_entry(text, domains, policy=None):
+    """Source of a file entry cut down to some of its domains, with its other fields kept
+
+    With policy, the entry instead becomes that one policy as changed
+    through the engine: its state and schedule, and its name under the
+    entry's own "policy" or "name" field.
+    """
+    item = json.loads(text)
+    if item.get("destination") or not item.get("domain"):
+        item["destination"] = domains[0]
+    else:
+        item["domain"] = domains[0]
+    if "domains" in item or len(domains) > 1:
+        item["domains"] = domains[1:]
+    if policy is not None:
+        item["enabled"] = policy.enabled
+        item["schedule"] = policy.schedule.to_dict()
+        if policy.name is not None:
+            item["name" if "name" in item and "policy" not in item else "policy"] = policy.name
+    return json.dumps(item)
+
+
+class PolicyFile:
+    """A policy file plus its journal, held as {(destination, source): Policy}
+
+    load() streams the file, validates each entry with parse (entries may
+    expand to several policies; ValueError skips one), keeps the last
+    policy per destination and source, then replays the journal. append()
+    records only changes that alter that state, as JSON lines in the
+    journal, and the file is compacted (rewritten with the live policies
+    only, the journal emptied) once dead records outnumber live ones.
+
+    The file may belong to another program (net_policies.json is the
+    UI's), so compaction keeps the source of every entry that still
+    defines a policy, with its own field names and fields the engine does
+    not know. Only entries with a domain deleted or changed through the
+    journal are rewritten, and only in the fields concerned.
+
+    The journal's first line names the file it extends (inode, size,
+    mtime), so a file rewritten by another program, e.g. Node-RED, starts
+    over with an empty journal instead of replaying stale changes over it.
+    """
+
+    def __init__(self, path, parse=parse_entry, journal_path=None):
+        self.path = path
+        self.journal_path = journal_path or path + ".journal"
+        self.parse = parse
+        self.policies = {}
+        # Source text and [(domain, key)] of each file entry, and the entry
+        # each key's policy still comes from; the last entry a changed key
+        # came from is kept as the template it is written back with
+        self._entries = []
+        self._origin = {}
+        self._templates = {}
+        # Member holding the array ({"temporal_policies": [...]}), kept when compacting
+        self.key = None
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._dead = 0
+        self._journal_header = None
+        self.stats = {
+            "loads": 0,
+            "entries": 0,
+            "duplicates": 0,
+            "invalid": 0,
+            "journal_records": 0,
+            "appends": 0,
+            "compactions": 0,
+            "load_seconds": 0.0,
+        }
+
+    # ---- file identity ----
+
+    @staticmethod
+    def _file_id(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def stamp(self):
+        """Identity of the file and its journal; differs after any write to either"""
+        return (self._file_id(self.path), self._file_id(self.journal_path))
+
+    def changed(self):
+        with self._lock:
+            return self.stamp() != self._stamp
+
+    # ---- loading ----
+
+    def load(self, compact=True):
+        """Read the file and its journal; returns the policies by (destination, source)"""
+        with self._lock:
+            start = time.perf_counter()
+            policies, entries, duplicates, invalid = {}, 0, 0, 0
+            found_key = []
+            # Source text of each distinct entry -> (its policies, its index in
+            # file_entries), or None if invalid; a repeat reuses the first index
+            parsed_texts = {}
+            file_entries, origin = [], {}
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for text, item in iter_entries(f, found_key):
+                        entries += 1
+                        if text in parsed_texts:
+                            parsed = parsed_texts[text]
+                        else:
+                            try:
+                                policies_in_entry = self.parse(item)
+                                parsed = (policies_in_entry, len(file_entries))
+                                file_entries.append((text, list(zip(entry_domains(item),
+                                                                    map(policy_key, policies_in_entry)))))
+                            except ValueError:
+                                parsed = None
+                            parsed_texts[text] = parsed
+                        if parsed is None:
+                            invalid += 1
+                            continue
+                        for policy in parsed[0]:
+                            key = policy_key(policy)
+                            if key in policies:
+                                duplicates += 1
+                            policies[key] = policy
+                            origin[key] = parsed[1]
+            except FileNotFoundError:
+                pass
+            self.key = found_key[0] if found_key else None
+            self._set_entries(file_entries, origin)
+
+            journal = self._replay(policies)
+            self.policies = policies
+            self._dead = duplicates + invalid + journal
+            self._stamp = self.stamp()
+            elapsed = time.perf_counter() - start
+            self.stats.update({
+                "entries": entries,
+                "duplicates": duplicates,
+                "invalid": invalid,
+                "journal_records": journal,
+                "load_seconds": elapsed,
+            })
+            self.stats["loads"] += 1
+            log.info("Loaded %d policies from %s in %.3fs (%d entries, %d duplicates, %d invalid, %d journal records)",
+                     len(policies), self.path, elapsed, entries, duplicates, invalid, journal)
+            if compact:
+                self._maybe_compact()
+            return dict(policies)
+
+    def _replay(self, policies):
+        """Apply the journal to policies; returns the records applied"""
+        self._journal_header = self._file_id(self.path)
+        try:
+            f = open(self.journal_path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return 0
+        records = 0
+        with f:
+            for number, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                    if number == 0:
+                        if record.get("file") != self._journal_header:
+                            log.info("%s was rewritten, discarding %s", self.path, self.journal_path)
+                            os.unlink(self.journal_path)
+                            return 0
+                        continue
+                    if record["op"] == "upsert":
+                        policy = Policy.from_dict(record["policy"])
+                        policies[policy_key(policy)] = policy
+                        self._detach(policy_key(policy))
+                    else:
+                        key = (record["destination"], record.get("source"))
+                        policies.pop(key, None)
+                        self._detach(key, deleted=True)
+                    records += 1
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    # A crash mid-append leaves a partial last line
+                    log.warning("Skipping bad record %d in %s", number + 1, self.journal_path)
+        return records
+
+    def _set_entries(self, entries, origin):
+        """Keep the file entries that still define a policy, renumbered"""
+        live = sorted(set(origin.values()))
+        renumber = dict((old, new) for new, old in enumerate(live))
+        self._entries = [entries[i] for i in live]
+        self._origin = dict((key, renumber[i]) for key, i in origin.items())
+        self._templates = {}
+
+    def _detach(self, key, deleted=False):
+        """The policy for key no longer comes from the file as written"""
+        index = self._origin.pop(key, None)
+        if deleted:
+            self._templates.pop(key, None)
+        elif index is not None:
+            self._templates[key] = self._entries[index][0]
+
+    # ---- writing ----
+
+    def append(self, upserts=(), deletes=()):
+        """Journal the policies and (destination, source) keys that change the current state
+
+        Returns the number of records written.
+        """
+        with self._lock:
+            if self.changed():
+                # Someone else wrote the file: build on what is there now
+                self.load(compact=False)
+            lines = []
+            for policy in upserts:
+                key = policy_key(policy)
+                current = self.policies.get(key)
+                if current is not None:
+                    if current.enabled == policy.enabled and current.schedule.json == policy.schedule.json:
+                        continue
+                    if policy.name is None:
+                        policy = policy.replace(name=current.name)
+                if policy.restored_from_db:
+                    policy = policy.replace(restored_from_db=False)
+                self.policies[key] = policy
+                self._detach(key)
+                lines.append('{"op": "upsert", "policy": %s}\n' % policy.to_json())
+            for destination, source in deletes:
+                if self.policies.pop((destination, source), None) is not None:
+                    self._detach((destination, source), deleted=True)
+                    lines.append(json.dumps({"op": "delete", "destination": destination, "source": source}) + "\n")
+            if not lines:
+                return 0
+
+            with open(self.journal_path, "a+", encoding="utf-8") as f:
+                if f.tell() == 0:
+                    f.write(json.dumps({"file": self._journal_header}) + "\n")
+                else:
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != "\n":
+                        # Close off a line cut short by a crash
+                        f.write("\n")
+                f.write("".join(lines))
+            self._dead += len(lines)
+            self.stats["journal_records"] += len(lines)
+            self.stats["appends"] += 1
+            self._stamp = self.stamp()
+            self._maybe_compact()
+            return len(lines)
+
+    def _maybe_compact(self):
+        if self._dead > max(COMPACT_MIN_RECORDS, len(self.policies)):
+            self.compact()
+
+    def _live_entries(self):
+        """(source text, [(domain, key)]) of each entry the compacted file holds
+
+        File entries come first, in file order and unchanged unless some of
+        their domains no longer come from them; then the policies changed
+        or added through the journal, after the entry they came from if any.
+        """
+        entries = []
+        for index, (text, domains) in enumerate(self._entries):
+            # One domain per key: the same domain may be listed twice in an entry
+            keys = {}
+            for domain, key in domains:
+                keys.setdefault(key, domain)
+            kept = [(domain, key) for key, domain in keys.items() if self._origin.get(key) == index]
+            if not kept:
+                continue
+            if len(kept) < len(keys):
+                text = _rewrite_entry(text, [domain for domain, _ in kept])
+            entries.append((text, kept))
+        for key, policy in self.policies.items():
+            if key in self._origin:
+                continue
+            template = self._templates.get(key)
+            text = policy.to_json() if template is None else _rewrite_entry(template, [key[0]], policy)
+            entries.append((text, [(key[0], key)]))
+        return entries
+
+    def compact(self):
+        """Rewrite the file with the live policies only and empty the journal"""
+        with self._lock:
+            entries = self._live_entries()
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".policies.")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    lines = ",\n".join("  " + text for text, _ in entries)
+                    body = "[\n%s\n]" % lines if lines else "[]"
+                    if self.key is not None:
+                        body = "{%s: %s}" % (json.dumps(self.key), body)
+                    f.write(body + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                if os.path.exists(self.path):
+                    os.chmod(tmp, os.stat(self.path).st_mode & 0o777)
+                os.replace(tmp, self.path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+            try:
+                os.unlink(self.journal_path)
+            except FileNotFoundError:
+                pass
+            self._set_entries(entries, dict((key, index) for index, (_, domains) in enumerate(entries)
+                                            for _, key in domains))
+            self._journal_header = self._file_id(self.path)
+            self._dead = 0
+            self._stamp = self.stamp()
+            self.stats["compactions"] += 1
+            self.stats["journal_records"] = 0
+            log.info("Compacted %s to %d policies", self.path, len(self.policies))
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["file"] = self.path
+            stats["policies"] = len(self.policies)
+            stats["bytes"] = sum(os.path.getsize(p) for p in (self.path, self.journal_path) if os.path.exists(p))
+            return stats
+
+
+def diff(old, new):
+    """(upserts, deleted keys) turning one {(destination, source): Policy} into another"""
+    upserts = [policy for key, policy in new.items() if key not in old or
+               (old[key].enabled, old[key].schedule.json) != (policy.enabled, policy.schedule.json)]
+    deleted = [key for key in old if key not in new]
+    return upserts, deleted
+
+
+class PolicyFileWatcher:
+    """Polls a PolicyFile and calls on_change(upserts, deleted keys) after another program edits it
+
+    Writes through the PolicyFile itself update its stamp, so only outside
+    edits trigger a reload. inotify is not in the standard library, so the
+    file is stat()ed every interval, as the lease index does.
+    """
+
+    def __init__(self, policy_file, on_change, interval=POLL_INTERVAL):
+        self.policy_file = policy_file
+        self.on_change = on_change
+        self.interval = interval
+        self.reloads = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        """Reload and report the difference if the file changed; returns True if it did"""
+        if not self.policy_file.changed():
+            return False
+        old = dict(self.policy_file.policies)
+        new = self.policy_file.load()
+        upserts, deleted = diff(old, new)
+        self.reloads += 1
+        if upserts or deleted:
+            log.info("%s changed: %d upserts, %d deletions", self.policy_file.path, len(upserts), len(deleted))
+            self.on_change(upserts, deleted)
+        return True
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="policy-file", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except (OSError, ValueError) as e:
+                log.warning("Reloading %s failed: %s", self.policy_file.path, str(e))
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER query log analytics
+Follows dnsmasq's log-queries output and counts, in fixed memory, which
+blocked domains are hit, by which devices and under which policy
+"""
+
+import collections
+import heapq
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from logs import get_logger
+
+log = get_logger("queries")
+
+# dnsmasq's log-facility file; needs log-queries in its config
+QUERY_LOG = "/var/log/dnsmasq.log"
+# Read position (inode and offset) and the counters, saved across restarts
+QUERY_LOG_STATE = "/var/lib/seer/query-log.json"
+
+# Bytes parsed per batch: one regex pass and one Counter per chunk
+CHUNK_SIZE = 1 << 20
+POLL_INTERVAL = 1.0
+SAVE_INTERVAL = 30.0
+
+# Items tracked per summary; counts are exact while fewer distinct items are seen
+NAME_CAPACITY = 1000
+DEVICE_CAPACITY = 1024
+POLICY_CAPACITY = 10000
+
+# "query[A] example.com from 192.168.1.50", with or without log-queries=extra
+_QUERY_RE = re.compile(rb"query\[[^\]]*\] (\S+) from (\S+)")
+
+
+class SpaceSaving:
+    """Top-k heavy hitters in fixed memory (Metwally et al.'s Space-Saving)
+
+    At most capacity items are tracked. An untracked item takes over the
+    smallest counter and inherits its count as its possible overestimate,
+    so every item seen more than total/capacity times is tracked, and no
+    count is more than its error too high. Counts arrive in batches.
+    """
+
+    __slots__ = ("capacity", "total", "_counts", "_errors", "_heap", "_order")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        self._counts = {}
+        self._errors = {}
+        # (count, order, item), possibly stale: refreshed when it reaches the top
+        self._heap = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, item):
+        return item in self._counts
+
+    def count(self, item):
+        return self._counts.get(item, 0)
+
+    def _pop_min(self):
+        heap, counts = self._heap, self._counts
+        while True:
+            count, _, item = heapq.heappop(heap)
+            current = counts.get(item)
+            if current == count:
+                return count, item
+            if current is not None:
+                heapq.heappush(heap, (current, next(self._order), item))
+
+    def update(self, batch):
+        """Add a {item: count} batch"""
+        counts, errors, heap = self._counts, self._errors, self._heap
+        for item, n in batch.items():
+            self.total += n
+            if item in counts:
+                counts[item] += n
+            elif len(counts) < self.capacity:
+                counts[item] = n
+                errors[item] = 0
+                heapq.heappush(heap, (n, next(self._order), item))
+            else:
+                floor, victim = self._pop_min()
+                del counts[victim], errors[victim]
+                counts[item] = floor + n
+                errors[item] = floor
+                heapq.heappush(heap, (floor + n, next(self._order), item))
+
+    def top(self, n=None):
+        """[(item, count, error)] by descending count"""
+        items = self._counts.items()
+        ranked = heapq.nlargest(n, items, key=lambda pair: pair[1]) if n else \
+            sorted(items, key=lambda pair: pair[1], reverse=True)
+        return [(item, count, self._errors[item]) for item, count in ranked]
+
+    def to_state(self):
+        return {"total": self.total, "items": [[item, count, self._errors[item]] for item, count, _ in self.top()]}
+
+    def load_state(self, state):
+        self.__init__(self.capacity)
+        self.total = state.get("total", 0)
+        for item, count, error in state.get("items", [])[:self.capacity]:
+            item = tuple(item) if isinstance(item, list) else item
+            self._counts[item] = count
+            self._errors[item] = error
+            heapq.heappush(self._heap, (count, next(self._order), item))
+
+
+class QueryLogTailer:
+    """Incremental reader of the dnsmasq query log with bounded-memory counters
+
+    match(name, client_ip) returns the key of the policy blocking name for
+    that client, or None. The file is read in CHUNK_SIZE batches: one regex
+    pass pulls out (name, client) pairs, a Counter folds repeats, and only
+    distinct pairs are decoded and matched. A rotated file is read to its
+    end before the new one is opened, and a truncated one from the start.
+    """
+
+    def __init__(self, match, path=QUERY_LOG, state_path=QUERY_LOG_STATE):
+        self.match = match
+        self.path = path
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+        self._inode = None
+        self._offset = 0
+        self.names = SpaceSaving(NAME_CAPACITY)
+        self.blocked_names = SpaceSaving(NAME_CAPACITY)
+        self.devices = SpaceSaving(DEVICE_CAPACITY)
+        self.blocked_devices = SpaceSaving(DEVICE_CAPACITY)
+        self.policies = SpaceSaving(POLICY_CAPACITY)
+        self.stats = {
+            "queries": 0,
+            "blocked": 0,
+            "bytes": 0,
+            "batches": 0,
+            "rotations": 0,
+            "parse_seconds": 0.0,
+            "since": time.time(),
+        }
+
+    # ---- parsing ----
+
+    def process(self, data):
+        """Count the queries in a chunk of complete lines"""
+        start = time.perf_counter()
+        pairs = collections.Counter(_QUERY_RE.findall(data))
+        names, devices = collections.Counter(), collections.Counter()
+        blocked_names, blocked_devices, policies = collections.Counter(), collections.Counter(), collections.Counter()
+        blocked = 0
+        for (name, client), n in pairs.items():
+            name = name.decode("latin-1").lower()
+            client = client.decode("latin-1")
+            names[name] += n
+            devices[client] += n
+            policy = self.match(name, client)
+            if policy is not None:
+                blocked += n
+                blocked_names[name] += n
+                blocked_devices[client] += n
+                policies[policy] += n
+        with self._lock:
+            self.names.update(names)
+            self.devices.update(devices)
+            self.blocked_names.update(blocked_names)
+            self.blocked_devices.update(blocked_devices)
+            self.policies.update(policies)
+            self.stats["queries"] += sum(devices.values())
+            self.stats["blocked"] += blocked
+            self.stats["bytes"] += len(data)
+            self.stats["batches"] += 1
+            self.stats["parse_seconds"] += time.perf_counter() - start
+
+    def _read(self):
+        """Process what the open file has past the offset; returns the bytes consumed"""
+        consumed = 0
+        while True:
+            data = self._file.read(CHUNK_SIZE)
+            if not data:
+                break
+            end = data.rfind(b"\n") + 1
+            if end == 0:
+                if len(data) < CHUNK_SIZE:
+                    # Half-written line: wait for the rest
+                    self._file.seek(self._offset)
+                    break
+                end = len(data)
+            self.process(data[:end])
+            self._offset += end
+            consumed += end
+            self._file.seek(self._offset)
+        return consumed
+
+    def _open(self, path, offset):
+        self.close_file()
+        self._file = open(path, "rb")
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._offset = offset
+        self._file.seek(offset)
+
+    def close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _count_rotation(self):
+        # stats is read under the lock by get_stats() and save_state()
+        with self._lock:
+            self.stats["rotations"] += 1
+
+    def poll(self):
+        """Read everything new, following rotation; returns the bytes consumed"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return self._read() if self._file is not None else 0
+
+        consumed = 0
+        if self._file is None:
+            offset = self._offset if self._inode == st.st_ino and self._offset <= st.st_size else 0
+            if self._inode is not None and self._inode != st.st_ino:
+                # Rotated while we were not running: finish the old file first
+                rotated = self.path + ".1"
+                try:
+                    if os.stat(rotated).st_ino == self._inode:
+                        self._open(rotated, self._offset)
+                        consumed += self._read()
+                        self._count_rotation()
+                except FileNotFoundError:
+                    pass
+            self._open(self.path, offset)
+        elif st.st_ino != self._inode:
+            # Renamed away under us: drain it, then start on the new file
+            consumed += self._read()
+            self._count_rotation()
+            self._open(self.path, 0)
+        elif st.st_size < self._offset:
+            log.info("%s was truncated, reading from the start", self.path)
+            self._count_rotation()
+            self._open(self.path, 0)
+        return consumed + self._read()
+
+    # ---- persistence ----
+
+    def save_state(self):
+        with self._lock:
+            state = {
+                "inode": self._inode,
+                "offset": self._offset,
+                "stats": self.stats,
+                "names": self.names.to_state(),
+                "blocked_names": self.blocked_names.to_state(),
+                "devices": self.devices.to_state(),
+                "blocked_devices": self.blocked_devices.to_state(),
+                "policies": self.policies.to_state(),
+            }
+            text = json.dumps(state)
+        directory = os.path.dirname(self.state_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".query-log.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            os.replace(tmp, self.state_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def load_state(self):
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            log.warning("Ignoring unreadable %s: %s", self.state_path, str(e))
+            return
+        with self._lock:
+            self._inode = state.get("inode")
+            self._offset = state.get("offset", 0)
+            self.stats.update(state.get("stats", {}))
+            for name in ("names", "blocked_names", "devices", "blocked_devices", "policies"):
+                getattr(self, name).load_state(state.get(name, {}))
+        log.info("Resuming %s at offset %d", self.path, self._offset)
+
+    # ---- thread ----
+
+    def start(self):
+        if self._thread is None:
+            self.load_state()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="query-log", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.close_file()
+            self.save_state()
+
+    def _run(self):
+        saved = time.monotonic()
+        unsaved = 0
+        while not self._stop.is_set():
+            try:
+                consumed = self.poll()
+            except OSError as e:
+                log.warning("Reading %s failed: %s", self.path, str(e))
+                self.close_file()
+                consumed = 0
+            unsaved += consumed
+            # Only write the state file when something was read (it may live on flash)
+            if unsaved and time.monotonic() - saved >= SAVE_INTERVAL:
+                try:
+                    self.save_state()
+                except OSError as e:
+                    log.warning("Saving %s failed: %s", self.state_path, str(e))
+                saved = time.monotonic()
+                unsaved = 0
+            if not consumed:
+                self._stop.wait(POLL_INTERVAL)
+
+    # ---- views ----
+
+    def top(self, summary, limit):
+        with self._lock:
+            return getattr(self, summary).top(limit)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["file"] = self.path
+            stats["offset"] = self._offset
+        try:
+            stats["lag_bytes"] = max(os.stat(self.path).st_size - stats["offset"], 0)
+        except OSError:
+            stats["lag_bytes"] = None
+        return stats
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SEER Temporal Policy storage
+Long-lived SQLite connection and typed policy schema for temporal_policy.py
+"""
+
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from logs import get_logger
+from Policy import Schedule, compile_schedule
+
+log = get_logger("db")
+
+# Bump when the schema changes; stored in PRAGMA user_version
+SCHEMA_VERSION = 1
+
+# Board-wide policies (the legacy device_mac="BOARD_WIDE")
+SOURCE_ALL = "*"
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # WAL + NORMAL only fsyncs at checkpoints; a power cut can lose the last
+    # commits but never corrupts the database
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=67108864",
+    "PRAGMA cache_size=-8192",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS temporal_policy (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT UNIQUE,
+        value TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS policies (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        domain TEXT NOT NULL,
+        source TEXT NOT NULL DEFAULT '*',
+        schedule TEXT,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        UNIQUE (domain, source)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_policies_enabled ON policies (enabled, domain)",
+    "CREATE INDEX IF NOT EXISTS idx_policies_updated ON policies (updated_at)",
+    """
+    CREATE TABLE IF NOT EXISTS device_blocks (
+        mac TEXT PRIMARY KEY,
+        ip TEXT,
+        hostname TEXT,
+        blocked_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_device_blocks_expires ON device_blocks (expires_at)",
+    """
+    CREATE TABLE IF NOT EXISTS device_groups (
+        name TEXT PRIMARY KEY,
+        address TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS group_members (
+        mac TEXT PRIMARY KEY,
+        name TEXT NOT NULL REFERENCES device_groups (name),
+        ip TEXT,
+        updated_at REAL NOT NULL
+    )
+    """,
+)
+
+# Statements are kept as constants so sqlite3's per-connection statement
+# cache hands back the same prepared statement on every call
+UPSERT_POLICY = """
+    INSERT INTO policies (domain, source, schedule, enabled, created_at, updated_at)
+    VALUES (?, ?, ?, 1, ?, ?)
+    ON CONFLICT (domain, source) DO UPDATE SET
+        schedule = excluded.schedule,
+        enabled = 1,
+        updated_at = excluded.updated_at
+"""
+DISABLE_POLICY = """
+    UPDATE policies SET enabled = 0, updated_at = ?
+    WHERE domain = ? AND source = ? AND enabled = 1
+"""
+# Board-wide policies are mirrored into the legacy key/value rows
+# (blocked_domain:<d> = "1"/"0") that Node-RED flows and older engines read.
+# Those readers know nothing of schedules and would block a "1" all day, so
+# only always-on policies are mirrored as "1"; scheduled ones are "0"
+UPSERT_LEGACY = """
+    INSERT INTO temporal_policy (key, value) VALUES ('blocked_domain:' || ?, ?)
+    ON CONFLICT (key) DO UPDATE SET value = excluded.value
+"""
+DISABLE_LEGACY = "UPDATE temporal_policy SET value = '0' WHERE key = 'blocked_domain:' || ?"
+SELECT_ENABLED = """
+    SELECT domain, source, schedule, created_at, updated_at
+    FROM policies
+    WHERE enabled = 1
+    ORDER BY domain
+"""
+UPSERT_DEVICE_BLOCK = """
+    INSERT INTO device_blocks (mac, ip, hostname, blocked_at, expires_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (mac) DO UPDATE SET
+        ip = excluded.ip,
+        hostname = excluded.hostname,
+        blocked_at = excluded.blocked_at,
+        expires_at = excluded.expires_at
+"""
+DELETE_DEVICE_BLOCK = "DELETE FROM device_blocks WHERE mac = ?"
+SELECT_DEVICE_BLOCKS = """
+    SELECT mac, ip, hostname, blocked_at, expires_at
+    FROM device_blocks
+    ORDER BY expires_at
+"""
+UPSERT_GROUP = """
+    INSERT INTO device_groups (name, address, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT (name) DO UPDATE SET address = excluded.address, updated_at = excluded.updated_at
+"""
+UPSERT_GROUP_MEMBER = """
+    INSERT INTO group_members (mac, name, ip, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT (mac) DO UPDATE SET name = excluded.name, ip = excluded.ip, updated_at = excluded.updated_at
+"""
+SELECT_GROUPS = "SELECT name, address FROM device_groups ORDER BY name"
+SELECT_GROUP_MEMBERS = "SELECT mac, name, ip FROM group_members ORDER BY mac"
+
+
+def _schedule_text(schedule):
+    """Stored form of a schedule dict or Schedule; a Schedule carries its JSON already"""
+    if isinstance(schedule, Schedule):
+        return schedule.json
+    return json.dumps(schedule) if schedule else None
+
+
+def _legacy_value(schedule):
+    """Legacy row value for an enabled board-wide policy: "1" only if it blocks all day"""
+    return "1" if compile_schedule(schedule).always else "0"
+
+
+class PolicyStorage:
+    """One SQLite connection for the life of the process, shared behind a lock
+
+    Opening a connection and re-issuing PRAGMA journal_mode per query cost
+    more than the query itself; this keeps a single tuned connection and
+    reuses prepared statements.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()
+        self.commits = 0
+        # Called as on_commit(operation, seconds) after each write transaction
+        self.on_commit = None
+
+    def open(self, path=None):
+        """Open (or reopen) the database, apply pragmas and migrate the schema"""
+        with self._lock:
+            self.close()
+            if path:
+                self.path = path
+            db_dir = os.path.dirname(self.path)
+            if db_dir and not os.path.exists(db_dir):
+                os.makedirs(db_dir, exist_ok=True)
+                log.info("Created database directory: %s", db_dir)
+
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, cached_statements=64)
+            conn.row_factory = sqlite3.Row
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self._conn = conn
+            self._migrate()
+        return self
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _migrate(self):
+        """Create the schema and copy legacy blocked_domain:<d> key/value rows into policies
+
+        The legacy rows are never deleted and, from then on, kept in step
+        with the board-wide policies, so other readers of seer.db and a
+        rolled-back engine still see them.
+        """
+        conn = self._conn
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        now = time.time()
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            rows = conn.execute("""
+                SELECT substr(key, 16), value FROM temporal_policy
+                WHERE key >= 'blocked_domain:' AND key < 'blocked_domain;'
+            """).fetchall()
+            conn.executemany("""
+                INSERT OR IGNORE INTO policies (domain, source, schedule, enabled, created_at, updated_at)
+                VALUES (?, ?, NULL, ?, ?, ?)
+            """, ((domain, SOURCE_ALL, 1 if value == "1" else 0, now, now) for domain, value in rows))
+            if rows:
+                log.info("Migrated %d key/value rows into the policies table", len(rows))
+            conn.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+
+    def _connection(self):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Database is not open")
+        return self._conn
+
+    @contextlib.contextmanager
+    def _transaction(self, operation):
+        """Hold the lock for one write transaction, commit it and report its duration"""
+        with self._lock:
+            conn = self._connection()
+            start = time.perf_counter()
+            with conn:
+                yield conn
+            self.commits += 1
+            if self.on_commit is not None:
+                self.on_commit(operation, time.perf_counter() - start)
+
+    def save_policies(self, policies, source=SOURCE_ALL):
+        """Upsert (domain, schedule) pairs as enabled policies in one transaction"""
+        policies = list(policies)
+        now = time.time()
+        with self._transaction("save_policies") as conn:
+            conn.executemany(UPSERT_POLICY, (
+                (domain, source, _schedule_text(schedule), now, now)
+                for domain, schedule in policies
+            ))
+            if source == SOURCE_ALL:
+                conn.executemany(UPSERT_LEGACY, ((domain, _legacy_value(schedule)) for domain, schedule in policies))
+
+    def disable_policies(self, domains, source=SOURCE_ALL):
+        """Mark domains inactive in one transaction; returns the number of rows changed"""
+        now = time.time()
+        with self._transaction("disable_policies") as conn:
+            cursor = conn.executemany(DISABLE_POLICY, ((now, domain, source) for domain in domains))
+            changed = cursor.rowcount
+            if source == SOURCE_ALL:
+                conn.executemany(DISABLE_LEGACY, ((domain,) for domain in domains))
+        return changed
+
+    def apply(self, saved, disabled, source=SOURCE_ALL):
+        """Upsert saved policies and disable others in a single transaction
+
+        saved holds (domain, schedule) or (domain, schedule, source) tuples
+        and disabled holds domains or (domain, source) pairs; entries without
+        a source use source.
+        """
+        now = time.time()
+        saved = [(entry[0], entry[2] if len(entry) > 2 else source, entry[1]) for entry in saved]
+        disabled = [entry if isinstance(entry, tuple) else (entry, source) for entry in disabled]
+        with self._transaction("apply") as conn:
+            conn.executemany(UPSERT_POLICY, (
+                (domain, entry_source, _schedule_text(schedule), now, now)
+                for domain, entry_source, schedule in saved
+            ))
+            conn.executemany(DISABLE_POLICY, ((now, domain, entry_source) for domain, entry_source in disabled))
+            conn.executemany(UPSERT_LEGACY, ((domain, _legacy_value(schedule)) for domain, entry_source, schedule in saved
+                                             if entry_source == SOURCE_ALL))
+            conn.executemany(DISABLE_LEGACY, ((domain,) for domain, entry_source in disabled
+                                              if entry_source == SOURCE_ALL))
+
+    def load_enabled(self):
+        """Return all enabled policies as dicts, in one query"""
+        with self._lock:
+            rows = self._connection().execute(SELECT_ENABLED).fetchall()
+        policies = []
+        # Most rows share a few schedule strings; decode each distinct one once
+        decoded = {}
+        for row in rows:
+            text = row["schedule"]
+            schedule = None
+            if text:
+                if text not in decoded:
+                    decoded[text] = json.loads(text)
+                schedule = decoded[text]
+                if isinstance(schedule, dict):
+                    schedule = dict(schedule)
+            policies.append({
+                "domain": row["domain"],
+                "source": row["source"],
+                "schedule": schedule,
+                "created_at": row["created_at"],
+                "updated_at": row["updated_at"],
+            })
+        return policies
+
+    def save_device_blocks(self, blocks):
+        """Upsert (mac, ip, hostname, blocked_at, expires_at) rows in one transaction"""
+        with self._transaction("save_device_blocks") as conn:
+            conn.executemany(UPSERT_DEVICE_BLOCK, blocks)
+
+    def delete_device_blocks(self, macs):
+        """Forget device blocks in one transaction"""
+        with self._transaction("delete_device_blocks") as conn:
+            conn.executemany(DELETE_DEVICE_BLOCK, ((mac,) for mac in macs))
+
+    def load_device_blocks(self):
+        """Return all device blocks as dicts, soonest expiry first"""
+        with self._lock:
+            rows = self._connection().execute(SELECT_DEVICE_BLOCKS).fetchall()
+        return [dict(row) for row in rows]
+
+    def save_group(self, name, address):
+        with self._transaction("save_group") as conn:
+            conn.execute(UPSERT_GROUP, (name, address, time.time()))
+
+    def delete_group(self, name):
+        """Forget a group and its memberships in one transaction"""
+        with self._transaction("delete_group") as conn:
+            conn.execute("DELETE FROM group_members WHERE name = ?", (name,))
+            conn.execute("DELETE FROM device_groups WHERE name = ?", (name,))
+
+    def save_group_members(self, members):
+        """Upsert (mac, group, ip) rows in one transaction; a device is in one group at a time"""
+        now = time.time()
+        with self._transaction("save_group_members") as conn:
+            conn.executemany(UPSERT_GROUP_MEMBER, ((mac, name, ip, now) for mac, name, ip in members))
+
+    def delete_group_members(self, macs):
+        with self._transaction("delete_group_members") as conn:
+            conn.executemany("DELETE FROM group_members WHERE mac = ?", ((mac,) for mac in macs))
+
+    def load_groups(self):
+        """Return groups as dicts with their (mac, ip) members"""
+        with self._lock:
+            conn = self._connection()
+            groups = [dict(row) for row in conn.execute(SELECT_GROUPS).fetchall()]
+            members = conn.execute(SELECT_GROUP_MEMBERS).fetchall()
+        by_name = dict((group["name"], group) for group in groups)
+        for group in groups:
+            group["members"] = []
+        for row in members:
+            if row["name"] in by_name:
+                by_name[row["name"]]["members"].append((row["mac"], row["ip"]))
+        return groups
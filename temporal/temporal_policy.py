@@ -7,95 +7,299 @@ Author: PatrickReyes-111
 Date: 2025-11-14
 """
 
+import argparse
 import json
+import re
 import subprocess
 import os
 import signal
 import time
-import sqlite3
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from datetime import datetime
+import threading
+import hashlib
+import errno
+import tempfile
+import heapq
+import itertools
+import queue
+import shlex
+import collections
+import contextlib
+import socket
+import sys
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+from datetime import datetime, timedelta
 from pathlib import Path
 
+from storage import SOURCE_ALL, PolicyStorage
+from Policy import Policy, compile_schedule, encode_policies, minute_of_week
+from domain_trie import DomainTrie
+from dns_sinkhole import DNSSinkhole, parse_upstream
+from device_blocks import BLOCK_DURATION, BLOCK_REGISTRY, DeviceBlockManager
+from firewall import create_backend
+from groups import GROUP_DIR, DeviceGroupManager, normalize_group
+from query_log import QUERY_LOG, QUERY_LOG_STATE, QueryLogTailer
+from leases import LEASE_FILE
+from lifecycle import GracefulHTTPServer, listen_fds, notify, reexec
+from policy_files import PolicyFile, PolicyFileWatcher, entry_domains, entry_name
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, RequestProfiler
+from logs import get_logger, get_stats as get_log_stats, setup_logging, shutdown_logging
+
+db_log = get_logger("db")
+cleanup_log = get_logger("cleanup")
+reload_log = get_logger("reload")
+scheduler_log = get_logger("scheduler")
+policy_log = get_logger("policy")
+startup_log = get_logger("startup")
+http_log = get_logger("http")
+
 # Configuration
 HOST_NAME = "127.0.0.1"
 SERVER_PORT = 1889
+# Owned by the writer thread; request handlers read POLICY_SNAPSHOT instead
 POLICIES = []
+POLICY_SNAPSHOT = None
+# Number of policy changes kept for GET /changes?since=<revision>
+CHANGE_LOG_SIZE = 10000
+# Page size cap for GET /?offset=&limit= and GET /devices/blocked
+MAX_PAGE_SIZE = 1000
+# Longest host name a policy may name (RFC 1035, without the trailing dot)
+MAX_DOMAIN_LENGTH = 253
 
 # Database Configuration
 # Using absolute path to ensure consistency regardless of user context
 DB_PATH = "/home/admin/.node-red/seer_database/seer.db"
 DB_TABLE = "temporal_policy"
+STORAGE = PolicyStorage(DB_PATH)
+
+# Enforcement Configuration
+HOSTS_FILE = "/etc/hosts"
+DNSMASQ_CONF = "/etc/dnsmasq.d/blocked-sites.conf"
+DNSMASQ_PID_FILE = "/run/dnsmasq/dnsmasq.pid"
+# dnsmasq only re-reads dnsmasq.d on a full restart
+DNSMASQ_RESTART_COMMAND = ["systemctl", "restart", "dnsmasq"]
+# Source-scoped policies (groups.py): the main dnsmasq includes GROUPS_CONF,
+# and each group's resolver runs as its own dnsmasq, seer-dns@<group>
+GROUPS_CONF = "/etc/dnsmasq.d/seer-groups.conf"
+GROUP_RESOLVER_COMMAND = ["systemctl", "{action}", "seer-dns@{group}"]
+# Optional built-in DNS front end (dns_sinkhole.py): blocked names are answered
+# from the in-memory blocklists and everything else is forwarded to DNS_UPSTREAM
+# (dnsmasq moved to another port), so policy changes need no rewrite or restart
+DNS_SINKHOLE = False
+DNS_LISTEN_ADDRESS = "0.0.0.0"
+DNS_PORT = 53
+DNS_UPSTREAM = "127.0.0.1:5353"
+# dnsmasq's log-queries output, tailed for per-policy and per-device hit counts
+# (query_log.py); None disables it. In sinkhole mode blocked queries are
+# answered before dnsmasq and never reach this log
+QUERY_LOG_FILE = QUERY_LOG
+# Optional policies.json-style file kept in step with the engine (policy_files.py):
+# edits made to it are applied, engine changes are journaled into it; None disables it
+POLICY_FILE = None
+# Sources meaning "every device" (the legacy device_mac was "BOARD_WIDE")
+BOARD_SOURCES = ("", SOURCE_ALL, "all", "board", "board_wide")
+# Delimiters of the SEER-managed block inside /etc/hosts
+HOSTS_BEGIN_MARKER = "# BEGIN SEER Policy - managed by temporal_policy.py, do not edit"
+HOSTS_END_MARKER = "# END SEER Policy"
+# Seconds to collect block/unblock changes before applying them with one reload
+RELOAD_WINDOW = 0.5
+# Seconds a block/unblock request waits for its change to reach the files
+RELOAD_WAIT_TIMEOUT = 30
+# Upper bound on one scheduler sleep, so wall-clock jumps (NTP sync at boot) are noticed
+SCHEDULER_MAX_SLEEP = 300
+DEFAULT_SCHEDULE = {"start": "00:00", "end": "23:59"}
+
+# Device blocks: "nft", "ipset", "iptables" or "auto" (the first of them installed)
+FIREWALL_BACKEND = "auto"
+
+# Prefix for every system path above (see apply_root); "" is the live system
+ROOT_PREFIX = ""
+SYSTEM_PATHS = {
+    "DB_PATH": DB_PATH,
+    "HOSTS_FILE": HOSTS_FILE,
+    "DNSMASQ_CONF": DNSMASQ_CONF,
+    "DNSMASQ_PID_FILE": DNSMASQ_PID_FILE,
+    "GROUPS_CONF": GROUPS_CONF,
+    "GROUP_DIR": GROUP_DIR,
+    "QUERY_LOG_FILE": QUERY_LOG_FILE,
+    "QUERY_LOG_STATE": QUERY_LOG_STATE,
+}
+
+# Logging: level, "text" or "json", and an optional file rotated at
+# LOG_MAX_BYTES (None logs to stdout, i.e. the journal under systemd)
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "text"
+LOG_FILE = None
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+# Records per second per category (burst of LOG_RATE_BURST); warnings are never limited
+LOG_RATE_LIMIT = 20.0
+LOG_RATE_BURST = 100
+# Request bodies are only logged when enabled, cut to LOG_BODY_LIMIT characters
+LOG_BODIES = False
+LOG_BODY_LIMIT = 256
+
+# How long to wait for a killed process to release the port
+PORT_FREE_TIMEOUT = 3.0
+# Seconds a stop or in-place restart (SIGUSR2) waits for requests in progress;
+# queued mutations are always finished. Keep it under systemd's TimeoutStopSec
+DRAIN_TIMEOUT = 10.0
+# How often the accept loop checks for a stop request, i.e. how long a signal can wait
+STOP_POLL_INTERVAL = 0.05
+
+# Seconds spent in each startup phase, in order (reported at /stats)
+STARTUP_TIMINGS = collections.OrderedDict()
+
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """Time a startup phase into STARTUP_TIMINGS"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[name] = time.perf_counter() - start
+
+# Per-request cProfile (GET /metrics to find slow actions first): profile this
+# fraction of requests and dump the ones slower than PROFILE_SLOW_SECONDS.
+# A request sent with an "X-SEER-Profile: 1" header is always profiled.
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_SLOW_SECONDS = 0.25
+PROFILE_DIR = "/tmp/seer-profiles"
+PROFILER = RequestProfiler(PROFILE_SAMPLE_RATE, PROFILE_SLOW_SECONDS, PROFILE_DIR)
+
+
+# ==================== METRICS ====================
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "seer_request_duration_seconds", "HTTP request latency by action", ("method", "action"))
+REQUESTS = REGISTRY.counter(
+    "seer_requests_total", "HTTP requests by action and response code", ("method", "action", "code"))
+RENDER_SECONDS = REGISTRY.histogram(
+    "seer_render_seconds", "Time to render a managed file and write it if changed", ("file",))
+DB_COMMIT_SECONDS = REGISTRY.histogram(
+    "seer_db_commit_seconds", "SQLite write transaction time", ("operation",))
+DNSMASQ_RELOAD_SECONDS = REGISTRY.histogram(
+    "seer_dnsmasq_reload_seconds", "Time to SIGHUP or restart dnsmasq", ("kind",))
+STORAGE.on_commit = lambda operation, seconds: DB_COMMIT_SECONDS.observe(seconds, operation=operation)
+
+# Read at scrape time from the engine's own state
+REGISTRY.gauge("seer_write_queue_depth", "Mutations waiting for the writer thread",
+               function=lambda: WRITE_QUEUE.qsize())
+REGISTRY.gauge("seer_reload_pending", "Domain changes waiting for the next batched reload",
+               function=lambda: RELOAD_SCHEDULER.get_stats()["pending"])
+REGISTRY.gauge("seer_policies", "Policies in the published snapshot",
+               function=lambda: len(POLICY_SNAPSHOT) if POLICY_SNAPSHOT is not None else 0)
+REGISTRY.gauge("seer_blocked_domains", "Domains currently blocked", function=lambda: len(BLOCKLIST))
+REGISTRY.gauge("seer_blocked_devices", "Devices currently blocked", function=lambda: len(DEVICE_BLOCKS))
+REGISTRY.counter("seer_db_commits_total", "SQLite write transactions", function=lambda: STORAGE.commits)
+REGISTRY.counter("seer_reloads_avoided_total", "Reloads saved by batching changes",
+                 function=lambda: RELOAD_SCHEDULER.get_stats()["reloads_avoided"])
+REGISTRY.counter("seer_schedule_transitions_total", "Scheduled policy activations and deactivations",
+                 function=lambda: POLICY_SCHEDULER.transitions)
+REGISTRY.counter("seer_dns_queries_total", "DNS sinkhole queries by how they were answered", ("result",),
+                 function=lambda: dict((result, SINKHOLE.get_stats()[key]) for result, key in (
+                     ("blocked", "blocked"), ("cached", "cache_hits"), ("forwarded", "forwarded"),
+                     ("coalesced", "coalesced"), ("servfail", "servfail"), ("formerr", "formerr")))
+                 if SINKHOLE is not None else {})
+REGISTRY.counter("seer_logged_queries_total", "Queries read from the dnsmasq query log, blocked or allowed",
+                 ("result",), function=lambda: {
+                     "blocked": QUERY_LOG_TAILER.stats["blocked"],
+                     "allowed": QUERY_LOG_TAILER.stats["queries"] - QUERY_LOG_TAILER.stats["blocked"]}
+                 if QUERY_LOG_FILE else {})
+REGISTRY.gauge("seer_startup_seconds", "Time spent in each startup phase", ("phase",),
+               function=lambda: dict(STARTUP_TIMINGS))
+
 
 def ensure_db_initialized():
-    """Ensure database and table exist"""
+    """Open the long-lived database connection and migrate the schema"""
     try:
-        # Create directory if it doesn't exist
-        db_dir = os.path.dirname(DB_PATH)
-        if not os.path.exists(db_dir):
-            os.makedirs(db_dir, exist_ok=True)
-            print("[DB] Created database directory: %s" % db_dir)
-        
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Check if table exists and verify schema
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='temporal_policy'")
-        if not cursor.fetchone():
-            # Create table with key-value schema
-            cursor.execute("""
-                CREATE TABLE temporal_policy (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    key TEXT UNIQUE,
-                    value TEXT
-                )
-            """)
-            print("[DB] Created temporal_policy table")
-        
-        conn.commit()
-        conn.close()
-        print("[DB] ✅ Database initialized successfully")
+        STORAGE.open(DB_PATH)
+        db_log.info("✅ Database initialized successfully")
         return True
     except Exception as e:
-        print("[DB ERROR] Failed to initialize database: %s" % str(e))
+        db_log.error("Failed to initialize database: %s", str(e))
+        return False
+
+
+def port_in_use(port):
+    """Try to bind the port the way the HTTP server will; True if that fails"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((HOST_NAME, port))
         return False
+    except OSError:
+        return True
+    finally:
+        sock.close()
+
+
+def wait_for_port(port, timeout=PORT_FREE_TIMEOUT):
+    """Poll until the port can be bound instead of sleeping a fixed time"""
+    deadline = time.monotonic() + timeout
+    while port_in_use(port):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
 
 
 def kill_process_on_port(port):
-    """Kill any process using the specified port"""
+    """Stop any process listening on the specified port
+
+    It gets SIGTERM first, so an older engine drains and closes its socket,
+    and SIGKILL only if the port is still taken after PORT_FREE_TIMEOUT.
+    """
+    # Normal boot: nothing holds the port, so skip lsof/fuser entirely
+    if not port_in_use(port):
+        return False
+
     try:
+        # Only the listener: clients with a connection open to the port are left alone
         result = subprocess.run(
-            ['lsof', '-ti', ':%d' % port],
+            ['lsof', '-ti', 'tcp:%d' % port, '-sTCP:LISTEN'],
             capture_output=True,
             text=True,
             check=False
         )
 
         if result.stdout.strip():
-            pids = result.stdout.strip().split('\n')
-            for pid in pids:
+            pids = []
+            for pid in result.stdout.strip().split('\n'):
                 try:
                     pid_num = int(pid.strip())
-                    print("[CLEANUP] Killing process %d on port %d" % (pid_num, port))
-                    os.kill(pid_num, signal.SIGKILL)
+                    cleanup_log.info("Stopping process %d on port %d", pid_num, port)
+                    os.kill(pid_num, signal.SIGTERM)
+                    pids.append(pid_num)
                 except (ValueError, ProcessLookupError):
                     pass
-            time.sleep(1)
-            print("[CLEANUP] Port %d freed" % port)
+            if not wait_for_port(port):
+                for pid_num in pids:
+                    try:
+                        cleanup_log.warning("Process %d did not release port %d, killing it", pid_num, port)
+                        os.kill(pid_num, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                wait_for_port(port)
+            cleanup_log.info("Port %d freed", port)
             return True
     except FileNotFoundError:
         pass
 
     try:
-        result = subprocess.run(
-            ['fuser', '-k', '%d/tcp' % port],
-            capture_output=True,
-            check=False
-        )
-        if result.returncode == 0:
-            time.sleep(1)
-            print("[CLEANUP] Port %d freed using fuser" % port)
-            return True
+        for sig in ('-TERM', '-KILL'):
+            result = subprocess.run(
+                ['fuser', '-k', sig, '%d/tcp' % port],
+                capture_output=True,
+                check=False
+            )
+            if result.returncode != 0:
+                break
+            if wait_for_port(port):
+                cleanup_log.info("Port %d freed using fuser", port)
+                return True
     except FileNotFoundError:
         pass
 
@@ -104,239 +308,1482 @@ def kill_process_on_port(port):
 
 # ==================== DATABASE FUNCTIONS ====================
 
-def get_db_connection():
-    """Get SQLite database connection"""
+def save_blocked_website_to_db(domain, schedule=None, source=None):
+    """Save blocked website to database (source None is board-wide)"""
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=5)
-        conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA journal_mode=WAL")  # Better concurrency
-        return conn
-    except sqlite3.Error as e:
-        print("[DB ERROR] Failed to connect: %s" % str(e))
-        return None
+        STORAGE.save_policies([(domain, schedule)], source or SOURCE_ALL)
+        db_log.debug("Saved to database: %s", domain)
+        return True
+    except Exception as e:
+        db_log.error("Failed to save: %s", str(e))
+        return False
 
 
-def save_blocked_website_to_db(domain, device_mac="BOARD_WIDE"):
-    """Save blocked website to database"""
+def save_blocked_websites_bulk(blocked, unblocked):
+    """Save many (domain, schedule, source) blocks and (domain, source) unblocks in a single transaction"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            print("[DB ERROR] Could not get database connection")
-            return False
-        
-        cursor = conn.cursor()
-        
-        try:
-            # Store as key='blocked_domain:domain' and value='1' for active
-            cursor.execute("""
-                INSERT OR REPLACE INTO temporal_policy (key, value)
-                VALUES (?, ?)
-            """, ("blocked_domain:" + domain, "1"))
-            
-            conn.commit()
-            print("[DB] ✅ Saved to database: %s" % domain)
-            return True
-        except sqlite3.IntegrityError as e:
-            print("[DB ERROR] Integrity error: %s" % str(e))
-            conn.rollback()
-            return False
-        except Exception as e:
-            print("[DB ERROR] Query error: %s" % str(e))
-            conn.rollback()
-            return False
-        finally:
-            conn.close()
+        STORAGE.apply(blocked, unblocked)
+        db_log.debug("Saved %d blocks and %d unblocks in one transaction", len(blocked), len(unblocked))
+        return True
     except Exception as e:
-        print("[DB ERROR] Failed to save: %s" % str(e))
+        db_log.error("Bulk save failed: %s", str(e))
         return False
 
 
-def remove_blocked_website_from_db(domain):
+def remove_blocked_website_from_db(domain, source=None):
     """Remove blocked website from database (mark as inactive)"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            print("[DB ERROR] Could not get database connection")
-            return False
-        
-        cursor = conn.cursor()
-        try:
-            # Update value to '0' to mark as inactive
-            cursor.execute("""
-                UPDATE temporal_policy
-                SET value = ?
-                WHERE key = ?
-            """, ("0", "blocked_domain:" + domain))
-            
-            if cursor.rowcount == 0:
-                print("[DB] Website not found in database: %s" % domain)
-            
-            conn.commit()
-            print("[DB] ✅ Removed from database: %s" % domain)
-            return True
-        except Exception as e:
-            print("[DB ERROR] Query error: %s" % str(e))
-            conn.rollback()
-            return False
-        finally:
-            conn.close()
+        if not STORAGE.disable_policies([domain], source or SOURCE_ALL):
+            db_log.debug("Website not found in database: %s", domain)
+        db_log.debug("Removed from database: %s", domain)
+        return True
     except Exception as e:
-        print("[DB ERROR] Failed to remove: %s" % str(e))
+        db_log.error("Failed to remove: %s", str(e))
         return False
 
 
 def load_blocked_websites_from_db():
-    """Load all active blocked websites from database"""
+    """Load all active blocked policies from database"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            print("[DB ERROR] Could not get database connection")
-            return []
-        
-        cursor = conn.cursor()
-        try:
-            cursor.execute("""
-                SELECT key, value 
-                FROM temporal_policy 
-                WHERE key LIKE 'blocked_domain:%' AND value = '1'
-                ORDER BY key
-            """)
-            
-            rows = cursor.fetchall()
-            websites = [row[0].replace('blocked_domain:', '') for row in rows]
-            print("[DB] ✅ Loaded %d blocked websites from database" % len(websites))
-            return websites
-        except Exception as e:
-            print("[DB ERROR] Query error: %s" % str(e))
-            return []
-        finally:
-            conn.close()
+        policies = STORAGE.load_enabled()
+        db_log.info("✅ Loaded %d blocked websites from database", len(policies))
+        return policies
     except Exception as e:
-        print("[DB ERROR] Failed to load: %s" % str(e))
+        db_log.error("Failed to load: %s", str(e))
         return []
 
 
-def apply_block_website(domain):
-    """Apply block to /etc/hosts and DNSMasq without HTTP handler"""
+# ==================== ENFORCEMENT FUNCTIONS ====================
+
+def normalize_domain(domain):
+    """Normalize a user-supplied URL or host name to a bare lowercase domain"""
+    domain = (domain or "").strip().lower()
+    for prefix in ("http://", "https://"):
+        if domain.startswith(prefix):
+            domain = domain[len(prefix):]
+    domain = domain.split('/', 1)[0].split(':', 1)[0].rstrip('.')
+    if domain.startswith("www."):
+        domain = domain[4:]
+    return domain
+
+
+# One host name label: letters, digits and hyphens, 1-63 long, no hyphen at either end
+_HOST_LABEL = re.compile(r"[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\Z")
+
+
+def validate_domain(domain):
+    """Normalize a user-supplied domain and check it is a host name; raises ValueError if not
+
+    Whatever is accepted here is written to /etc/hosts and the dnsmasq
+    config, so only LDH labels pass: no spaces, control characters,
+    separators or empty labels, and no ".." even in a URL path.
+    """
+    if not isinstance(domain, str):
+        raise ValueError("Invalid domain: %r" % (domain,))
+    name = normalize_domain(domain)
+    if (not name or len(name) > MAX_DOMAIN_LENGTH or ".." in domain
+            or not all(_HOST_LABEL.match(label) for label in name.split("."))):
+        raise ValueError("Invalid domain: %r" % (domain,))
+    return name
+
+
+def _hosts_domain(line):
+    """Return the host name of a 127.0.0.1 hosts line, or None"""
+    parts = line.split()
+    if len(parts) >= 2 and parts[0] in ("127.0.0.1", "::1"):
+        return parts[1]
+    return None
+
+
+class Blocklist:
+    """In-memory index of blocked domains, the source of truth for /etc/hosts and DNSMasq
+
+    Domains are keyed by their normalized form, so lookups, adds and removes
+    are O(1) and the managed files are rendered from the index instead of
+    being re-parsed on every change. A suffix trie alongside the dict
+    answers subdomain questions in O(labels).
+    """
+
+    def __init__(self):
+        self._domains = {}
+        self._trie = DomainTrie()
+
+    def __contains__(self, domain):
+        return normalize_domain(domain) in self._domains
+
+    def __len__(self):
+        return len(self._domains)
+
+    def domains(self):
+        return list(self._domains)
+
+    def load(self, domains):
+        """Populate the index"""
+        # Interned, so the index shares each name with its Policy
+        self._domains = dict.fromkeys(sys.intern(normalize_domain(d)) for d in domains if normalize_domain(d))
+        self._trie = DomainTrie((domain, domain) for domain in self._domains)
+
+    def match(self, name):
+        """Blocked domain covering name (itself or a parent), or None"""
+        found = self._trie.match(normalize_domain(name))
+        return found[0] if found else None
+
+    def covering(self, domain):
+        """Blocked strict parent of domain, or None"""
+        return self._trie.covering(normalize_domain(domain))
+
+    def add(self, domain):
+        """Add a domain; returns True if the index changed"""
+        domain = normalize_domain(domain)
+        if not domain or domain in self._domains:
+            return False
+        domain = sys.intern(domain)
+        self._domains[domain] = None
+        self._trie.insert(domain, domain)
+        return True
+
+    def remove(self, domain):
+        """Remove a domain; returns True if the index changed"""
+        domain = normalize_domain(domain)
+        if domain not in self._domains:
+            return False
+        del self._domains[domain]
+        self._trie.remove(domain)
+        return True
+
+    def apply(self, changes):
+        """Apply {domain: blocked} changes; returns the number of domains that changed"""
+        changed = 0
+        for domain, blocked in changes.items():
+            if self.add(domain) if blocked else self.remove(domain):
+                changed += 1
+        return changed
+
+    # Both renders are sorted so the output depends only on which domains are
+    # blocked, not on the order they were added: a restart restoring from the
+    # database then reproduces the files byte for byte and skips the reload
+    def render_hosts(self):
+        """Render the body of the SEER block in /etc/hosts"""
+        return "".join("127.0.0.1 %s\n127.0.0.1 www.%s\n" % (domain, domain) for domain in sorted(self._domains))
+
+    def render_dnsmasq(self):
+        # No timestamp in the header: identical content must hash identically
+        return ("# SEER Temporal Policy - Blocked Domains\n"
+                "# This file is managed by temporal_policy.py\n\n" + self.render_addresses())
+
+    def render_addresses(self):
+        """address= lines for every blocked domain not already covered by a blocked parent"""
+        out = []
+        trie = self._trie
+        for domain in sorted(self._domains):
+            # A parent's wildcard already covers this name
+            if trie.covering(domain) is not None:
+                continue
+            # Exact name plus wildcard for all subdomains
+            out.append("address=/%s/127.0.0.1\naddress=/.%s/127.0.0.1\n" % (domain, domain))
+        return "".join(out)
+
+
+BLOCKLIST = Blocklist()
+# One blocklist per device group, for group-scoped policies
+GROUP_BLOCKLISTS = {}
+
+
+# (content hash, file stamp) of the last write per managed path, so unchanged
+# renders skip disk I/O as long as nobody else touched the file since
+_managed_hashes = {}
+
+
+def _content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _file_stamp(path):
+    """(inode, size, mtime) of path, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _atomic_write(path, content):
+    """Write content to a temp file next to path and rename() it into place"""
+    directory = os.path.dirname(path) or "."
     try:
-        # Method 1: Add to /etc/hosts (for Pi itself)
-        with open('/etc/hosts', 'r') as f:
-            content = f.read()
-            if "127.0.0.1 %s" % domain in content or "127.0.0.1 www.%s" % domain in content:
-                print("[INFO] %s already in /etc/hosts" % domain)
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o644
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".%s." % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        try:
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # /etc/hosts is bind-mounted in some containers and cannot be replaced
+            if e.errno not in (errno.EBUSY, errno.EXDEV):
+                raise
+            with open(path, 'w') as f:
+                f.write(content)
+            os.unlink(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def write_managed_file(path, content):
+    """Atomically replace a fully managed file; returns False if content was unchanged"""
+    digest = _content_hash(content)
+    stamp = _file_stamp(path)
+    if _managed_hashes.get(path) == (digest, stamp):
+        return False
+    # First write, or the file was edited or replaced since: compare with what is on disk
+    if stamp is not None:
+        with open(path, 'r') as f:
+            if _content_hash(f.read()) == digest:
+                _managed_hashes[path] = (digest, stamp)
+                return False
+
+    _atomic_write(path, content)
+    _managed_hashes[path] = (digest, _file_stamp(path))
+    return True
+
+
+def _strip_legacy_hosts_entries(text):
+    """Drop pre-marker '# SEER Policy' blocks that were appended to /etc/hosts"""
+    kept = []
+    in_seer_block = False
+    for line in text.splitlines(True):
+        if line.startswith("#") and "SEER Policy" in line:
+            in_seer_block = True
+            continue
+        if in_seer_block:
+            if _hosts_domain(line) is not None:
+                continue
+            in_seer_block = False
+        kept.append(line)
+    return "".join(kept).rstrip("\n") + "\n"
+
+
+def write_managed_block(path, body):
+    """Replace only the delimited SEER block of a shared file like /etc/hosts
+
+    Lines outside the markers are copied through byte for byte. Returns False
+    if the block content was unchanged.
+    """
+    digest = _content_hash(body)
+    stamp = _file_stamp(path)
+    if _managed_hashes.get(path) == (digest, stamp):
+        return False
+
+    try:
+        with open(path, 'r') as f:
+            text = f.read()
+    except FileNotFoundError:
+        text = ""
+
+    begin = text.find(HOSTS_BEGIN_MARKER + "\n")
+    end = text.find(HOSTS_END_MARKER + "\n", begin + 1) if begin != -1 else -1
+    if begin != -1 and end != -1:
+        if text[begin + len(HOSTS_BEGIN_MARKER) + 1:end] == body:
+            _managed_hashes[path] = (digest, stamp)
+            return False
+        head, tail = text[:begin], text[end + len(HOSTS_END_MARKER) + 1:]
+    else:
+        head, tail = _strip_legacy_hosts_entries(text) + "\n", ""
+
+    _atomic_write(path, "%s%s\n%s%s\n%s" % (head, HOSTS_BEGIN_MARKER, body, HOSTS_END_MARKER, tail))
+    _managed_hashes[path] = (digest, _file_stamp(path))
+    return True
+
+
+def policy_key(domain, source=None):
+    """Key of a policy in the schedulers: the domain if board-wide, else (group, domain)"""
+    return domain if source is None else (source, domain)
+
+
+def _split_changes(changes):
+    """Split {key: blocked} into board-wide {domain: blocked} and {group: {domain: blocked}}"""
+    board, groups = {}, {}
+    for key, blocked in changes.items():
+        if isinstance(key, tuple):
+            groups.setdefault(key[0], {})[key[1]] = blocked
+        else:
+            board[key] = blocked
+    return board, groups
+
+
+def render_group_resolver(name):
+    """Write one group's resolver config from its blocklist; returns whether it changed"""
+    blocklist = GROUP_BLOCKLISTS.setdefault(name, Blocklist())
+    if DNS_SINKHOLE:
+        return False
+    with RENDER_SECONDS.time(file="group"):
+        return write_managed_file(DEVICE_GROUPS.resolver_file(name),
+                                  DEVICE_GROUPS.render_resolver_header(name) + blocklist.render_addresses())
+
+
+def render_groups():
+    """Write the main dnsmasq's group include, host tags and DNS options
+
+    Returns the set of files that were rewritten: "dnsmasq" for the include
+    (needs a restart, but only changes the first time), "groups" for the
+    host and option files (a SIGHUP re-reads them).
+    """
+    changed = set()
+    if DNS_SINKHOLE:
+        # The sinkhole tells groups apart by client address, so every device
+        # keeps the main resolver
+        if os.path.exists(GROUPS_CONF):
+            os.unlink(GROUPS_CONF)
+            _managed_hashes.pop(GROUPS_CONF, None)
+            changed.add("dnsmasq")
+        return changed
+    if not len(DEVICE_GROUPS) and not os.path.exists(GROUPS_CONF):
+        return changed
+    os.makedirs(DEVICE_GROUPS.directory, exist_ok=True)
+    with RENDER_SECONDS.time(file="groups"):
+        if write_managed_file(GROUPS_CONF, DEVICE_GROUPS.render_main_conf()):
+            changed.add("dnsmasq")
+        if write_managed_file(DEVICE_GROUPS.hosts_file, DEVICE_GROUPS.render_hosts()):
+            changed.add("groups")
+        if write_managed_file(DEVICE_GROUPS.opts_file, DEVICE_GROUPS.render_opts()):
+            changed.add("groups")
+    return changed
+
+
+def apply_website_changes(changes):
+    """Apply a batch of {key: blocked} changes to the blocklists and render each changed file once
+
+    Board-wide keys are domains; group keys are (group, domain). Returns the
+    set of files that were rewritten ("hosts", "dnsmasq", "group:<name>").
+    """
+    changed = set()
+    board, groups = _split_changes(changes)
+
+    for name, group_changes in groups.items():
+        # Changes still queued for a group removed since are dropped
+        if name in DEVICE_GROUPS and GROUP_BLOCKLISTS.setdefault(name, Blocklist()).apply(group_changes):
+            if render_group_resolver(name):
+                changed.add("group:" + name)
+
+    # The sinkhole answers from BLOCKLIST itself: nothing to render or reload
+    if not board or not BLOCKLIST.apply(board) or DNS_SINKHOLE:
+        return changed
+
+    # Method 1: /etc/hosts (for Pi itself)
+    with RENDER_SECONDS.time(file="hosts"):
+        if write_managed_block(HOSTS_FILE, BLOCKLIST.render_hosts()):
+            changed.add("hosts")
+
+    # Method 2: DNSMasq (for all network clients)
+    with RENDER_SECONDS.time(file="dnsmasq"):
+        if write_managed_file(DNSMASQ_CONF, BLOCKLIST.render_dnsmasq()):
+            changed.add("dnsmasq")
+
+    return changed
+
+
+def restore_website_blocks(keys):
+    """Rebuild the blocklists from the database rows in one pass at startup
+
+    The files left on disk by the previous run are compared by content hash,
+    so after a restart or power cut with no policy changes nothing is
+    rewritten and dnsmasq keeps running untouched. Returns the set of files
+    that were rewritten.
+    """
+    board, groups = _split_changes(dict.fromkeys(keys, True))
+    BLOCKLIST.load(board)
+    # Under the sinkhole the files block nothing, or an unblock would still
+    # wait for a dnsmasq restart
+    rendered = Blocklist() if DNS_SINKHOLE else BLOCKLIST
+    changed = set()
+    with RENDER_SECONDS.time(file="hosts"):
+        if write_managed_block(HOSTS_FILE, rendered.render_hosts()):
+            changed.add("hosts")
+    with RENDER_SECONDS.time(file="dnsmasq"):
+        if write_managed_file(DNSMASQ_CONF, rendered.render_dnsmasq()):
+            changed.add("dnsmasq")
+
+    changed |= render_groups()
+    GROUP_BLOCKLISTS.clear()
+    for name in DEVICE_GROUPS.names():
+        GROUP_BLOCKLISTS[name] = Blocklist()
+        GROUP_BLOCKLISTS[name].load(groups.get(name, ()))
+        if render_group_resolver(name):
+            changed.add("group:" + name)
+    return changed
+
+
+def match_policy(name, client):
+    """Key of the policy blocking a DNS query from client (board-wide first, then the client's group), or None"""
+    found = BLOCKLIST.match(name)
+    if found is not None:
+        return policy_key(found)
+    if GROUP_BLOCKLISTS:
+        lease = DEVICE_BLOCKS.leases.by_ip(client)
+        group = DEVICE_GROUPS.group_of(lease.mac) if lease is not None and lease.mac else None
+        if group in GROUP_BLOCKLISTS:
+            found = GROUP_BLOCKLISTS[group].match(name)
+            if found is not None:
+                return policy_key(found, group)
+    return None
+
+
+def _dnsmasq_pid():
+    """Return the PID of the running dnsmasq, or None"""
+    try:
+        with open(DNSMASQ_PID_FILE, 'r') as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+        return pid
+    except (OSError, ValueError):
+        return None
+
+
+def reload_dnsmasq(restart=True):
+    """Make dnsmasq pick up new files: SIGHUP when enough, full restart otherwise
+
+    SIGHUP re-reads /etc/hosts and clears the cache, but address= lines in
+    dnsmasq.d only take effect after a restart.
+    """
+    start = time.perf_counter()
+    if not restart:
+        pid = _dnsmasq_pid()
+        if pid:
+            try:
+                os.kill(pid, signal.SIGHUP)
+                DNSMASQ_RELOAD_SECONDS.observe(time.perf_counter() - start, kind="sighup")
+                return "sighup"
+            except OSError:
+                pass
+    subprocess.run(DNSMASQ_RESTART_COMMAND,
+                 check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    DNSMASQ_RELOAD_SECONDS.observe(time.perf_counter() - start, kind="restart")
+    return "restart"
+
+
+def run_group_resolver(name, action="restart"):
+    """Start, restart or stop one group's resolver with GROUP_RESOLVER_COMMAND"""
+    start = time.perf_counter()
+    subprocess.run([arg.format(action=action, group=name) for arg in GROUP_RESOLVER_COMMAND],
+                   check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    DNSMASQ_RELOAD_SECONDS.observe(time.perf_counter() - start, kind="group_" + action)
+
+
+def reload_changed(changed):
+    """Reload whatever reads the rewritten files; returns the kinds of reload done
+
+    The main dnsmasq is restarted for its address= lines and sent SIGHUP for
+    the hosts and group files; a group resolver is restarted only when its
+    own blocklist changed.
+    """
+    kinds = []
+    if changed & {"dnsmasq", "hosts", "groups"}:
+        kinds.append(reload_dnsmasq(restart="dnsmasq" in changed))
+    for item in sorted(changed):
+        if item.startswith("group:"):
+            run_group_resolver(item[len("group:"):])
+            kinds.append("group_restart")
+    return kinds
+
+
+class ReloadScheduler:
+    """Collect block/unblock changes over a short window and apply the net change once"""
+
+    def __init__(self, window=RELOAD_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._apply_lock = threading.Lock()
+        self._pending = {}
+        self._submitted = 0
+        self._timer = None
+        # Submissions are numbered; wait() finds the flush that covered one
+        # in the (last number, error) results of recent flushes
+        self._flushed = threading.Condition(self._lock)
+        self._seq = 0
+        self._done = 0
+        self._results = collections.deque(maxlen=64)
+        self.last_error = None
+        self.stats = {
+            "changes_submitted": 0,
+            "changes_applied": 0,
+            "flushes": 0,
+            "failures": 0,
+            "restarts": 0,
+            "sighups": 0,
+            "group_restarts": 0,
+            "reloads_avoided": 0,
+        }
+
+    def submit(self, domain, blocked):
+        """Queue a change; the latest request for a domain wins"""
+        self.submit_many({domain: blocked})
+
+    def submit_many(self, changes):
+        """Queue a batch of {domain: blocked} changes in one step"""
+        with self._lock:
+            self._pending.update(changes)
+            self._submitted += len(changes)
+            self._seq += 1
+            self.stats["changes_submitted"] += len(changes)
+            if self._timer is None and self.window > 0:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        # No window (sinkhole mode, where applying is only an index update)
+        if self.window <= 0:
+            self.flush()
+
+    def flush(self):
+        """Apply all pending changes now with at most one reload per dnsmasq instance"""
+        with self._apply_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                pending, self._pending = self._pending, {}
+                submitted, self._submitted = self._submitted, 0
+                seq = self._seq
+            if not pending:
+                self._finished(seq, None)
+                return True
+
+            error = None
+            try:
+                changed = apply_website_changes(pending)
+            except PermissionError:
+                error = "Permission denied - run with sudo"
+                changed = None
+            except Exception as e:
+                error = "Failed to apply %d changes: %s" % (len(pending), str(e))
+                changed = None
+            if error:
+                reload_log.error("%s", error)
+
+            kinds = reload_changed(changed) if changed else []
+            for kind in kinds:
+                self.stats[kind + "s"] += 1
+            reloads = len(kinds)
+
+            with self._lock:
+                self.stats["flushes"] += 1
+                self.stats["changes_applied"] += len(pending)
+                # The old code restarted dnsmasq once per submitted change
+                self.stats["reloads_avoided"] += submitted - reloads
+            self._finished(seq, error)
+
+            reload_log.info("Applied %d changes (%s) with %d reload(s)",
+                            len(pending), ", ".join(sorted(changed)) if changed else "no file changes", reloads)
+            return changed is not None
+
+    def _finished(self, seq, error):
+        """Record that every submission up to seq was applied (error is None) or failed"""
+        with self._lock:
+            if error:
+                self.stats["failures"] += 1
+                self.last_error = {"message": error, "time": time.time()}
+            self._done = seq
+            self._results.append((seq, error))
+            self._flushed.notify_all()
+
+    def wait(self, timeout=RELOAD_WAIT_TIMEOUT):
+        """Wait for everything submitted so far to be applied; returns None, or why it was not"""
+        with self._lock:
+            target = self._seq
+            if not self._flushed.wait_for(lambda: self._done >= target, timeout):
+                return "Timed out waiting for the blocklist files to be written"
+            for seq, error in self._results:
+                if seq >= target:
+                    return error
+            return None
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._pending)
+            stats["window"] = self.window
+            stats["last_error"] = self.last_error
+        return stats
+
+
+RELOAD_SCHEDULER = ReloadScheduler()
+
+
+# ==================== SCHEDULER ====================
+
+class PolicyScheduler:
+    """Activate and deactivate scheduled policies exactly at their window boundaries
+
+    Upcoming transitions sit in a min-heap of (time, generation, domain);
+    the thread sleeps until the earliest one instead of polling, and all
+    transitions that fall due together are applied in one batched flush.
+    Replacing or removing a policy bumps its generation, which lazily
+    invalidates its stale heap entry, so every update costs O(log n).
+    Due transitions are submitted on the writer thread, after checking
+    that no mutation replaced or removed their policy since they were due.
+    """
+
+    def __init__(self, reload_scheduler):
+        self._reload = reload_scheduler
+        self._writer = None
+        self._cond = threading.Condition()
+        self._heap = []
+        self._entries = {}
+        self._generation = itertools.count()
+        self._thread = None
+        self._stopped = False
+        self.transitions = 0
+
+    def _next_time(self, compiled, now):
+        """Timestamp of the next transition after now
+
+        Windows are in local wall-clock minutes, so the target minute is
+        counted on the wall clock and converted back with mktime(): across
+        a DST change it is not a fixed number of seconds away.
+        """
+        local = time.localtime(now)
+        wall = datetime(*local[:5]) + timedelta(minutes=compiled.minutes_until_next(minute_of_week(now)))
+        fields = wall.timetuple()[:6] + (0, 0, -1)
+        when = time.mktime(fields)
+        if when <= now and time.localtime(when + 3600)[:5] == fields[:5]:
+            # The hour repeated when DST ends: mktime() chose its first pass, already behind us
+            when += 3600
+        # A minute skipped when DST starts can map behind now: look again a minute later
+        return max(when, int(now) - local.tm_sec + 60)
+
+    def set_policy(self, domain, schedule, now=None):
+        """Register or replace a policy's schedule; returns whether it is active now"""
+        compiled = compile_schedule(schedule)
+        if now is None:
+            now = time.time()
+        with self._cond:
+            generation = next(self._generation)
+            self._entries[domain] = (compiled, generation)
+            if not compiled.always:
+                entry = (self._next_time(compiled, now), generation, domain)
+                heapq.heappush(self._heap, entry)
+                if self._heap[0] is entry:
+                    self._cond.notify()
+        return compiled.active(minute_of_week(now))
+
+    def remove_policy(self, domain):
+        with self._cond:
+            self._entries.pop(domain, None)
+
+    def is_active(self, domain):
+        with self._cond:
+            entry = self._entries.get(domain)
+        if entry is None:
+            return False
+        return entry[0].active(minute_of_week(time.time()))
+
+    def start(self, writer=None):
+        """Start the thread; writer (the WriteQueue) serializes transitions with policy mutations"""
+        if self._thread is None:
+            self._writer = writer
+            self._thread = threading.Thread(target=self._run, name="policy-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _pop_due(self):
+        """Wait for the next due transition; returns {domain: (active, generation)} or None when stopped"""
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    break
+                timeout = self._heap[0][0] - now if self._heap else SCHEDULER_MAX_SLEEP
+                self._cond.wait(min(timeout, SCHEDULER_MAX_SLEEP))
+            if self._stopped:
+                return None
+
+            now = time.time()
+            minute = minute_of_week(now)
+            changes = {}
+            while self._heap and self._heap[0][0] <= now:
+                _, generation, domain = heapq.heappop(self._heap)
+                entry = self._entries.get(domain)
+                if entry is None or entry[1] != generation:
+                    continue
+                changes[domain] = (entry[0].active(minute), generation)
+                heapq.heappush(self._heap, (self._next_time(entry[0], now), generation, domain))
+            return changes
+
+    def _apply(self, changes):
+        """Submit the transitions whose policy is still the one that fell due; returns them"""
+        with self._cond:
+            changes = dict((domain, active) for domain, (active, generation) in changes.items()
+                           if self._entries.get(domain, (None, None))[1] == generation)
+            self.transitions += len(changes)
+        if changes:
+            self._reload.submit_many(changes)
+        return changes
+
+    def _run(self):
+        while True:
+            changes = self._pop_due()
+            if changes is None:
+                return
+            if not changes:
+                continue
+            # On the writer thread, so an unblock cannot land between the check and the submit
+            if self._writer is not None:
+                changes = self._writer.call(self._apply, changes)
             else:
-                with open('/etc/hosts', 'a') as f:
-                    f.write("\n# SEER Policy %s\n" % datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                    f.write("127.0.0.1 %s\n" % domain)
-                    f.write("127.0.0.1 www.%s\n" % domain)
-
-        # Method 2: Add to DNSMasq (for all network clients)
-        dnsmasq_file = "/etc/dnsmasq.d/blocked-sites.conf"
-        
-        # Read current blocks
-        blocked_domains = set()
+                changes = self._apply(changes)
+            if not changes:
+                continue
+            scheduler_log.info("%d transition(s): %d activated, %d deactivated",
+                               len(changes), sum(changes.values()), len(changes) - sum(changes.values()))
+            self._reload.flush()
+
+    def get_stats(self):
+        with self._cond:
+            next_due = self._heap[0][0] if self._heap else None
+            return {
+                "policies": len(self._entries),
+                "scheduled": sum(1 for compiled, _ in self._entries.values() if not compiled.always),
+                "transitions": self.transitions,
+                "next_transition": datetime.fromtimestamp(next_due).isoformat() if next_due else None,
+            }
+
+
+POLICY_SCHEDULER = PolicyScheduler(RELOAD_SCHEDULER)
+
+# Lease removal only takes effect after a full restart
+DEVICE_BLOCKS = DeviceBlockManager(STORAGE, create_backend(FIREWALL_BACKEND), lambda: reload_dnsmasq(restart=True))
+
+DEVICE_GROUPS = DeviceGroupManager(STORAGE)
+
+# The DNS front end when DNS_SINKHOLE is on; started by start_server()
+SINKHOLE = None
+
+QUERY_LOG_TAILER = QueryLogTailer(match_policy, QUERY_LOG_FILE, QUERY_LOG_STATE)
+
+# The POLICY_FILE and its watcher; created by start_server()
+POLICY_FILE_STORE = None
+POLICY_FILE_WATCHER = None
+
+# Served under "process" in /stats; "socket" is "inherited" from systemd or an
+# in-place restart, or "bound" by this process
+PROCESS = {"pid": os.getpid(), "started": None, "socket": None}
+
+
+# ==================== POLICY STATE ====================
+
+class WriteQueue:
+    """Single writer thread that serializes every mutation of POLICIES and the managed files
+
+    Request threads submit work and wait on the returned Future; reads never
+    go through the queue and are served from POLICY_SNAPSHOT.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="policy-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Finish queued mutations, then stop the writer thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def submit(self, func, *args):
+        future = Future()
+        if self._thread is None:
+            # Not started (startup, tools): run inline on the caller's thread
+            self._execute(future, func, args)
+        else:
+            self._queue.put((future, func, args))
+        return future
+
+    def call(self, func, *args):
+        return self.submit(func, *args).result()
+
+    def _execute(self, future, func, args):
+        if not future.set_running_or_notify_cancel():
+            return
         try:
-            with open(dnsmasq_file, 'r') as f:
-                for line in f:
-                    if line.startswith("address=/"):
-                        blocked_domains.add(line.strip())
-        except:
-            pass
-        
-        # Add new blocks (including wildcard for all subdomains)
-        new_entries = [
-            "address=/%s/127.0.0.1" % domain,
-            "address=/.%s/127.0.0.1" % domain  # Wildcard for all subdomains
-        ]
-        
-        for entry in new_entries:
-            blocked_domains.add(entry)
-        
-        # Write back to file
-        with open(dnsmasq_file, 'w') as f:
-            f.write("# SEER Temporal Policy - Blocked Domains\n")
-            f.write("# This file is managed by temporal_policy.py\n")
-            f.write("# Last updated: %s\n\n" % datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-            for entry in sorted(blocked_domains):
-                f.write(entry + "\n")
-        
-        # Restart DNSMasq to apply changes
-        subprocess.run(['systemctl', 'restart', 'dnsmasq'],
-                     check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        print("[STARTUP] Applied block: %s" % domain)
-        return True
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._execute(*item)
+
+
+WRITE_QUEUE = WriteQueue()
+
+
+class PolicySnapshot:
+    """Immutable view of POLICIES at one revision, with its JSON encoding cached
+
+    Policy objects are replaced, never mutated, once they are in POLICIES,
+    so a shallow tuple copy is enough. The encoded list is built on first use
+    and shared by every GET and POST response until the next mutation.
+    """
+
+    __slots__ = ("revision", "policies", "etag", "_policies_json")
+
+    def __init__(self, revision, policies):
+        self.revision = revision
+        self.policies = policies
+        # Revisions restart with the process, so the ETag carries the process epoch too
+        self.etag = '"%x-%d"' % (_SNAPSHOT_EPOCH, revision)
+        self._policies_json = None
+
+    def __len__(self):
+        return len(self.policies)
+
+    def policies_json(self):
+        if self._policies_json is None:
+            self._policies_json = encode_policies(self.policies)
+        return self._policies_json
+
+
+_SNAPSHOT_EPOCH = int(time.time() * 1000)
+
+# Recent (revision, change) pairs, oldest first
+CHANGE_LOG = collections.deque(maxlen=CHANGE_LOG_SIZE)
+_change_log_lock = threading.Lock()
+# Clients older than this revision cannot be served from CHANGE_LOG
+_change_log_floor = 0
+
+
+def publish_policies(changes=(), reset=False):
+    """Publish a new revision of POLICIES for lock-free readers (writer thread only)
+
+    changes is a list of {"op": "upsert", "policy": ...} or
+    {"op": "delete", "destination": ...} entries for the change feed;
+    reset=True marks a wholesale replacement that clients must refetch.
+    """
+    global POLICY_SNAPSHOT, _change_log_floor
+    revision = POLICY_SNAPSHOT.revision + 1 if POLICY_SNAPSHOT is not None else 1
+    with _change_log_lock:
+        if reset:
+            CHANGE_LOG.clear()
+            _change_log_floor = revision
+        CHANGE_LOG.extend((revision, change) for change in changes)
+    POLICY_SNAPSHOT = PolicySnapshot(revision, tuple(POLICIES))
+    if POLICY_FILE_STORE is not None and changes:
+        try:
+            POLICY_FILE_STORE.append(
+                [change["policy"] for change in changes if change["op"] == "upsert"],
+                [(change["destination"], change.get("source")) for change in changes if change["op"] == "delete"])
+        except OSError as e:
+            policy_log.warning("Could not journal changes to %s: %s", POLICY_FILE_STORE.path, str(e))
+
+
+def changes_since(revision):
+    """Changes after revision, or None if the log no longer reaches back that far"""
+    with _change_log_lock:
+        floor = _change_log_floor
+        if len(CHANGE_LOG) == CHANGE_LOG.maxlen:
+            # The oldest revision may have been partly evicted
+            floor = max(floor, CHANGE_LOG[0][0])
+        # Ahead of us: the client's revision is from before a restart
+        if revision < floor or revision > POLICY_SNAPSHOT.revision:
+            return None
+        changes = []
+        for rev, change in reversed(CHANGE_LOG):
+            if rev <= revision:
+                break
+            change = dict(change, revision=rev)
+            if "policy" in change:
+                change["policy"] = change["policy"].to_dict()
+            changes.append(change)
+    changes.reverse()
+    return changes
+
+
+publish_policies(reset=True)
+
+
+def parse_source(source):
+    """Validate a policy source; returns None for board-wide or the name of a defined group"""
+    if source is None or str(source).strip().lower() in BOARD_SOURCES:
+        return None
+    name = normalize_group(source)
+    if name not in DEVICE_GROUPS:
+        raise ValueError("Unknown group: %s" % name)
+    return name
+
+
+def _delete_change(domain, source):
+    change = {"op": "delete", "destination": domain}
+    if source is not None:
+        change["source"] = source
+    return change
+
+
+def block_website(domain, schedule=None, source=None):
+    """Block a domain board-wide or for one group and record its policy; runs on the writer thread"""
+    try:
+        policy = Policy(domain, schedule or DEFAULT_SCHEDULE, source=source)
+        domain = policy.destination
+        key = policy_key(domain, policy.source)
+
+        # ========== SAVE TO DATABASE ==========
+        save_blocked_website_to_db(domain, policy.schedule, policy.source)
+
+        # Outside its schedule window the policy is only armed; the scheduler activates it later
+        active = POLICY_SCHEDULER.set_policy(key, policy.schedule)
+
+        # /etc/hosts and DNSMasq are updated by the reload scheduler, batched with other changes
+        RELOAD_SCHEDULER.submit(key, active)
+
+        # Check if policy already exists
+        for i, p in enumerate(POLICIES):
+            if p.destination == domain and p.source == policy.source:
+                policy = POLICIES[i] = p.replace(enabled=True, schedule=policy.schedule)
+                break
+        else:
+            POLICIES.append(policy)
+        publish_policies([{"op": "upsert", "policy": policy}])
+
+        if policy.source is None:
+            policy_log.info("Blocked: %s (via /etc/hosts and DNSMasq)", domain)
+            parent = BLOCKLIST.covering(domain)
+        else:
+            policy_log.info("Blocked: %s for group %s", domain, policy.source)
+            parent = GROUP_BLOCKLISTS.setdefault(policy.source, Blocklist()).covering(domain)
+        if parent:
+            return True, "%s blocked successfully (already covered by %s)" % (domain, parent)
+        return True, "%s blocked successfully" % domain
+
     except Exception as e:
-        print("[STARTUP ERROR] Failed to apply block %s: %s" % (domain, str(e)))
-        return False
+        return False, "Error blocking %s: %s" % (domain, str(e))
+
+
+def unblock_website(domain, source=None):
+    """Unblock a domain board-wide or for one group and drop its policy; runs on the writer thread"""
+    try:
+        key = policy_key(domain, source)
+
+        # ========== REMOVE FROM DATABASE ==========
+        remove_blocked_website_from_db(domain, source)
+
+        POLICY_SCHEDULER.remove_policy(key)
+        RELOAD_SCHEDULER.submit(key, False)
+
+        POLICIES[:] = [p for p in POLICIES if p.destination != domain or p.source != source]
+        publish_policies([_delete_change(domain, source)])
+
+        if source is None:
+            policy_log.info("Unblocked: %s (from /etc/hosts and DNSMasq)", domain)
+        else:
+            policy_log.info("Unblocked: %s for group %s", domain, source)
+        return True, "%s unblocked successfully" % domain
+
+    except Exception as e:
+        return False, "Error unblocking %s: %s" % (domain, str(e))
+
+
+def parse_bulk_entry(item, default_action="block", default_schedule=None, default_source=None):
+    """Validate one bulk entry (a domain string or an object); returns (action, domain, schedule, source)"""
+    if isinstance(item, str):
+        item = {"domain": item}
+    if not isinstance(item, dict):
+        raise ValueError("Entry must be a domain or an object")
+
+    action = item.get("action", default_action)
+    if action not in ("block", "unblock"):
+        raise ValueError("Unknown action: %s" % action)
+
+    domain = validate_domain(item.get("domain") or item.get("destination") or item.get("website"))
+
+    source = parse_source(item.get("source", default_source))
+
+    schedule = None
+    if action == "block":
+        schedule = compile_schedule(item.get("schedule") or default_schedule or DEFAULT_SCHEDULE)
+    return action, domain, schedule, source
+
+
+def apply_bulk_changes(entries):
+    """Apply many validated (action, domain, schedule, source) entries; runs on the writer thread
+
+    All entries share one SQLite transaction, one render of the managed
+    files and one reload per dnsmasq instance. The last entry for a domain
+    and source wins.
+    """
+    try:
+        net = {}
+        for action, domain, schedule, source in entries:
+            net.pop((domain, source), None)
+            net[(domain, source)] = (action, schedule)
+        blocked = [(d, schedule, source or SOURCE_ALL)
+                   for (d, source), (action, schedule) in net.items() if action == "block"]
+        unblocked = [(d, source or SOURCE_ALL) for (d, source), (action, _) in net.items() if action == "unblock"]
+
+        if not save_blocked_websites_bulk(blocked, unblocked):
+            return False, "Database error, no changes applied"
+
+        changes = {}
+        feed = []
+        index = dict(((p.destination, p.source), i) for i, p in enumerate(POLICIES))
+        for (domain, source), (action, schedule) in net.items():
+            if action == "block":
+                if (domain, source) in index:
+                    i = index[(domain, source)]
+                    policy = POLICIES[i] = POLICIES[i].replace(enabled=True, schedule=schedule)
+                else:
+                    policy = Policy(domain, schedule, source=source)
+                    index[(domain, source)] = len(POLICIES)
+                    POLICIES.append(policy)
+                key = policy_key(policy.destination, source)
+                changes[key] = POLICY_SCHEDULER.set_policy(key, schedule)
+                feed.append({"op": "upsert", "policy": policy})
+            else:
+                key = policy_key(domain, source)
+                POLICY_SCHEDULER.remove_policy(key)
+                changes[key] = False
+                feed.append(_delete_change(domain, source))
+
+        if unblocked:
+            removed = set(key for key, (action, _) in net.items() if action == "unblock")
+            POLICIES[:] = [p for p in POLICIES if (p.destination, p.source) not in removed]
+        publish_policies(feed)
+        RELOAD_SCHEDULER.submit_many(changes)
+        RELOAD_SCHEDULER.flush()
+        error = RELOAD_SCHEDULER.wait()
+
+        policy_log.info("Bulk update: %d blocked, %d unblocked", len(blocked), len(unblocked))
+        if error:
+            return False, "%d blocked, %d unblocked in the database, but not applied: %s" % (
+                len(blocked), len(unblocked), error)
+        return True, "%d blocked, %d unblocked" % (len(blocked), len(unblocked))
+
+    except Exception as e:
+        return False, "Error applying bulk update: %s" % str(e)
+
+
+def define_group(name, address):
+    """Create a group or move it to another resolver address; runs on the writer thread"""
+    group = DEVICE_GROUPS.define(name, address)
+    changed = render_groups()
+    if render_group_resolver(group.name):
+        changed.add("group:" + group.name)
+    reload_changed(changed)
+    return group
+
+
+def remove_group(name):
+    """Delete a group that has no policies left and stop its resolver; runs on the writer thread"""
+    name = normalize_group(name)
+    count = sum(1 for p in POLICIES if p.source == name)
+    if count:
+        raise ValueError("Group %s still has %d policies" % (name, count))
+    macs = DEVICE_GROUPS.remove(name)
+    GROUP_BLOCKLISTS.pop(name, None)
+    run_group_resolver(name, "stop")
+    path = DEVICE_GROUPS.resolver_file(name)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    _managed_hashes.pop(path, None)
+    reload_changed(render_groups())
+    return macs
+
+
+def assign_devices(name, devices):
+    """Move (mac, ip) devices into a group; only their host file lines change. Runs on the writer thread"""
+    moved = DEVICE_GROUPS.assign(name, devices)
+    if moved:
+        reload_changed(render_groups())
+    return moved
+
+
+def unassign_devices(macs):
+    """Take devices out of their groups; runs on the writer thread"""
+    grouped = DEVICE_GROUPS.unassign(macs)
+    if grouped:
+        reload_changed(render_groups())
+    return grouped
+
+
+def parse_policy_file_entry(item):
+    """Policies in one policy file entry (destination and "domains"), validated like bulk entries"""
+    policies = []
+    for domain in entry_domains(item):
+        _, domain, schedule, source = parse_bulk_entry(
+            {"domain": domain, "schedule": item.get("schedule"), "source": item.get("source")})
+        policies.append(Policy(domain, schedule, item.get("enabled", True), source, entry_name(item)))
+    return policies
+
+
+def apply_policy_file_changes(upserts, deleted):
+    """Bring POLICIES in line with policies added, changed or removed in POLICY_FILE; runs on the writer thread
+
+    Only differences from the running set become changes; a disabled
+    policy in the file removes the running one.
+    """
+    running = dict(((p.destination, p.source), p) for p in POLICIES)
+    entries = []
+    for policy in upserts:
+        current = running.get((policy.destination, policy.source))
+        if not policy.enabled:
+            if current is not None:
+                entries.append(("unblock", policy.destination, None, policy.source))
+        elif current is None or not current.enabled or current.schedule.json != policy.schedule.json:
+            entries.append(("block", policy.destination, policy.schedule, policy.source))
+    for destination, source in deleted:
+        if (destination, source) in running:
+            entries.append(("unblock", destination, None, source))
+    if not entries:
+        return True, "Policy file matches the running policies"
+    policy_log.info("Applying %d changes from %s", len(entries), POLICY_FILE)
+    return apply_bulk_changes(entries)
 
 
 def load_and_apply_blocked_websites():
     """Load blocked websites from database and apply them on startup"""
-    print("\n[STARTUP] Loading blocked websites from database...")
-    websites = load_blocked_websites_from_db()
-    
-    if not websites:
-        print("[STARTUP] No blocked websites found in database")
+    startup_log.info("Loading blocked websites from database...")
+    with startup_phase("query"):
+        websites = load_blocked_websites_from_db()
+        DEVICE_GROUPS.load()
+
+    if not websites and not len(DEVICE_GROUPS):
+        BLOCKLIST.load([])
+        startup_log.info("No blocked websites found in database")
         return
     
-    print("[STARTUP] Applying %d blocked websites..." % len(websites))
-    
-    for website in websites:
-        print("[STARTUP] Processing: %s" % website)
-        if apply_block_website(website):
+    startup_log.info("Applying %d blocked websites...", len(websites))
+
+    with startup_phase("schedule"):
+        known = set((p.destination, p.source) for p in POLICIES)
+        active = []
+        now = time.time()
+        for row in websites:
+            source = None if row["source"] == SOURCE_ALL else row["source"]
+            if source is not None and source not in DEVICE_GROUPS:
+                startup_log.warning("Skipping %s: group %s no longer exists", row["domain"], source)
+                continue
+            try:
+                schedule = compile_schedule(row["schedule"] or DEFAULT_SCHEDULE)
+            except ValueError as e:
+                startup_log.warning("Invalid schedule for %s (%s), using all day", row["domain"], str(e))
+                schedule = compile_schedule(DEFAULT_SCHEDULE)
+            policy = Policy(row["domain"], schedule, source=source, restored_from_db=True)
+            website = policy.destination
+            key = policy_key(website, policy.source)
+            if POLICY_SCHEDULER.set_policy(key, schedule, now):
+                active.append(key)
             # Add to POLICIES list
-            existing = any(p.get("destination") == website for p in POLICIES)
-            if not existing:
-                POLICIES.append({
-                    "destination": website,
-                    "enabled": True,
-                    "schedule": {"start": "00:00", "end": "23:59"},
-                    "restored_from_db": True
-                })
+            if (website, policy.source) not in known:
+                known.add((website, policy.source))
+                POLICIES.append(policy)
+        publish_policies(reset=True)
+
+    # Restore straight from the rows instead of replaying each one as a change
+    with startup_phase("restore"):
+        try:
+            changed = restore_website_blocks(active)
+        except Exception as e:
+            startup_log.error("Failed to apply blocked websites: %s", str(e))
+            changed = set()
+
+    with startup_phase("reload"):
+        if changed:
+            reload_changed(changed)
+            startup_log.info("Rewrote %s", ", ".join(sorted(changed)))
         else:
-            print("[STARTUP] Failed to apply: %s" % website)
-    
-    print("[STARTUP] ✅ Startup restoration complete! %d websites are blocked" % len(POLICIES))
-    print("=" * 60)
+            startup_log.info("Managed files already up to date, dnsmasq left running")
+        # Unchanged group resolvers may simply not be running yet (after boot)
+        for name in DEVICE_GROUPS.names() if not DNS_SINKHOLE else ():
+            if "group:" + name not in changed:
+                run_group_resolver(name, "start")
+
+    startup_log.info("✅ Startup restoration complete! %d websites are blocked", len(POLICIES))
+
+
+def truncate_body(body, limit=None):
+    """Shorten a request body for the log"""
+    limit = LOG_BODY_LIMIT if limit is None else limit
+    if len(body) <= limit:
+        return body
+    return "%s... (%d more characters)" % (body[:limit], len(body) - limit)
 
 
 class PolicyHandler(BaseHTTPRequestHandler):
 
     def log_message(self, format, *args):
-        print("[%s] %s" % (datetime.now().strftime('%H:%M:%S'), format % args))
+        http_log.info("%s " + format, self.address_string(), *args)
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
 
-    def _set_headers(self, code=200):
+    def _instrumented(self, method, handler):
+        """Run a request handler, recording its latency per action and profiling it on request"""
+        self.action = "other"
+        self.status_code = None
+        start = time.perf_counter()
+        try:
+            with PROFILER.profile(self.headers, lambda: "%s-%s" % (method, self.action)):
+                handler()
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, method=method, action=self.action)
+            REQUESTS.inc(method=method, action=self.action, code=self.status_code or 0)
+
+    def _set_headers(self, code=200, etag=None):
         self.send_response(code)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
         self.send_header("Content-Type", "application/json")
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Connection", "close")
         self.end_headers()
 
+    def _send_json(self, code, payload):
+        self._set_headers(code)
+        self.wfile.write(json.dumps(payload).encode("utf-8"))
+        self.wfile.flush()
+
+    def _send_policies(self, code, snapshot, **fields):
+        """Send fields plus the snapshot's cached policy list without re-encoding it"""
+        fields["count"] = len(snapshot)
+        fields["revision"] = snapshot.revision
+        head = json.dumps(fields)
+        self._set_headers(code, snapshot.etag)
+        self.wfile.write(('%s, "policies": %s}' % (head[:-1], snapshot.policies_json())).encode("utf-8"))
+        self.wfile.flush()
+
+    def _get_policies(self, query):
+        snapshot = POLICY_SNAPSHOT
+        if snapshot.etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", snapshot.etag)
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            return
+
+        if "offset" not in query and "limit" not in query:
+            http_log.debug("GET request - returning %d policies", len(snapshot))
+            self._send_policies(200, snapshot, status="ok")
+            return
+
+        try:
+            offset = max(int(query.get("offset", ["0"])[0]), 0)
+            limit = min(max(int(query.get("limit", [str(MAX_PAGE_SIZE)])[0]), 0), MAX_PAGE_SIZE)
+        except ValueError:
+            self._send_json(400, {"status": "error", "message": "offset and limit must be integers"})
+            return
+        self._set_headers(200, snapshot.etag)
+        self.wfile.write(json.dumps({
+            "status": "ok",
+            "policies": [policy.to_dict() for policy in snapshot.policies[offset:offset + limit]],
+            "count": len(snapshot),
+            "offset": offset,
+            "limit": limit,
+            "revision": snapshot.revision
+        }).encode("utf-8"))
+        self.wfile.flush()
+
+    def _get_changes(self, query):
+        snapshot = POLICY_SNAPSHOT
+        try:
+            since = int(query.get("since", ["0"])[0])
+        except ValueError:
+            self._send_json(400, {"status": "error", "message": "since must be an integer"})
+            return
+        changes = changes_since(since)
+        if changes is None:
+            # Too far behind: the client has to refetch the full list
+            self._send_json(200, {"status": "ok", "reset": True, "revision": snapshot.revision, "changes": []})
+            return
+        self._send_json(200, {"status": "ok", "reset": False, "revision": snapshot.revision, "changes": changes})
+
+    def _get_blocked_devices(self, query):
+        """List active device blocks from memory, sorted by expiry
+
+        Filters: mac, ip, hostname (substring), expires_after/expires_before
+        (UNIX time). order=desc, offset/limit, and format=array for a bare
+        list as printed by list_blocked_devices.sh.
+        """
+        def param(name):
+            return query.get(name, [None])[0]
+
+        try:
+            blocks = DEVICE_BLOCKS.blocked(
+                mac=param("mac"),
+                ip=param("ip"),
+                hostname=param("hostname"),
+                expires_after=float(param("expires_after")) if param("expires_after") else None,
+                expires_before=float(param("expires_before")) if param("expires_before") else None,
+                descending=param("order") == "desc")
+            offset = max(int(param("offset") or 0), 0)
+            # Without a limit the whole list is returned, as list_blocked_devices.sh expects
+            limit = min(max(int(param("limit")), 0), MAX_PAGE_SIZE) if param("limit") else None
+        except ValueError as e:
+            self._send_json(400, {"status": "error", "message": str(e)})
+            return
+        total = len(blocks)
+        page = blocks[offset:offset + limit if limit is not None else None]
+
+        # Each block's JSON is encoded once and reused across requests
+        devices = "[%s]" % ", ".join(block.json() for block in page)
+        if param("format") == "array":
+            body = devices
+        else:
+            body = '{"status": "ok", "count": %d, "devices": %s}' % (total, devices)
+        self._set_headers(200)
+        self.wfile.write(body.encode("utf-8"))
+        self.wfile.flush()
+
+    def _get_queries(self, path, query):
+        """Query log counts: /queries (overview), /queries/policies, /queries/devices
+
+        Counts are Space-Saving estimates: exact until a summary fills up,
+        after which each entry's count may be up to its "error" too high.
+        limit caps each list (default 20).
+        """
+        if not QUERY_LOG_FILE:
+            self._send_json(404, {"status": "error", "message": "query log analytics are disabled"})
+            return
+        try:
+            limit = min(max(int(query.get("limit", ["20"])[0]), 1), MAX_PAGE_SIZE)
+        except ValueError:
+            self._send_json(400, {"status": "error", "message": "limit must be an integer"})
+            return
+
+        def names(summary):
+            return [{"domain": name, "count": count, "error": error}
+                    for name, count, error in QUERY_LOG_TAILER.top(summary, limit)]
+
+        def devices(summary):
+            result = []
+            for ip, count, error in QUERY_LOG_TAILER.top(summary, limit):
+                lease = DEVICE_BLOCKS.leases.by_ip(ip)
+                result.append({"ip": ip, "mac": lease.mac if lease is not None else None,
+                               "hostname": lease.hostname if lease is not None else None,
+                               "count": count, "error": error})
+            return result
+
+        if path == '/queries':
+            self._send_json(200, {"status": "ok", "stats": QUERY_LOG_TAILER.get_stats(),
+                                  "blocked": names("blocked_names"), "queried": names("names"),
+                                  "blocked_devices": devices("blocked_devices")})
+        elif path == '/queries/policies':
+            policies = []
+            for key, count, error in QUERY_LOG_TAILER.top("policies", limit):
+                source, domain = key if isinstance(key, tuple) else (SOURCE_ALL, key)
+                policies.append({"domain": domain, "source": source, "count": count, "error": error})
+            self._send_json(200, {"status": "ok", "policies": policies})
+        elif path == '/queries/devices':
+            self._send_json(200, {"status": "ok", "blocked": devices("blocked_devices"),
+                                  "queried": devices("devices")})
+        else:
+            self._send_json(404, {"status": "error", "message": "unknown path %s" % path})
+
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, %s" % PROFILER.header)
         self.send_header("Connection", "close")
         self.end_headers()
 
     def do_GET(self):
+        self._instrumented("GET", self._do_get)
+
+    def do_POST(self):
+        self._instrumented("POST", self._do_post)
+
+    def _get_metrics(self):
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def _do_get(self):
         try:
-            print("[%s] GET request - returning %d policies" % (datetime.now().strftime('%H:%M:%S'), len(POLICIES)))
-            self._set_headers(200)
-            response = {
-                "status": "ok",
-                "policies": POLICIES,
-                "count": len(POLICIES)
-            }
-            response_data = json.dumps(response).encode("utf-8")
-            self.wfile.write(response_data)
-            self.wfile.flush()
+            url = urlsplit(self.path)
+            path = url.path.rstrip('/')
+            query = parse_qs(url.query)
+
+            if path == '/changes':
+                self.action = "changes"
+                self._get_changes(query)
+                return
+
+            if path == '/devices/blocked':
+                self.action = "devices_blocked"
+                self._get_blocked_devices(query)
+                return
+
+            if path == '/groups':
+                self.action = "groups"
+                self._send_json(200, {"status": "ok", "groups": DEVICE_GROUPS.to_list()})
+                return
+
+            if path == '/metrics':
+                self.action = "metrics"
+                self._get_metrics()
+                return
+
+            if path.startswith('/queries'):
+                self.action = "queries"
+                self._get_queries(path, query)
+                return
+
+            if path == '/stats':
+                self.action = "stats"
+                self._send_json(200, {
+                    "status": "ok",
+                    "reload": RELOAD_SCHEDULER.get_stats(),
+                    "scheduler": POLICY_SCHEDULER.get_stats(),
+                    "devices": DEVICE_BLOCKS.get_stats(),
+                    "groups": dict(DEVICE_GROUPS.get_stats(),
+                                   domains=sum(len(b) for b in GROUP_BLOCKLISTS.values())),
+                    "dns": SINKHOLE.get_stats() if SINKHOLE is not None else None,
+                    "queries": QUERY_LOG_TAILER.get_stats() if QUERY_LOG_FILE else None,
+                    "policy_file": POLICY_FILE_STORE.get_stats() if POLICY_FILE_STORE is not None else None,
+                    "startup": {name: round(seconds, 4) for name, seconds in STARTUP_TIMINGS.items()},
+                    "process": PROCESS,
+                    "write_queue": WRITE_QUEUE.qsize(),
+                    "profiler": dict(PROFILER.stats),
+                    "logging": get_log_stats()
+                })
+                return
+
+            self.action = "policies"
+            self._get_policies(query)
         except BrokenPipeError:
-            print("[%s] Client disconnected before response completed (GET)" % datetime.now().strftime('%H:%M:%S'))
+            http_log.info("Client disconnected before response completed (GET)")
         except Exception as e:
-            print("[ERROR] do_GET failed: %s" % str(e))
+            http_log.error("do_GET failed: %s", str(e))
             try:
                 self._set_headers(500)
                 error_response = json.dumps({"status": "error", "message": str(e)}).encode("utf-8")
@@ -345,68 +1792,239 @@ class PolicyHandler(BaseHTTPRequestHandler):
             except:
                 pass
 
-    def do_POST(self):
+    def _apply_bulk(self, entries, errors):
+        """Reject the whole batch if any entry is invalid, otherwise apply it in one writer job"""
+        if errors:
+            self._send_json(400, {
+                "status": "error",
+                "message": "%d invalid entries, nothing applied" % len(errors),
+                "errors": errors[:100]
+            })
+            return
+        success, message = WRITE_QUEUE.call(apply_bulk_changes, entries)
+        snapshot = POLICY_SNAPSHOT
+        self._send_json(200 if success else 500, {
+            "status": "ok" if success else "error",
+            "message": message,
+            "count": len(snapshot),
+            "revision": snapshot.revision
+        })
+
+    def _post_ndjson(self, content_length):
+        """Stream an NDJSON body: one domain or {"action", "domain", "schedule", "source"} object per line"""
+        query = parse_qs(urlsplit(self.path).query)
+        default_action = query.get("action", ["block"])[0]
+        default_source = query.get("source", [None])[0]
+        entries, errors = [], []
+        remaining = content_length
+        line_no = 0
+        while remaining > 0:
+            line = self.rfile.readline(min(remaining, 65536))
+            if not line:
+                break
+            remaining -= len(line)
+            line_no += 1
+            try:
+                text = line.decode("utf-8").strip()
+                if not text or text.startswith("#"):
+                    continue
+                try:
+                    item = json.loads(text)
+                except ValueError:
+                    if text[0] in '{["':
+                        raise
+                    # Not JSON: a bare domain
+                    item = text
+                # parse_bulk_entry rejects JSON values other than objects and strings
+                entries.append(parse_bulk_entry(item, default_action, None, default_source))
+            except ValueError as e:
+                # UnicodeDecodeError is a ValueError too
+                errors.append({"line": line_no, "error": str(e)})
+        self._apply_bulk(entries, errors)
+
+    def _post_devices(self, path, payload):
+        """Block devices for a duration ({"mac", "ip"} or {"macs": [...]}, plus "duration") or unblock them"""
+        if path == '/devices/unblock':
+            macs = payload.get("macs") or [payload.get("mac")]
+            try:
+                if not isinstance(macs, list):
+                    raise ValueError("macs must be a list")
+                blocks = WRITE_QUEUE.call(DEVICE_BLOCKS.unblock, macs)
+            except (TypeError, ValueError) as e:
+                self._send_json(400, {"status": "error", "message": str(e)})
+                return
+            self._send_json(200, {
+                "status": "ok",
+                "message": "Unblocked %d device(s)" % len(macs),
+                "devices": [block.to_dict() for block in blocks]
+            })
+            return
+
+        # The dhcp scripts block with iptables themselves when this fails
+        if not DEVICE_BLOCKS.enforced():
+            self._send_json(503, {"status": "error",
+                                  "message": "No firewall tool (nft, ipset or iptables) - device blocks cannot be enforced"})
+            return
+        if isinstance(payload.get("macs"), list):
+            devices = [(mac, None, None) for mac in payload["macs"]]
+        else:
+            devices = [(payload.get("mac"), payload.get("ip"), payload.get("hostname"))]
+        try:
+            duration = float(payload.get("duration", BLOCK_DURATION))
+            lease_ips = [DEVICE_BLOCKS.lease_ip(mac) for mac, _, _ in devices]
+        except (TypeError, ValueError, OverflowError) as e:
+            self._send_json(400, {"status": "error", "message": str(e)})
+            return
+        # Refuse to cut off the client that is asking, as remove_device_complete.sh does over SSH
+        if self.client_address[0] in lease_ips and not payload.get("force"):
+            self._send_json(409, {"status": "error",
+                                  "message": "Refusing to block the requesting device (%s)" % self.client_address[0]})
+            return
+        try:
+            blocks = WRITE_QUEUE.call(DEVICE_BLOCKS.block_many, devices, duration)
+        except ValueError as e:
+            self._send_json(400, {"status": "error", "message": str(e)})
+            return
+        self._send_json(200, {
+            "status": "ok",
+            "message": "Blocked %d device(s)" % len(blocks),
+            "devices": [block.to_dict() for block in blocks]
+        })
+
+    def _post_groups(self, path, payload):
+        """Define or remove a group, or move devices in and out of groups
+
+        /groups/define {"name", "address"}, /groups/remove {"name"},
+        /groups/assign {"name", "devices": [{"mac"} or {"ip"}, ...]} and
+        /groups/unassign {"macs": [...]}; a device given by IP is looked up
+        in the DHCP leases.
+        """
+        try:
+            if path == '/groups/define':
+                result = WRITE_QUEUE.call(define_group, payload.get("name"), payload.get("address")).to_dict()
+                message = "Group %s resolves via %s" % (result["name"], result["address"])
+            elif path == '/groups/remove':
+                result = WRITE_QUEUE.call(remove_group, payload.get("name"))
+                message = "Removed group %s" % payload.get("name")
+            elif path == '/groups/assign':
+                devices = []
+                devices_in = payload.get("devices") or [payload]
+                if not isinstance(devices_in, list):
+                    raise ValueError("devices must be a list")
+                for device in devices_in:
+                    if not isinstance(device, dict):
+                        raise ValueError("Each device must be an object with a mac or an ip")
+                    mac, ip = device.get("mac"), device.get("ip")
+                    if not mac and ip:
+                        lease = DEVICE_BLOCKS.leases.by_ip(ip)
+                        if lease is None:
+                            raise ValueError("No DHCP lease for %s" % ip)
+                        mac = lease.mac
+                    devices.append((mac, ip))
+                result = WRITE_QUEUE.call(assign_devices, payload.get("name"), devices)
+                message = "Moved %d device(s) to %s" % (len(result), payload.get("name"))
+            else:
+                macs = payload.get("macs") or [payload.get("mac")]
+                if not isinstance(macs, list):
+                    raise ValueError("macs must be a list")
+                result = WRITE_QUEUE.call(unassign_devices, macs)
+                message = "Ungrouped %d device(s)" % len(result)
+        except (TypeError, ValueError) as e:
+            self._send_json(400, {"status": "error", "message": str(e)})
+            return
+        self._send_json(200, {"status": "ok", "message": message, "result": result})
+
+    def _do_post(self):
         try:
             content_length = int(self.headers.get('Content-Length', 0))
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+                self.action = "bulk_ndjson"
+                self._post_ndjson(content_length)
+                return
+
             post_data = self.rfile.read(content_length).decode("utf-8")
-            print("[%s] POST: %s" % (datetime.now().strftime('%H:%M:%S'), post_data))
+            if LOG_BODIES:
+                http_log.info("POST %s: %s", self.path, truncate_body(post_data))
 
             payload = json.loads(post_data)
+            if not isinstance(payload, dict):
+                self._send_json(400, {"status": "error", "message": "Request body must be a JSON object"})
+                return
+            path = urlsplit(self.path).path.rstrip('/')
+            if path in ('/devices/block', '/devices/unblock'):
+                self.action = path.strip('/').replace('/', '_')
+                self._post_devices(path, payload)
+                return
+            if path in ('/groups/define', '/groups/remove', '/groups/assign', '/groups/unassign'):
+                self.action = path.strip('/').replace('/', '_')
+                self._post_groups(path, payload)
+                return
+
             action = payload.get("action")
             domain = payload.get("domain") or payload.get("destination") or payload.get("website")
 
+            if action and isinstance(payload.get("domains"), list):
+                self.action = "bulk"
+                entries, errors = [], []
+                for i, item in enumerate(payload["domains"]):
+                    try:
+                        entries.append(parse_bulk_entry(item, action, payload.get("schedule"),
+                                                        payload.get("source")))
+                    except ValueError as e:
+                        errors.append({"index": i, "error": str(e)})
+                self._apply_bulk(entries, errors)
+                return
+
             if not action or not domain:
                 self._set_headers(400)
                 error_response = json.dumps({"status": "error", "message": "Missing action or domain"}).encode("utf-8")
                 self.wfile.write(error_response)
                 self.wfile.flush()
                 return
+            if not isinstance(action, str) or not isinstance(domain, str):
+                self._send_json(400, {"status": "error", "message": "action and domain must be strings"})
+                return
 
-            # Clean domain name
-            domain = domain.replace('http://', '').replace('https://', '').replace('www.', '').strip('/')
+            # Clean domain name; the same check as bulk entries
+            try:
+                domain = validate_domain(domain)
+                source = parse_source(payload.get("source"))
+            except ValueError as e:
+                self._send_json(400, {"status": "error", "message": str(e)})
+                return
 
             if action == "block":
-                success, message = self.block_website(domain)
-                if success:
-                    # Check if policy already exists
-                    existing = False
-                    for p in POLICIES:
-                        if p.get("destination") == domain:
-                            p["enabled"] = True
-                            p["schedule"] = payload.get("schedule", {"start": "00:00", "end": "23:59"})
-                            existing = True
-                            break
-
-                    if not existing:
-                        POLICIES.append({
-                            "destination": domain,
-                            "enabled": True,
-                            "schedule": payload.get("schedule", {"start": "00:00", "end": "23:59"})
-                        })
+                self.action = "block"
+                try:
+                    schedule = compile_schedule(payload.get("schedule") or DEFAULT_SCHEDULE)
+                except ValueError as e:
+                    self._send_json(400, {"status": "error", "message": "Invalid schedule: %s" % str(e)})
+                    return
+
+                success, message = WRITE_QUEUE.call(block_website, domain, schedule, source)
 
             elif action == "unblock":
-                success, message = self.unblock_website(domain)
-                if success:
-                    POLICIES[:] = [p for p in POLICIES if p.get("destination") != domain]
+                self.action = "unblock"
+                success, message = WRITE_QUEUE.call(unblock_website, domain, source)
             else:
                 success = False
                 message = "Unknown action: %s" % action
 
-            self._set_headers(200 if success else 500)
-            response = {
-                "status": "ok" if success else "error",
-                "message": message,
-                "policies": POLICIES,
-                "count": len(POLICIES)
-            }
-            response_data = json.dumps(response).encode("utf-8")
-            self.wfile.write(response_data)
-            self.wfile.flush()
+            if success:
+                # Reported only once the batched write of /etc/hosts and dnsmasq has run
+                error = RELOAD_SCHEDULER.wait()
+                if error:
+                    success = False
+                    message = "%s %sed in the database, but not applied: %s" % (domain, action, error)
+
+            self._send_policies(200 if success else 500, POLICY_SNAPSHOT,
+                                status="ok" if success else "error", message=message)
 
         except BrokenPipeError:
-            print("[%s] Client disconnected before response completed (POST)" % datetime.now().strftime('%H:%M:%S'))
+            http_log.info("Client disconnected before response completed (POST)")
         except json.JSONDecodeError as e:
-            print("[ERROR] Invalid JSON: %s" % str(e))
+            http_log.warning("Invalid JSON: %s", str(e))
             try:
                 self._set_headers(400)
                 error_response = json.dumps({"status": "error", "message": "Invalid JSON"}).encode("utf-8")
@@ -415,7 +2033,7 @@ class PolicyHandler(BaseHTTPRequestHandler):
             except:
                 pass
         except Exception as e:
-            print("[ERROR] do_POST failed: %s" % str(e))
+            http_log.error("do_POST failed: %s", str(e))
             try:
                 self._set_headers(500)
                 error_response = json.dumps({"status": "error", "message": str(e)}).encode("utf-8")
@@ -424,158 +2042,237 @@ class PolicyHandler(BaseHTTPRequestHandler):
             except:
                 pass
 
-    def block_website(self, domain):
-        try:
-            # Method 1: Add to /etc/hosts (for Pi itself)
-            with open('/etc/hosts', 'r') as f:
-                content = f.read()
-                if "127.0.0.1 %s" % domain in content or "127.0.0.1 www.%s" % domain in content:
-                    print("[INFO] %s already in /etc/hosts" % domain)
-                else:
-                    with open('/etc/hosts', 'a') as f:
-                        f.write("\n# SEER Policy %s\n" % datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                        f.write("127.0.0.1 %s\n" % domain)
-                        f.write("127.0.0.1 www.%s\n" % domain)
-
-            # Method 2: Add to DNSMasq (for all network clients)
-            dnsmasq_file = "/etc/dnsmasq.d/blocked-sites.conf"
-            
-            # Read current blocks
-            blocked_domains = set()
-            try:
-                with open(dnsmasq_file, 'r') as f:
-                    for line in f:
-                        if line.startswith("address=/"):
-                            blocked_domains.add(line.strip())
-            except:
-                pass
-            
-            # Add new blocks (including wildcard for all subdomains)
-            new_entries = [
-                "address=/%s/127.0.0.1" % domain,
-                "address=/.%s/127.0.0.1" % domain  # Wildcard for all subdomains
-            ]
-            
-            for entry in new_entries:
-                blocked_domains.add(entry)
-            
-            # Write back to file
-            with open(dnsmasq_file, 'w') as f:
-                f.write("# SEER Temporal Policy - Blocked Domains\n")
-                f.write("# This file is managed by temporal_policy.py\n")
-                f.write("# Last updated: %s\n\n" % datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                for entry in sorted(blocked_domains):
-                    f.write(entry + "\n")
-            
-            # Restart DNSMasq to apply changes
-            subprocess.run(['systemctl', 'restart', 'dnsmasq'],
-                         check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-            # ========== SAVE TO DATABASE ==========
-            save_blocked_website_to_db(domain)
-
-            print("[SUCCESS] Blocked: %s (via /etc/hosts and DNSMasq)" % domain)
-            return True, "%s blocked successfully" % domain
-
-        except PermissionError:
-            return False, "Permission denied - run with sudo"
-        except Exception as e:
-            return False, "Error blocking %s: %s" % (domain, str(e))
 
-    def unblock_website(self, domain):
-        try:
-            # Remove from /etc/hosts
-            with open('/etc/hosts', 'r') as f:
-                lines = f.readlines()
-
-            new_lines = []
-            skip_comment = False
+def apply_root(prefix):
+    """Re-base every file the engine touches under prefix, e.g. a scratch directory
 
-            for line in lines:
-                if domain in line and ("127.0.0.1" in line or "::1" in line):
-                    continue
-                if "SEER Policy" in line:
-                    skip_comment = True
-                    continue
-                if skip_comment and not line.strip():
-                    skip_comment = False
-                    continue
-                new_lines.append(line)
-
-            with open('/etc/hosts', 'w') as f:
-                f.writelines(new_lines)
-
-            # Remove from DNSMasq
-            dnsmasq_file = "/etc/dnsmasq.d/blocked-sites.conf"
-            
-            try:
-                with open(dnsmasq_file, 'r') as f:
-                    lines = f.readlines()
-                
-                with open(dnsmasq_file, 'w') as f:
-                    f.write("# SEER Temporal Policy - Blocked Domains\n")
-                    f.write("# This file is managed by temporal_policy.py\n")
-                    f.write("# Last updated: %s\n\n" % datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                    for line in lines:
-                        # Skip lines containing the domain
-                        if domain not in line or line.startswith("#"):
-                            if not (line.startswith("#") and "managed by" in line):
-                                if not (line.startswith("#") and "Last updated" in line):
-                                    if line.strip() and not line.startswith("# SEER"):
-                                        f.write(line)
-            except:
-                pass
-            
-            # Restart DNSMasq to apply changes
-            subprocess.run(['systemctl', 'restart', 'dnsmasq'],
-                         check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    The database, /etc/hosts, blocked-sites.conf, the group files, the
+    dnsmasq PID, lease and query log files, the query log state and the
+    device registry move under prefix, and device blocks use
+    a dry-run firewall without iptables/conntrack calls, so nothing outside
+    prefix changes. Point DNSMASQ_RESTART_COMMAND (and GROUP_RESOLVER_COMMAND)
+    at a stand-in such as benchmarks/fake_dnsmasq.py to complete the sandbox.
+    """
+    global ROOT_PREFIX, DB_PATH, HOSTS_FILE, DNSMASQ_CONF, DNSMASQ_PID_FILE, GROUPS_CONF
 
-            # ========== REMOVE FROM DATABASE ==========
-            remove_blocked_website_from_db(domain)
+    def rooted(path):
+        path = os.path.join(prefix, path.lstrip("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
 
-            print("[SUCCESS] Unblocked: %s (from /etc/hosts and DNSMasq)" % domain)
-            return True, "%s unblocked successfully" % domain
+    ROOT_PREFIX = prefix
+    DB_PATH = rooted(SYSTEM_PATHS["DB_PATH"])
+    HOSTS_FILE = rooted(SYSTEM_PATHS["HOSTS_FILE"])
+    DNSMASQ_CONF = rooted(SYSTEM_PATHS["DNSMASQ_CONF"])
+    DNSMASQ_PID_FILE = rooted(SYSTEM_PATHS["DNSMASQ_PID_FILE"])
+    GROUPS_CONF = rooted(SYSTEM_PATHS["GROUPS_CONF"])
+    DEVICE_GROUPS.directory = os.path.join(prefix, SYSTEM_PATHS["GROUP_DIR"].lstrip("/"))
+    QUERY_LOG_TAILER.path = rooted(SYSTEM_PATHS["QUERY_LOG_FILE"])
+    QUERY_LOG_TAILER.state_path = rooted(SYSTEM_PATHS["QUERY_LOG_STATE"])
+    DEVICE_BLOCKS.leases.path = rooted(LEASE_FILE)
+    DEVICE_BLOCKS.registry = rooted(BLOCK_REGISTRY)
+    DEVICE_BLOCKS.firewall = create_backend("nft" if FIREWALL_BACKEND == "auto" else FIREWALL_BACKEND, dry_run=True)
+    DEVICE_BLOCKS.system_commands = False
 
-        except PermissionError:
-            return False, "Permission denied - run with sudo"
-        except Exception as e:
-            return False, "Error unblocking %s: %s" % (domain, str(e))
 
+def start_server():
+    """Restore state, start the background threads and bind the HTTP server
 
-def run():
-    print("=" * 60)
-    print("Temporal Policy Backend - Port %d" % SERVER_PORT)
-    print("=" * 60)
+    The HTTP socket is taken over when systemd (temporal-policy.socket) or
+    an in-place restart passed one; otherwise the port is freed and bound.
+    Returns the server, or None if the port could not be bound.
+    """
+    global SINKHOLE, POLICY_FILE_STORE, POLICY_FILE_WATCHER
+    started = time.perf_counter()
+    STARTUP_TIMINGS.clear()
+    PROCESS["started"] = time.time()
+    inherited = listen_fds()
+    listener = inherited.pop("http", None)
+    if listener is None and len(inherited) == 1:
+        # Socket units name their descriptor after the unit unless FileDescriptorName= is set
+        listener = inherited.popitem()[1]
+    for name, sock in inherited.items():
+        startup_log.warning("Closing unexpected inherited socket %s", name)
+        sock.close()
 
     # Initialize database on startup
-    print("[STARTUP] Initializing database...")
-    if not ensure_db_initialized():
-        print("[WARNING] Database initialization had issues, continuing anyway...")
+    startup_log.info("Initializing database...")
+    with startup_phase("db"):
+        if not ensure_db_initialized():
+            startup_log.warning("Database initialization had issues, continuing anyway...")
 
-    # Automatically kill any process on the port
-    print("[STARTUP] Checking port %d..." % SERVER_PORT)
-    kill_process_on_port(SERVER_PORT)
+    if listener is None:
+        # Automatically stop any process on the port
+        startup_log.info("Checking port %d...", SERVER_PORT)
+        with startup_phase("port"):
+            kill_process_on_port(SERVER_PORT)
 
     # Load blocked websites from database on startup
     load_and_apply_blocked_websites()
+    with startup_phase("devices"):
+        DEVICE_BLOCKS.load()
+    POLICY_SCHEDULER.start(WRITE_QUEUE)
+    DEVICE_BLOCKS.start()
+    WRITE_QUEUE.start()
+    if QUERY_LOG_FILE:
+        QUERY_LOG_TAILER.start()
+
+    if POLICY_FILE:
+        try:
+            with startup_phase("policy_file"):
+                store = PolicyFile(POLICY_FILE, parse_policy_file_entry)
+                # At startup the file can only add to or change the database's policies
+                success, message = WRITE_QUEUE.call(apply_policy_file_changes, list(store.load().values()), ())
+                if not success:
+                    startup_log.warning("%s: %s", POLICY_FILE, message)
+                # ...and then picks up the database's policies it does not have yet
+                store.append(POLICY_SNAPSHOT.policies, ())
+                POLICY_FILE_STORE = store
+                POLICY_FILE_WATCHER = PolicyFileWatcher(
+                    store, lambda upserts, deleted: WRITE_QUEUE.call(apply_policy_file_changes, upserts, deleted))
+                POLICY_FILE_WATCHER.start()
+        except (OSError, ValueError) as e:
+            startup_log.error("Could not load policy file %s: %s", POLICY_FILE, str(e))
+
+    if DNS_SINKHOLE:
+        try:
+            with startup_phase("dns"):
+                SINKHOLE = DNSSinkhole(match_policy, parse_upstream(DNS_UPSTREAM), DNS_LISTEN_ADDRESS, DNS_PORT)
+                SINKHOLE.start()
+        except OSError as e:
+            startup_log.error("DNS sinkhole could not bind %s:%d: %s", DNS_LISTEN_ADDRESS, DNS_PORT, str(e))
+            return None
 
     try:
-        server = HTTPServer((HOST_NAME, SERVER_PORT), PolicyHandler)
-        print("[STARTUP] Successfully bound to port %d" % SERVER_PORT)
-        print("=" * 60)
-        print("Ready! Waiting for requests...")
-        print("=" * 60)
-        server.serve_forever()
+        with startup_phase("bind"):
+            server = GracefulHTTPServer((HOST_NAME, SERVER_PORT), PolicyHandler, listener)
     except OSError as e:
-        if e.errno == 98:
-            print("[ERROR] Port %d still in use" % SERVER_PORT)
-            print("[ERROR] Try: sudo fuser -k %d/tcp" % SERVER_PORT)
+        if e.errno == errno.EADDRINUSE:
+            startup_log.error("Port %d still in use - try: sudo fuser -k %d/tcp", SERVER_PORT, SERVER_PORT)
         else:
-            print("[ERROR] %s" % str(e))
-    except KeyboardInterrupt:
-        print("\n[SHUTDOWN] Server stopped")
+            startup_log.error("%s", str(e))
+        return None
+
+    STARTUP_TIMINGS["total"] = time.perf_counter() - started
+    PROCESS["socket"] = "inherited" if server.inherited else "bound"
+    if server.inherited:
+        startup_log.info("Serving on inherited socket %s:%d", *server.server_address[:2])
+    else:
+        startup_log.info("Successfully bound to port %d", SERVER_PORT)
+    startup_log.info("Ready in %.3fs (%s)", STARTUP_TIMINGS["total"], ", ".join(
+        "%s %.3fs" % (name, seconds) for name, seconds in STARTUP_TIMINGS.items() if name != "total"))
+    return server
+
+
+def shutdown(server):
+    """Finish the requests in progress and the queued mutations, then stop the background threads"""
+    left = server.drain(DRAIN_TIMEOUT)
+    if left:
+        startup_log.warning("%d request(s) still running after %.0fs, stopping anyway", left, DRAIN_TIMEOUT)
+    POLICY_SCHEDULER.stop()
+    DEVICE_BLOCKS.stop()
+    WRITE_QUEUE.stop()
+    RELOAD_SCHEDULER.flush()
+    if SINKHOLE is not None:
+        SINKHOLE.stop()
+    QUERY_LOG_TAILER.stop()
+    if POLICY_FILE_WATCHER is not None:
+        POLICY_FILE_WATCHER.stop()
+    STORAGE.close()
+
+
+def run():
+    setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS, LOG_RATE_LIMIT, LOG_RATE_BURST)
+    startup_log.info("Temporal Policy Backend - Port %d", SERVER_PORT)
+    if ROOT_PREFIX:
+        startup_log.info("Running under root prefix %s", ROOT_PREFIX)
+
+    server = start_server()
+    if server is None:
+        return
+
+    # SIGTERM (systemctl stop/restart) and SIGINT stop after draining;
+    # SIGUSR2 (systemctl reload) restarts in place on the same socket
+    received = []
+    restart_signal = getattr(signal, "SIGUSR2", None)
+
+    def request_stop(signum, frame):
+        if not received:
+            received.append(signum)
+            # shutdown() waits for serve_forever(), which runs on this thread
+            threading.Thread(target=server.shutdown, name="shutdown", daemon=True).start()
+
+    for signum in (signal.SIGTERM, signal.SIGINT, restart_signal):
+        if signum is not None:
+            signal.signal(signum, request_stop)
+
+    notify("READY=1\nSTATUS=Serving %d policies on port %d" % (len(POLICY_SNAPSHOT), server.server_address[1]))
+    startup_log.info("Ready! Waiting for requests...")
+    server.serve_forever(STOP_POLL_INTERVAL)
+
+    restarting = received[0] == restart_signal
+    notify("RELOADING=1" if restarting else "STOPPING=1")
+    if not restarting:
+        # Release the port right away; under socket activation systemd keeps
+        # its copy, and connections wait there for the next start
         server.server_close()
+    startup_log.info("%s: finishing %d request(s) and %d queued change(s)",
+                     "Restarting" if restarting else "Stopping", server.active(), WRITE_QUEUE.qsize())
+    shutdown(server)
+    if restarting:
+        startup_log.info("Restarting in place on the same socket")
+        shutdown_logging()
+        try:
+            reexec({"http": server.socket})
+        except OSError as e:
+            setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS, LOG_RATE_LIMIT, LOG_RATE_BURST)
+            startup_log.error("Restart failed, stopping instead: %s", str(e))
+        server.server_close()
+    startup_log.info("Server stopped")
 
 
-if __name__ == "__main__":
+def main():
+    global LOG_LEVEL, LOG_FORMAT, LOG_FILE, LOG_BODIES, SERVER_PORT, DNSMASQ_RESTART_COMMAND, GROUP_RESOLVER_COMMAND
+    global DNS_SINKHOLE, DNS_PORT, DNS_UPSTREAM, QUERY_LOG_FILE, POLICY_FILE
+    parser = argparse.ArgumentParser(description="SEER temporal policy engine")
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--root", default=ROOT_PREFIX, help="run against files under this directory")
+    parser.add_argument("--restart-command", default=" ".join(DNSMASQ_RESTART_COMMAND),
+                        help="command that restarts dnsmasq")
+    parser.add_argument("--group-resolver-command", default=" ".join(GROUP_RESOLVER_COMMAND),
+                        help="command that starts/restarts/stops a group resolver ({action}, {group})")
+    parser.add_argument("--dns-sinkhole", action="store_true", default=DNS_SINKHOLE,
+                        help="answer DNS on --dns-port from the blocklist, forwarding the rest to --dns-upstream")
+    parser.add_argument("--dns-port", type=int, default=DNS_PORT)
+    parser.add_argument("--dns-upstream", default=DNS_UPSTREAM, help="resolver for names that are not blocked")
+    parser.add_argument("--policy-file", default=POLICY_FILE,
+                        help="policies.json-style file to apply on change and journal engine changes into")
+    parser.add_argument("--query-log", default=QUERY_LOG_FILE,
+                        help="dnsmasq log-queries file to tail for /queries (empty to disable)")
+    parser.add_argument("--log-level", default=LOG_LEVEL, choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        type=str.upper)
+    parser.add_argument("--log-format", default=LOG_FORMAT, choices=("text", "json"))
+    parser.add_argument("--log-file", default=LOG_FILE, help="rotated log file instead of stdout")
+    parser.add_argument("--log-bodies", action="store_true", default=LOG_BODIES,
+                        help="log request bodies (truncated)")
+    args = parser.parse_args()
+    LOG_LEVEL, LOG_FORMAT, LOG_FILE, LOG_BODIES = args.log_level, args.log_format, args.log_file, args.log_bodies
+    SERVER_PORT = args.port
+    DNSMASQ_RESTART_COMMAND = shlex.split(args.restart_command)
+    GROUP_RESOLVER_COMMAND = shlex.split(args.group_resolver_command)
+    DNS_SINKHOLE, DNS_PORT, DNS_UPSTREAM = args.dns_sinkhole, args.dns_port, args.dns_upstream
+    QUERY_LOG_FILE = args.query_log or None
+    POLICY_FILE = args.policy_file or None
+    if QUERY_LOG_FILE:
+        QUERY_LOG_TAILER.path = QUERY_LOG_FILE
+        SYSTEM_PATHS["QUERY_LOG_FILE"] = QUERY_LOG_FILE
+    if DNS_SINKHOLE:
+        # Applying a change is only an index update, so do it right away
+        RELOAD_SCHEDULER.window = 0
+    if args.root:
+        apply_root(args.root)
     run()
+
+
+if __name__ == "__main__":
+    main()